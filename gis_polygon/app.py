@@ -1,25 +1,116 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+"""
+GISPolygon WSGI application.
+
+    gunicorn gis_polygon.app - the application is built by each worker on the first access to `application`
+    gunicorn -c gunicorn.conf.py - preloaded by the master with create_app() and warm_up(), then forked
+"""
+
+import logging
+from datetime import datetime
+
 import falcon
 from falcon_cors import CORS
+from shapely.geometry import Polygon
+from sqlalchemy.orm import configure_mappers
+
+import settings
+from . import formats, geometry_pool
+from .controllers import GISPolygonList, GISPolygonCRUD, GISPolygonTransform, GISPolygonBulk, GISPolygonStatus, \
+    GISPolygonSearch, GISPolygonTiles, GISPolygonMetrics, GISPolygonProfiles, GISPolygonStats, \
+    GISPolygonChanges, BaseGISPolygonController
+from .db_session import SessionManager
+from .encoders import dumps, encode_gis_polygon, encode_created_gis_polygon
+from .metrics import Metrics
+from .profiling import Profiler
+
+
+def configure_logging():
+    logging.basicConfig(level=logging.INFO, filename=settings.LOG_FILE,
+                        format="%(levelname)s:%(name)s:%(funcName)s: %(message)s")
+
+
+def create_app():
+    """
+    Build the WSGI application.
+    :return:
+    """
+    configure_logging()
+
+    cors = CORS(allow_all_origins=True,
+                allow_all_headers=True,
+                allow_origins_list=['*'],
+                allow_all_methods=True)
+
+    # Metrics goes first to time the whole request, session commit included
+    middleware = ([Metrics()] if settings.METRICS_ENABLED else []) + \
+        ([Profiler()] if settings.PROFILE_ENABLED else []) + [cors.middleware, SessionManager()]
+
+    api = falcon.App(middleware=middleware)
+    # keep commas in WKT query params, comma separated lists are split explicitly
+    api.req_options.auto_parse_qs_csv = False
+    # serve /gis_polygon/ and /gis_polygon/list/ as well, falcon>=3 keeps the trailing slash by default
+    api.req_options.strip_url_path_trailing_slash = True
+    # JSON only, falcon>=3 parses URL-encoded forms into req.media as well
+    api.req_options.media_handlers.pop(falcon.MEDIA_URLENCODED, None)
+
+    gis_polygon_list = GISPolygonList()
+    gis_polygon_crud = GISPolygonCRUD()
+    gis_polygon_transform = GISPolygonTransform()
+    gis_polygon_bulk = GISPolygonBulk()
+    gis_polygon_status = GISPolygonStatus()
+    gis_polygon_search = GISPolygonSearch()
+    gis_polygon_tiles = GISPolygonTiles()
+    gis_polygon_profiles = GISPolygonProfiles()
+
+    api.add_route('/gis_polygon', gis_polygon_crud)
+    api.add_route('/gis_polygon/{gis_polygon_id}', gis_polygon_crud)
+
+    api.add_route('/gis_polygon/transform', gis_polygon_transform)
+    api.add_route('/gis_polygon/bulk', gis_polygon_bulk)
+    api.add_route('/gis_polygon/status', gis_polygon_status)
+    api.add_route('/gis_polygon/search', gis_polygon_search)
+    api.add_route('/gis_polygon/stats', GISPolygonStats())
+    api.add_route('/gis_polygon/changes', GISPolygonChanges())
+    api.add_route('/gis_polygon/tiles/{z}/{x}/{y}.mvt', gis_polygon_tiles)
+    api.add_route('/metrics', GISPolygonMetrics())
+    api.add_route('/gis_polygon/profiles', gis_polygon_profiles)
+    api.add_route('/gis_polygon/profiles/{capture_id}', gis_polygon_profiles)
+
+    api.add_route('/gis_polygon/list', gis_polygon_list)
 
-from .controllers import GISPolygonList, GISPolygonCRUD, GISPolygonTransform
+    return api
 
-cors = CORS(allow_all_origins=True,
-            allow_all_headers=True,
-            allow_origins_list=['*'],
-            allow_all_methods=True)
 
-api = application = falcon.API(middleware=[cors.middleware])
+def warm_up():
+    """
+    Pay the one-off costs the first requests would pay otherwise, with no database access:
+    mapper configuration, pyproj CRS database lookups of settings.WARM_UP_SRIDS transformers,
+    and the first run of geometry parsing, serializers and encoders.
+    :return:
+    """
+    configure_mappers()
 
-gis_polygon_list = GISPolygonList()
-gis_polygon_crud = GISPolygonCRUD()
-gis_polygon_transform = GISPolygonTransform()
+    square = Polygon([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)])
+    for srid in settings.WARM_UP_SRIDS:
+        geometry_pool.transform([square.wkb], 'epsg:4326', 'epsg:%s' % srid)
+        formats.crs_json(srid)
+    formats.crs_json(4326)
 
-api.add_route('/gis_polygon', gis_polygon_crud)
-api.add_route('/gis_polygon/{gis_polygon_id}', gis_polygon_crud)
+    gis_polygon = BaseGISPolygonController.serializer.load({'name': 'warm_up', 'class_id': 0, 'props': '{}',
+                                                            'geom': 'SRID=4326;' + square.wkt}).data
+    gis_polygon.id = 0
+    gis_polygon._created = gis_polygon._updated = datetime.utcnow()
+    dumps(encode_gis_polygon(gis_polygon))
+    dumps(encode_created_gis_polygon(gis_polygon))
 
-api.add_route('/gis_polygon/transform', gis_polygon_transform)
 
-api.add_route('/gis_polygon/list/', gis_polygon_list)
+def __getattr__(name):
+    # `api`/`application` are built on the first access rather than on import, so importing the module
+    # (e.g. by gunicorn master before forking) builds nothing the factory users do not need
+    if name in ('api', 'application'):
+        globals()['api'] = globals()['application'] = create_app()
+        return globals()[name]
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
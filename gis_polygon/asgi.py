@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+ASGI variant of the GISPolygon API, to be run by uvicorn:
+    uvicorn gis_polygon.asgi:app
+
+GISPolygonCRUD, GISPolygonList and GISPolygonTransform responders are async: they query through
+SQLAlchemy asyncio engine (asyncpg driver at settings.ASYNC_DB_PATH) by the same query code as the WSGI
+application, run by AsyncSession.run_sync, while blocking Shapely/pyproj and serialization work
+is offloaded to the default executor.
+The rest of the routes are not ported to the async engine: search, stats, changes, tiles, status, metrics and
+profiles run their sync responders, and bulk its statements, in the executor on the sync (psycopg2) engine.
+
+Requires falcon>=3 and SQLAlchemy>=1.4.
+"""
+
+import asyncio
+import contextvars
+import io
+from functools import partial
+
+import falcon
+import falcon.asgi
+from marshmallow import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from webargs.falconparser import parser
+
+import settings
+from . import formats, profiling
+from .changes import record_changes
+from .controllers import GISPolygonCRUD, GISPolygonList, GISPolygonTransform, GISPolygonBulk, GISPolygonStatus, \
+    GISPolygonSearch, GISPolygonStats, GISPolygonChanges, GISPolygonTiles, GISPolygonMetrics, GISPolygonProfiles, \
+    UserSchema
+from .db_session import DBSession, SessionManager
+from .encoders import dumps, encode_created_gis_polygon
+from .lod import refresh_lod
+from .metrics import AsyncMetrics, instrument_engine
+from .models import GISPolygon
+from .stats import add_class_stats
+from .tiles import geom_bounds
+
+async_engine = create_async_engine(settings.ASYNC_DB_PATH,
+                                   pool_size=settings.DB_POOL_SIZE,
+                                   max_overflow=settings.DB_MAX_OVERFLOW,
+                                   pool_timeout=settings.DB_POOL_TIMEOUT,
+                                   pool_recycle=settings.DB_POOL_RECYCLE,
+                                   pool_pre_ping=settings.DB_POOL_PRE_PING)
+if settings.METRICS_ENABLED:
+    instrument_engine(async_engine.sync_engine)
+if settings.PROFILE_ENABLED:
+    profiling.instrument_engine(async_engine.sync_engine)
+
+# Objects stay readable after commit, as reading expired attributes would need IO outside of await
+AsyncDBSession = sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def run_blocking(func, *args):
+    """
+    Run blocking func in the default executor not to block the event loop, within the context of the caller
+    (so it is timed into the request metrics).
+    :param func:
+    :param args:
+    :return:
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, partial(contextvars.copy_context().run,
+                                                                          func, *args))
+
+
+class AsyncSessionStream(object):
+    """
+    Streamed response body read with an AsyncDBSession of its own, closing the session once exhausted or closed
+    by falcon, on client disconnect as well, even if it has never been iterated (when the finally clause
+    of an async generator body would never run, and falcon.asgi calls close() rather than aclose()).
+    """
+
+    def __init__(self, session, stream):
+        self.session = session
+        self.stream = stream
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except StopAsyncIteration:
+            await self.close()
+            raise
+
+    async def close(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            await self.session.close()
+
+
+class AsyncSessionManager(object):
+    """
+    Falcon ASGI middleware opening AsyncDBSession for a request and closing it on response:
+    commits it if the request succeeded, rolls it back otherwise.
+    """
+
+    async def process_request(self, req, resp):
+        req.context.session = AsyncDBSession()
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        session = getattr(req.context, 'session', None)
+        if session is None:
+            return
+
+        try:
+            if req_succeeded:
+                await session.commit()
+            else:
+                await session.rollback()
+        finally:
+            await session.close()
+
+
+class AsyncGISPolygonCRUD(GISPolygonCRUD):
+    """
+    GISPolygonCRUD with async responders, sharing the cache with it.
+    """
+
+    async def on_get(self, req, resp, gis_polygon_id=None):
+        geom_format = self.get_geom_format(req)
+        tolerance = self.get_tolerance(req)
+
+        session = req.context.session
+
+        version = await session.run_sync(self.get_version, gis_polygon_id)
+        if version is None:
+            self.invalidate(gis_polygon_id)
+            return self.response_404(resp)
+
+        if self.not_modified(req, resp, self.make_etag(gis_polygon_id, version, geom_format, tolerance)):
+            return
+
+        # keyed by the numeric id, '/gis_polygon/007' and '/gis_polygon/7' are the same entry
+        cache_key = (int(gis_polygon_id), geom_format, tolerance)
+        if self.cache is not None:
+            if not settings.GET_CACHE_VERIFY:
+                version = None
+
+            body = self.cache.get(cache_key, version)
+            if body is not None:
+                resp.data = body
+                resp.status = falcon.HTTP_200
+                return
+
+        gis_polygon = await session.run_sync(self.get_gis_polygon, gis_polygon_id, geom_format, tolerance)
+
+        if not gis_polygon:
+            return self.response_404(resp)
+
+        body = await run_blocking(lambda: dumps(self.as_dict(gis_polygon)))
+        if self.cache is not None:
+            self.cache.set(cache_key, body, version)
+
+        resp.data = body
+        resp.status = falcon.HTTP_200
+
+    async def on_post(self, req, resp):
+        session = req.context.session
+        data = await req.get_media()
+
+        try:
+            serialized = await run_blocking(partial(self.serializer.load, data=data))
+        except ValidationError as err:
+            return self.response_400(resp, err)
+
+        gis_polygon = serialized.data
+        bounds = geom_bounds(gis_polygon.geom)
+
+        session.add(gis_polygon)
+        await session.flush()
+        await session.run_sync(refresh_lod, GISPolygon.id == gis_polygon.id)
+        await session.run_sync(add_class_stats, GISPolygon.id == gis_polygon.id)
+        await session.run_sync(record_changes, GISPolygon.id == gis_polygon.id)
+        await session.commit()
+        self.invalidate(gis_polygon.id, bounds)
+
+        resp.data = dumps(encode_created_gis_polygon(gis_polygon))
+        resp.status = falcon.HTTP_201
+
+    async def on_put(self, req, resp, gis_polygon_id=None):
+        session = req.context.session
+        data = await req.get_media()
+
+        try:
+            serialized = await run_blocking(partial(self.serializer.load, data=data, partial=True))
+        except ValidationError as err:
+            return self.response_400(resp, err)
+
+        values = self.written_values(serialized.data, data)
+        if values:
+            ids, bounds = await session.run_sync(self.update_gis_polygons, values,
+                                                 [GISPolygon.id == gis_polygon_id])
+            found = bool(ids)
+        else:
+            found, bounds = await session.run_sync(self.get_version, gis_polygon_id) is not None, []
+
+        if not found:
+            return self.response_404(resp)
+
+        await session.commit()
+        self.invalidate(gis_polygon_id, *bounds)
+
+        resp.data = dumps({"status": "200 OK"})
+        resp.status = falcon.HTTP_200
+
+    async def on_delete(self, req, resp, gis_polygon_id=None):
+        session = req.context.session
+        ids, bounds = await session.run_sync(self.delete_gis_polygons, [GISPolygon.id == gis_polygon_id])
+
+        if not ids:
+            return self.response_404(resp)
+
+        await session.commit()
+        self.invalidate(gis_polygon_id, *bounds)
+
+        resp.data = dumps({"status": "200 OK"})
+        resp.status = falcon.HTTP_200
+
+
+class AsyncGISPolygonList(GISPolygonList):
+    """
+    GISPolygonList with async responder, the whole list is streamed through a server-side cursor
+    of a session of its own, chunks are encoded in the executor.
+    """
+
+    async def on_get(self, req, resp):
+        sort = self.get_sort(req)
+        after = self.get_after(req, sort)
+        limit = self.get_limit(req)
+        criteria = self.get_criteria(req)
+        geom_format = self.get_geom_format(req)
+        tolerance = self.get_tolerance(req)
+        media_type = self.get_media_type(req)
+
+        session = req.context.session
+
+        resp.set_header('Vary', 'Accept')
+
+        def query(sync_session):
+            return self.query_gis_polygons(sync_session, after, geom_format, tolerance, media_type, sort) \
+                .filter(*criteria)
+
+        if limit:
+            etag = self.make_etag(req.query_string, media_type,
+                                  *(await session.run_sync(self.get_page_version, after, limit, criteria, sort)))
+            if self.not_modified(req, resp, etag):
+                return
+            gis_polygons = await session.run_sync(lambda sync_session: query(sync_session).limit(limit).all())
+            return await run_blocking(self.response_page, resp, gis_polygons, after, limit, media_type, sort,
+                                      bool(criteria))
+
+        # the stream outlives the request session, so it reads with a session of its own
+        stream_session = AsyncDBSession()
+        try:
+            statement = await stream_session.run_sync(lambda sync_session: query(sync_session).statement)
+            result = await stream_session.stream(statement)
+            chunks = result.partitions(settings.LIST_STREAM_CHUNK)
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except Exception:
+            await stream_session.close()
+            raise
+
+        if first is None:
+            await stream_session.close()
+            if media_type == formats.JSON:
+                return self.response_empty(resp, after, bool(criteria))
+            return await run_blocking(self.response_encoded, resp, media_type, [])
+
+        if media_type != formats.JSON:
+            resp.content_type = media_type
+        resp.stream = AsyncSessionStream(stream_session, self.stream_async(media_type, first, chunks))
+        resp.status = falcon.HTTP_200
+
+    @classmethod
+    async def stream_async(cls, media_type, first, chunks):
+        """
+        Yield gis_polygons encoded into the media type chunk by chunk.
+        :param media_type:
+        :param first: the first chunk of rows
+        :param chunks: async iterator of the rest of the chunks
+        :return:
+        """
+        def encode_json(rows):
+            return b','.join(dumps(cls.as_dict(row[0] if isinstance(row[0], GISPolygon) else row)) for row in rows)
+
+        if media_type == formats.JSON:
+            yield b'['
+            yield await run_blocking(encode_json, first)
+            async for rows in chunks:
+                yield b',' + await run_blocking(encode_json, rows)
+            yield b']'
+        else:
+            writer = formats.writer(media_type)
+            yield writer.begin()
+            yield await run_blocking(writer.write, first)
+            async for rows in chunks:
+                yield await run_blocking(writer.write, rows)
+            yield writer.end()
+
+
+class AsyncGISPolygonTransform(GISPolygonTransform):
+    """
+    GISPolygonTransform with async responder, projecting by pyproj in the executor.
+    """
+
+    schema = UserSchema(strict=True)
+
+    async def on_get(self, req, resp):
+        args = parser.parse(self.schema, req, locations=('query',))
+
+        srid = self.get_srid(args)
+        engine = args['engine'] or settings.TRANSFORM_ENGINE
+        tolerance = self.get_tolerance(req)
+        media_type = self.get_media_type(req)
+        session = req.context.session
+
+        criteria, batch = self.get_criteria(args)
+        if criteria is None:
+            return self.response_404(resp)
+
+        versions = await session.run_sync(self.get_versions, criteria)
+        if not batch and not versions:
+            return self.response_404(resp)
+
+        resp.set_header('Vary', 'Accept')
+        if self.not_modified(req, resp, self.make_etag(srid, engine, tolerance, media_type, *versions)):
+            return
+
+        gis_polygons = await session.run_sync(self.query_gis_polygons_transform, criteria, srid, engine, tolerance)
+        gis_polygons = await run_blocking(self.project_gis_polygons, gis_polygons, srid)
+        await run_blocking(self.response_transformed, resp, gis_polygons, batch, media_type, srid)
+
+
+class AsyncGISPolygonBulk(GISPolygonBulk):
+    """
+    GISPolygonBulk with async responders: the request body is read in whole by the event loop,
+    records are inserted, updated or deleted in the executor on the sync engine by DBSession of the pool thread.
+    """
+
+    def __init__(self):
+        super(AsyncGISPolygonBulk, self).__init__()
+        self.on_delete = ThreadedResource.threaded(super(AsyncGISPolygonBulk, self).on_delete)
+        self.patch_threaded = ThreadedResource.threaded(self.patch)
+
+    async def on_patch(self, req, resp):
+        await self.patch_threaded(req, resp, data=await req.get_media())
+
+    async def on_post(self, req, resp):
+        content_type = (req.content_type or '').split(';')[0].strip()
+        if content_type in self.SEQUENCE_CONTENT_TYPES:
+            records = self.read_sequence(io.BytesIO(await req.stream.read()))
+        else:
+            records = await req.get_media()
+            if not isinstance(records, list):
+                raise falcon.HTTPBadRequest('Invalid JSON', 'A JSON array of gis_polygons is expected.')
+
+        def insert_records():
+            try:
+                return self.insert_records(DBSession(), records)
+            finally:
+                DBSession.remove()
+
+        self.response_inserted(resp, *(await run_blocking(insert_records)))
+
+
+class BlockingStream(object):
+    """
+    Async iterator over blocking iterable (e.g. a body streamed by a sync responder), advanced in the executor.
+    The iterable is closed by falcon closing the stream, on client disconnect as well, even if it has never
+    been iterated (when the finally clause of an async generator would never run).
+    """
+
+    END = object()
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await run_blocking(next, self.iterator, self.END)
+        if item is self.END:
+            raise StopAsyncIteration
+        return item
+
+    async def close(self):
+        close = getattr(self.iterator, 'close', None)
+        if close is not None:
+            await run_blocking(close)
+
+
+class ThreadedResource(object):
+    """
+    Resource running responders of a sync resource in the executor, each with DBSession of its own thread
+    closed by SessionManager, streamed bodies are iterated in the executor as well.
+    Only the responders not reading the request body are supported.
+    """
+
+    METHODS = ('get', 'head', 'options', 'delete')
+
+    def __init__(self, resource):
+        # profiling opt-out of the wrapped resource
+        self.profiled = getattr(resource, 'profiled', True)
+        for method in self.METHODS:
+            responder = getattr(resource, 'on_' + method, None)
+            if responder is not None:
+                setattr(self, 'on_' + method, self.threaded(responder))
+
+    @staticmethod
+    def threaded(responder):
+        def respond(req, resp, **params):
+            succeeded = False
+            try:
+                responder(req, resp, **params)
+                succeeded = True
+            finally:
+                SessionManager().process_response(req, resp, None, succeeded)
+
+        async def on_request(req, resp, **params):
+            await run_blocking(partial(respond, req, resp, **params))
+            if resp.stream is not None and not hasattr(resp.stream, '__aiter__'):
+                resp.stream = BlockingStream(resp.stream)
+
+        return on_request
+
+
+middleware = ([AsyncMetrics()] if settings.METRICS_ENABLED else []) + \
+    ([profiling.AsyncProfiler()] if settings.PROFILE_ENABLED else []) + [AsyncSessionManager()]
+
+app = application = falcon.asgi.App(middleware=middleware)
+# keep commas in WKT query params, comma separated lists are split explicitly
+app.req_options.auto_parse_qs_csv = False
+# serve /gis_polygon/list/ as well as /gis_polygon/list like the WSGI application
+app.req_options.strip_url_path_trailing_slash = True
+# JSON only, falcon>=3 parses URL-encoded forms into req.media as well
+app.req_options.media_handlers.pop(falcon.MEDIA_URLENCODED, None)
+
+gis_polygon_list = AsyncGISPolygonList()
+gis_polygon_crud = AsyncGISPolygonCRUD()
+gis_polygon_transform = AsyncGISPolygonTransform()
+
+app.add_route('/gis_polygon', gis_polygon_crud)
+app.add_route('/gis_polygon/{gis_polygon_id}', gis_polygon_crud)
+
+app.add_route('/gis_polygon/transform', gis_polygon_transform)
+app.add_route('/gis_polygon/bulk', AsyncGISPolygonBulk())
+app.add_route('/gis_polygon/status', ThreadedResource(GISPolygonStatus()))
+app.add_route('/gis_polygon/search', ThreadedResource(GISPolygonSearch()))
+app.add_route('/gis_polygon/stats', ThreadedResource(GISPolygonStats()))
+app.add_route('/gis_polygon/changes', ThreadedResource(GISPolygonChanges()))
+app.add_route('/gis_polygon/tiles/{z}/{x}/{y}.mvt', ThreadedResource(GISPolygonTiles()))
+app.add_route('/metrics', ThreadedResource(GISPolygonMetrics()))
+app.add_route('/gis_polygon/profiles', ThreadedResource(GISPolygonProfiles()))
+app.add_route('/gis_polygon/profiles/{capture_id}', ThreadedResource(GISPolygonProfiles()))
+
+app.add_route('/gis_polygon/list', gis_polygon_list)
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmarks for GISPolygon API hot paths against the database at settings.DB_PATH.
+
+Usage:
+    python -m gis_polygon.benchmarks [--rows 1000] [--vertices 1000] [--holes 0] [--requests 100]
+                                     [--only bench_endpoints] [--output results.json] [--compare baseline.json]
+
+Synthetic polygons are deterministic for the given arguments. They are committed for the API to see them
+and deleted at exit along with the ones created by the benchmarks, so the benchmarks leave the database
+as it was. Results can be written as JSON (with the git revision) and compared against the results
+of another commit.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from unittest import mock
+
+from falcon import testing
+
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Polygon
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+import settings
+from . import geometry_pool
+from .app import api
+from .controllers import GISPolygonTransform
+from .encoders import datetime_wkb_handler, dumps, encode_gis_polygon
+from .models import GISPolygon, GEOM_FORMATS
+
+
+def make_ring(rnd, lon, lat, radius, vertices):
+    step = 2 * math.pi / vertices
+    # a single jittered radius per vertex keeps the ring star shaped, hence simple
+    radii = [radius * rnd.uniform(0.7, 1) for _ in range(vertices)]
+    return [(lon + r * math.cos(i * step), lat + r * math.sin(i * step)) for i, r in enumerate(radii)]
+
+
+def make_polygon(vertices, seed=0, holes=0):
+    """
+    Deterministic valid star shaped polygon with the given number of exterior vertices somewhere around the globe,
+    optionally with star shaped holes (of a quarter of the vertices shared among them) around its center.
+    :param vertices:
+    :param seed:
+    :param holes:
+    :return:
+    """
+    rnd = random.Random(seed)
+    lon, lat = rnd.uniform(-170, 170), rnd.uniform(-80, 80)
+    radius = rnd.uniform(0.01, 0.5)
+
+    # hole centers on a circle of 0.35 radius, holes not overlapping each other nor reaching the exterior
+    distance = 0.35 * radius
+    hole_radius = 0.2 * radius if holes < 2 else min(0.2 * radius, 0.9 * distance * math.sin(math.pi / holes))
+    interiors = [make_ring(rnd, lon + distance * math.cos(2 * math.pi * i / holes),
+                           lat + distance * math.sin(2 * math.pi * i / holes),
+                           hole_radius, max(4, vertices // (4 * holes)))
+                 for i in range(holes)]
+
+    return Polygon(make_ring(rnd, lon, lat, radius, vertices), interiors)
+
+
+def populate(session, rows, vertices, holes=0):
+    """
+    Insert synthetic gis_polygons into the session (not committed), flushed in batches to fit large row counts.
+    :param session:
+    :param rows:
+    :param vertices:
+    :param holes:
+    :return:
+    """
+    for batch in range(0, rows, POPULATE_BATCH):
+        session.add_all(GISPolygon(name='benchmark_%s' % i, class_id=i % 10,
+                                   geom=from_shape(make_polygon(vertices, seed=i, holes=holes), srid=4326))
+                        for i in range(batch, min(rows, batch + POPULATE_BATCH)))
+        session.flush()
+        session.expunge_all()
+
+
+def cpu_per_row(func, rows):
+    """
+    Process CPU time spent by func in microseconds per row.
+    :param func:
+    :param rows:
+    :return:
+    """
+    start = time.process_time()
+    func()
+    return (time.process_time() - start) * 1e6 / rows
+
+
+def percentiles(timings):
+    """
+    p50/p95/p99 (nearest rank) of the timings.
+    :param timings:
+    :return:
+    """
+    timings = sorted(timings)
+    return {'p%s' % p: timings[max(0, int(math.ceil(p / 100 * len(timings))) - 1)] for p in (50, 95, 99)}
+
+
+def measure(name, requests):
+    """
+    Latency percentiles (ms) and throughput (requests/sec) of the requests run one after another,
+    every one of them is expected to succeed.
+    :param name: prefix of the result names
+    :param requests: callables simulating a request each
+    :return:
+    """
+    timings = []
+    for request in requests:
+        start = time.perf_counter()
+        result = request()
+        timings.append((time.perf_counter() - start) * 1e3)
+        assert result.status_code < 400, '%s failed: %s %s' % (name, result.status, result.text)
+
+    results = {'%s_%s_ms' % (name, p): value for p, value in percentiles(timings).items()}
+    results['%s_rps' % name] = len(timings) * 1e3 / sum(timings)
+    return results
+
+
+def bench_endpoints(session, args):
+    """
+    Latency percentiles and throughput of POST, GET, PUT, transform, list page and DELETE requests
+    on --requests gis_polygons of --vertices vertices and --holes holes created through the API
+    (and deleted afterwards) with the --rows gis_polygons in the table.
+    :param session:
+    :param args:
+    :return:
+    """
+    client = testing.TestClient(api)
+    engine = session.get_bind()
+
+    def geom(seed):
+        return ''.join(['SRID=4326;', make_polygon(args.vertices, seed=seed, holes=args.holes).wkt])
+
+    def post(i):
+        return lambda: client.simulate_post('/gis_polygon', body=json.dumps(
+            {'name': 'benchmark_api_%s' % i, 'class_id': i % 10, 'props': {'seed': i}, 'geom': geom(i)}))
+
+    def put(gis_polygon_id, i):
+        body = json.dumps({'name': 'benchmark_api_%s' % i, 'geom': geom(args.requests + i)})
+        return lambda: client.simulate_put('/gis_polygon/%s' % gis_polygon_id, body=body)
+
+    results = {}
+    try:
+        results.update(measure('post', [post(i) for i in range(args.requests)]))
+        ids = [row[0] for row in engine.execute(select([GISPolygon.id]).where(
+            GISPolygon.name.like('benchmark_api_%')).order_by(GISPolygon.id))]
+
+        results.update(measure('get', [partial(client.simulate_get, '/gis_polygon/%s' % gis_polygon_id)
+                                       for gis_polygon_id in ids]))
+        results.update(measure('put', [put(gis_polygon_id, i) for i, gis_polygon_id in enumerate(ids)]))
+        results.update(measure('transform', [
+            partial(client.simulate_get, '/gis_polygon/transform', query_string='id=%s&outProj=32644' % gis_polygon_id)
+            for gis_polygon_id in ids]))
+        results.update(measure('list', [
+            partial(client.simulate_get, '/gis_polygon/list', query_string='limit=%s&after=%s' % (LIST_PAGE, after))
+            for after in ids]))
+        results.update(measure('delete', [partial(client.simulate_delete, '/gis_polygon/%s' % gis_polygon_id)
+                                          for gis_polygon_id in ids]))
+    finally:
+        engine.execute(GISPolygon.__table__.delete().where(GISPolygon.name.like('benchmark_api_%')))
+
+    return results
+
+
+def bench_geom_encoding(session, args):
+    """
+    Compare per-row CPU cost (us/row) of encoding geom by Shapely (the default) against encoding by PostGIS.
+    :param session:
+    :param args:
+    :return:
+    """
+    rows = args.rows
+
+    def shapely_wkt():
+        for gis_polygon in session.query(GISPolygon).limit(rows):
+            json.dumps(gis_polygon.as_json_dict(), default=datetime_wkb_handler)
+
+    def postgis(geom_format):
+        def encode():
+            for gis_polygon in session.query(*GISPolygon.encoded_columns(geom_format)).limit(rows):
+                json.dumps(gis_polygon._asdict(), default=datetime_wkb_handler)
+        return encode
+
+    results = {'shapely_wkt_us_per_row': cpu_per_row(shapely_wkt, rows)}
+    for geom_format in sorted(GEOM_FORMATS):
+        results['postgis_%s_us_per_row' % geom_format] = cpu_per_row(postgis(geom_format), rows)
+    return results
+
+
+def bench_response_encoding(session, args):
+    """
+    Compare per-row CPU cost (us/row) of serializing GET responses by stdlib json with the default hook
+    against the precompiled encoder, rows are fetched beforehand to leave the database out.
+    :param session:
+    :param args:
+    :return:
+    """
+    gis_polygons = session.query(GISPolygon).limit(args.rows).all()
+    rows = len(gis_polygons) or 1
+
+    def default_hook():
+        for gis_polygon in gis_polygons:
+            json.dumps(gis_polygon.as_dict(), ensure_ascii=False, default=datetime_wkb_handler).encode('utf-8')
+
+    def precompiled():
+        for gis_polygon in gis_polygons:
+            dumps(encode_gis_polygon(gis_polygon))
+
+    return {'default_hook_us_per_row': cpu_per_row(default_hook, rows),
+            'precompiled_us_per_row': cpu_per_row(precompiled, rows)}
+
+
+def bench_transform_engines(session, args):
+    """
+    Compare wall time (ms/polygon) of projecting polygons of growing vertex count by pyproj in the worker
+    against ST_Transform in PostGIS to find the crossover, i.e. the least vertex count PostGIS is faster at.
+    :param session:
+    :param args:
+    :return:
+    """
+    results = {}
+    crossover = None
+
+    for vertices in TRANSFORM_VERTICES:
+        polygons = [GISPolygon(name='benchmark_transform_%s' % i,
+                               geom=from_shape(make_polygon(vertices, seed=i), srid=4326))
+                    for i in range(TRANSFORM_POLYGONS)]
+        session.add_all(polygons)
+        session.flush()
+
+        criteria = [GISPolygon.id.in_([polygon.id for polygon in polygons])]
+        timings = {}
+        for engine in ('python', 'postgis'):
+            start = time.perf_counter()
+            GISPolygonTransform.transform_gis_polygons(session, criteria, 32644, engine)
+            timings[engine] = (time.perf_counter() - start) * 1e3 / TRANSFORM_POLYGONS
+            results['%s_%s_vertices_ms_per_polygon' % (engine, vertices)] = timings[engine]
+
+        if crossover is None and timings['postgis'] < timings['python']:
+            crossover = vertices
+
+    results['crossover_vertices'] = crossover
+    return results
+
+
+def bench_bulk_ingest(session, args):
+    """
+    Sustained rows/sec of ingesting NDJSON through /gis_polygon/bulk, the ingested rows are deleted afterwards.
+    :param session:
+    :param args:
+    :return:
+    """
+    body = '\n'.join(json.dumps({'name': 'benchmark_bulk_%s' % i, 'class_id': i % 10,
+                                 'geom': ''.join(['SRID=4326;',
+                                                  make_polygon(args.vertices, seed=i, holes=args.holes).wkt])})
+                     for i in range(args.rows))
+
+    client = testing.TestClient(api)
+    try:
+        start = time.perf_counter()
+        result = client.simulate_post('/gis_polygon/bulk', body=body,
+                                      headers={'Content-Type': 'application/x-ndjson'})
+        elapsed = time.perf_counter() - start
+    finally:
+        engine = session.get_bind()
+        engine.execute(GISPolygon.__table__.delete().where(GISPolygon.name.like('benchmark_bulk_%')))
+
+    return {'inserted': result.json['inserted'], 'rows_per_sec': result.json['inserted'] / elapsed}
+
+
+def bench_geometry_pool(session, args):
+    """
+    Compare wall time (ms/job) of concurrent reprojection jobs on large polygons run inline in the request threads
+    against the ones offloaded to the process pool of settings.GEOM_POOL_SIZE (2 if unset) processes.
+    :param session:
+    :param args:
+    :return:
+    """
+    geometries = [make_polygon(POOL_VERTICES, seed=i).wkb for i in range(POOL_JOBS)]
+    threads = ThreadPoolExecutor(max_workers=POOL_JOBS)
+
+    def concurrent_jobs():
+        start = time.perf_counter()
+        list(threads.map(lambda geometry: geometry_pool.run(geometry_pool.transform, [geometry],
+                                                             'epsg:4326', 'epsg:3857'), geometries))
+        return (time.perf_counter() - start) * 1e3 / POOL_JOBS
+
+    results = {}
+    with mock.patch.object(settings, 'GEOM_POOL_SIZE', 0):
+        results['inline_ms_per_job'] = concurrent_jobs()
+    with mock.patch.object(settings, 'GEOM_POOL_SIZE', settings.GEOM_POOL_SIZE or 2), \
+            mock.patch.object(settings, 'GEOM_POOL_MIN_VERTICES', 0):
+        geometry_pool.run(geometry_pool.area, geometries[:1])  # start the pool processes
+        results['pooled_ms_per_job'] = concurrent_jobs()
+
+    threads.shutdown()
+    return results
+
+
+# Worker startup measured in a fresh interpreter: `cold` builds the application as a worker with no preloading,
+# `preload` builds and warms it up as gunicorn master with gunicorn.conf.py and forks the worker.
+# Prints boot time (till the worker is ready to serve) and latency of the first request to argv[2] path.
+STARTUP_SCRIPT = '''
+import json, os, sys, time
+start = time.perf_counter()
+from falcon import testing
+from gis_polygon import app, db_session
+application = app.create_app()
+preload = sys.argv[1] == 'preload'
+if preload:
+    app.warm_up()
+    db_session.engine.dispose()
+    read, write = os.pipe()
+    if os.fork():
+        os.close(write)
+        print(os.read(read, 4096).decode())
+        os.wait()
+        sys.exit()
+    start = time.perf_counter()
+    db_session.reset_after_fork()
+boot = time.perf_counter() - start
+start = time.perf_counter()
+path, _, query_string = sys.argv[2].partition('?')
+status = testing.TestClient(application).simulate_get(path, query_string=query_string).status_code
+output = json.dumps({'boot_ms': boot * 1e3, 'first_request_ms': (time.perf_counter() - start) * 1e3, 'status': status})
+if preload:
+    os.write(write, output.encode())
+    os._exit(0)
+print(output)
+'''
+
+
+def startup(mode, path):
+    """
+    Worker startup timings of the mode (cold or preload) in a fresh interpreter.
+    :param mode:
+    :param path: path with query string of the first request
+    :return:
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', STARTUP_SCRIPT, mode, path], cwd=root)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def bench_startup(session, args):
+    """
+    Compare worker boot time and first transform request latency (ms) of a worker building the application
+    on its own against a worker forked from the master preloading and warming it up (gunicorn.conf.py).
+    :param session:
+    :param args:
+    :return:
+    """
+    gis_polygon_id = session.query(GISPolygon.id).order_by(GISPolygon.id).limit(1).scalar()
+    path = '/gis_polygon/transform?id=%s&outProj=32644' % gis_polygon_id
+
+    results = {}
+    for mode in ('cold', 'preload'):
+        timings = startup(mode, path)
+        results['%s_boot_ms' % mode] = timings['boot_ms']
+        results['%s_first_request_ms' % mode] = timings['first_request_ms']
+    return results
+
+
+# Number of synthetic gis_polygons flushed at once
+POPULATE_BATCH = 10000
+
+# Page size of the list requests measured by bench_endpoints
+LIST_PAGE = 100
+
+# Vertex counts and number of polygons per count to find the transform engines crossover at
+TRANSFORM_VERTICES = (10, 100, 1000, 10000, 100000)
+TRANSFORM_POLYGONS = 10
+
+# Vertex count of the polygons and number of concurrent jobs to compare inline and pooled geometry operations with
+POOL_VERTICES = 200000
+POOL_JOBS = 8
+
+BENCHMARKS = [bench_endpoints, bench_geom_encoding, bench_response_encoding, bench_transform_engines,
+              bench_bulk_ingest, bench_geometry_pool, bench_startup]
+
+
+def git_revision():
+    """
+    Git commit the benchmarks are run at, None outside of a git checkout.
+    :return:
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Print relative change of every numeric result against the baseline results of another run.
+    :param results: {benchmark: {name: value}}
+    :param baseline: results of the baseline run in the same form
+    :return:
+    """
+    for benchmark, values in sorted(results.items()):
+        for name, value in sorted(values.items()):
+            base = baseline.get(benchmark, {}).get(name)
+            if isinstance(value, (int, float)) and isinstance(base, (int, float)) and base:
+                print('{0}.{1}: {2} -> {3} ({4:+.1f}%)'.format(benchmark, name, round(base, 3), round(value, 3),
+                                                              (value - base) * 100 / base))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000, help='gis_polygons in the table')
+    parser.add_argument('--vertices', type=int, default=1000, help='vertices per polygon exterior')
+    parser.add_argument('--holes', type=int, default=0, help='holes per polygon')
+    parser.add_argument('--requests', type=int, default=100, help='requests per endpoint of bench_endpoints')
+    parser.add_argument('--only', nargs='+', choices=[benchmark.__name__ for benchmark in BENCHMARKS],
+                        help='benchmarks to run, all by default')
+    parser.add_argument('--output', help='JSON file to write the results into')
+    parser.add_argument('--compare', help='JSON results of another run to compare with')
+    args = parser.parse_args()
+
+    engine = create_engine(settings.DB_PATH)
+    session = sessionmaker(bind=engine)()
+
+    results = {}
+    try:
+        populate(session, args.rows, args.vertices, args.holes)
+        # let the API (on connections of its own) see the synthetic rows, deleted at exit
+        session.commit()
+        for benchmark in BENCHMARKS:
+            if args.only and benchmark.__name__ not in args.only:
+                continue
+            results[benchmark.__name__] = benchmark(session, args)
+            for name, value in results[benchmark.__name__].items():
+                print('{0}.{1}: {2}'.format(benchmark.__name__, name,
+                                            round(value, 3) if isinstance(value, float) else value))
+    finally:
+        session.rollback()
+        engine.execute(GISPolygon.__table__.delete().where(GISPolygon.name.like('benchmark_%')))
+        session.close()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'revision': git_revision(), 'timestamp': datetime.utcnow().isoformat(),
+                       'args': vars(args), 'results': results}, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline)['results'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Bounded in-process caches kept per worker.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """
+    Thread safe least recently used cache bounded by number of entries and their time to live.
+    Entries may carry a version, a lookup with another version is a miss and drops the entry.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        """
+        :param maxsize: max number of entries
+        :param ttl: seconds an entry lives for, None for no expiration
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, version=None):
+        """
+        Cached value for the key or None.
+        :param key:
+        :param version: expected version of the value, None to accept any
+        :return:
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, entry_version, expires = entry
+            if (expires is not None and expires < time.monotonic()) or \
+                    (version is not None and version != entry_version):
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, version=None):
+        with self._lock:
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self._entries[key] = (value, version, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Cache occupancy and counters as Dict.
+        :return:
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Change feed of gis_polygons: every write records the id of its transaction (txid_current()) for the written
+gis_polygons into gis_polygon_change table, deleted gis_polygons are kept there as tombstones.
+
+The feed lists the log in (xid, gis_polygon_id) order, keyset paginated. Transaction ids are assigned
+in start order while the writes become visible in commit order, so the feed is bounded by the oldest
+transaction still running (xmin of the snapshot): no transaction may commit below the bound later on,
+the feed never skips a change (a long running transaction delays the feed rather).
+
+Record the gis_polygons written before the log existed or bypassing the API,
+prune tombstones older than the given number of days (clients with older cursors are to resync):
+    python -m gis_polygon.changes [--prune DAYS]
+"""
+
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, create_engine, exists, false, func, literal, select, tuple_, TIMESTAMP
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+
+import settings
+from .models import GISPolygon, GISPolygonChange
+
+
+def upsert(insert):
+    """
+    Make the INSERT into gis_polygon_change overwrite the former record of the gis_polygon.
+    :param insert:
+    :return:
+    """
+    return insert.on_conflict_do_update(index_elements=['gis_polygon_id'], set_={
+        'xid': insert.excluded.xid,
+        'deleted': insert.excluded.deleted,
+        '_updated': insert.excluded._updated,
+    })
+
+
+def record_changes(session, *criteria):
+    """
+    Record gis_polygons matching criteria as created or updated by the current transaction.
+    :param session:
+    :param criteria: SQLAlchemy filter clauses
+    :return:
+    """
+    changed = select([GISPolygon.id, func.txid_current(), false(), literal(datetime.utcnow(), TIMESTAMP)]) \
+        .where(and_(*criteria))
+    insert = postgresql.insert(GISPolygonChange.__table__) \
+        .from_select(['gis_polygon_id', 'xid', 'deleted', '_updated'], changed)
+    session.execute(upsert(insert))
+
+
+def record_deletes(session, gis_polygon_ids):
+    """
+    Record tombstones of gis_polygons deleted by the current transaction.
+    :param session:
+    :param gis_polygon_ids:
+    :return:
+    """
+    if not gis_polygon_ids:
+        return
+
+    now = datetime.utcnow()
+    insert = postgresql.insert(GISPolygonChange.__table__).values([
+        {'gis_polygon_id': gis_polygon_id, 'xid': func.txid_current(), 'deleted': True, '_updated': now}
+        for gis_polygon_id in gis_polygon_ids])
+    session.execute(upsert(insert))
+
+
+def feed_bound(session):
+    """
+    Transaction id the feed is read up to (exclusive): xmin of the current snapshot.
+    :param session:
+    :return:
+    """
+    return session.execute(select([func.txid_snapshot_xmin(func.txid_current_snapshot())])).scalar()
+
+
+def query_changes(session, after, bound):
+    """
+    Query changes following the cursor up to the bound as (gis_polygon_id, xid, deleted, GISPolygon) rows,
+    GISPolygon is None for tombstones.
+    :param session:
+    :param after: (xid, gis_polygon_id) of the last change read, None to read from the beginning
+    :param bound: as returned by feed_bound
+    :return:
+    """
+    query = session.query(GISPolygonChange.gis_polygon_id, GISPolygonChange.xid, GISPolygonChange.deleted, GISPolygon) \
+        .outerjoin(GISPolygon, GISPolygon.id == GISPolygonChange.gis_polygon_id) \
+        .filter(GISPolygonChange.xid < bound) \
+        .order_by(GISPolygonChange.xid, GISPolygonChange.gis_polygon_id)
+    if after is not None:
+        query = query.filter(tuple_(GISPolygonChange.xid, GISPolygonChange.gis_polygon_id) > tuple_(*after))
+    return query
+
+
+def prune_tombstones(session, before):
+    """
+    Delete tombstones recorded before the given time.
+    :param session:
+    :param before:
+    :return: number of deleted tombstones
+    """
+    table = GISPolygonChange.__table__
+    return session.execute(table.delete().where(and_(table.c.deleted, table.c._updated < before))).rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prune', type=float, metavar='DAYS', help='prune tombstones older than DAYS')
+    args = parser.parse_args()
+
+    session = sessionmaker(bind=create_engine(settings.DB_PATH))()
+    if args.prune is not None:
+        print('Pruned %s tombstones' % prune_tombstones(session, datetime.utcnow() - timedelta(days=args.prune)))
+    else:
+        # gis_polygons already in the log are left as they are
+        record_changes(session, ~exists().where(GISPolygonChange.gis_polygon_id == GISPolygon.id))
+    session.commit()
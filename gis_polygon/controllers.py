@@ -9,58 +9,57 @@ GISPolygon CRUD Controller allowing:
     - Delete on DELETE
 """
 
+import base64
+import hashlib
+import json
 from datetime import datetime
-
-try:
-    import ujson as json
-except:
-    import simplejson as json
-finally:
-    import json
+from itertools import chain, groupby, islice
 
 import falcon
 from marshmallow import Schema, fields, ValidationError
+from marshmallow.validate import OneOf
+from sqlalchemy import and_, case, func, null, select, LargeBinary
+from webargs.falconparser import use_args
+from webargs.fields import DelimitedList
 
-from geoalchemy2.shape import to_shape
-from geoalchemy2.elements import WKBElement
+from shapely import wkt
 
 from autologging import logged
 import logging
 
-from .db_session import DBSession
-from .models import GISPolygon
-from .serializers import GISPolygonSerializer
-from .middleware import cs_transform
+import settings
+from .cache import LRUCache
+from .changes import feed_bound, query_changes, record_changes, record_deletes
+from .db_session import DBSession, SessionStream, engine
+from .encoders import dumps, loads, encode_gis_polygon, encode_created_gis_polygon
+from . import formats, geometry_pool, metrics, profiling
+from .filters import bbox_filter, intersects_filter, dwithin_filter, class_filter, name_prefix_filter, range_filter, \
+    props_filter, keyset_filter, sort_order, SORT_COLUMNS
+from .lod import lod_geom, refresh_lod, zoom_tolerance
+from .models import GISPolygon, GEOM_FORMATS
+from .serializers import GISPolygonSerializer, GISPolygonBulkSerializer, as_wkb_element, check_geometries
+from .stats import add_class_stats, class_stats, remove_class_stats, stats_columns
+from .tiles import is_valid_tile, render_tile, geom_bounds, geom_bounds_columns, invalidate_tiles
 
 
-def datetime_wkb_handler(x):
-    """
-    Handles json dumps of datetime/WKBElement objects in str format.
-    :param x:
-    :return:
-    """
-    # TODO: One could try using isoformat in Models or write a decorator
-    if isinstance(x, datetime):
-        return x.isoformat()
-    if isinstance(x, WKBElement):
-        return to_shape(x).to_wkt()
-    return x
+TRANSFORM_ENGINES = ('python', 'postgis', 'auto')
+
+# (column name, descending) of lists by default
+DEFAULT_SORT = ('id', False)
 
 
 class UserSchema(Schema):
     outProj = fields.Str(missing='32644')
     id = fields.Integer(missing=None)
+    ids = DelimitedList(fields.Integer(), missing=None)
+    class_id = fields.Integer(missing=None)
+    engine = fields.Str(missing=None, validate=OneOf(TRANSFORM_ENGINES))
 
 
-# TODO: ADD Logger
-logging.basicConfig(level=logging.INFO, filename="/tmp/gis_polygon.log",
-                    format="%(levelname)s:%(name)s:%(funcName)s: %(message)s")
-
+# configured by the application, see app.configure_logging
 logger = logging.getLogger('gis_polygon')
 
 
-# TODO: Optimize for speed
-
 class BaseGISPolygonController(object):
     """
     General implementations for GISPolygon CRUD Controller Classes.
@@ -79,10 +78,392 @@ class BaseGISPolygonController(object):
         resp.status = falcon.HTTP_400
 
     @staticmethod
-    def get_gis_polygon(session, gis_polygon_id):
+    def get_geom_format(req):
+        """
+        Format requested by `geom_format` param for PostGIS to encode geom in,
+        None stands for the default encoding into WKT by Shapely.
+        :param req:
+        :return:
+        """
+        geom_format = req.get_param('geom_format')
+        if geom_format is not None and geom_format not in GEOM_FORMATS:
+            raise falcon.HTTPInvalidParam('Expected one of: %s.' % ', '.join(sorted(GEOM_FORMATS)), 'geom_format')
+        return geom_format
+
+    @staticmethod
+    def get_media_type(req):
+        """
+        Media type to encode the response into negotiated by Accept header, JSON by default.
+        :param req:
+        :return:
+        """
+        media_types = formats.media_types()
+        media_type = req.client_prefers(media_types)
+        if not media_type:
+            raise falcon.HTTPNotAcceptable('Supported media types: %s.' % ', '.join(media_types))
+        return media_type
+
+    @staticmethod
+    def get_tolerance(req):
+        """
+        Tolerance (in degrees) to simplify geom with requested by `simplify` or by map `zoom` param,
+        None stands for the full resolution geometry.
+        :param req:
+        :return:
+        """
+        simplify = req.get_param('simplify')
+        if simplify is not None:
+            try:
+                tolerance = float(simplify)
+            except ValueError:
+                tolerance = 0
+            if not tolerance > 0:
+                raise falcon.HTTPInvalidParam('Expected a positive number.', 'simplify')
+            return tolerance
+
+        zoom = req.get_param_as_int('zoom')
+        if zoom is not None:
+            if not 0 <= zoom <= settings.TILE_MAX_ZOOM:
+                raise falcon.HTTPInvalidParam('Expected a value between 0 and %s.' % settings.TILE_MAX_ZOOM, 'zoom')
+            return zoom_tolerance(zoom)
+
+    @staticmethod
+    def as_dict(gis_polygon):
+        """
+        Represent GISPolygon object or a row of its encoded columns as JSON ready Dict.
+        :param gis_polygon:
+        :return:
+        """
+        if isinstance(gis_polygon, GISPolygon):
+            return encode_gis_polygon(gis_polygon)
+        return gis_polygon._asdict()
+
+    @staticmethod
+    def get_gis_polygon(session, gis_polygon_id, geom_format=None, tolerance=None):
         if gis_polygon_id:
+            if geom_format or tolerance:
+                geom = lod_geom(tolerance) if tolerance else None
+                return session.query(*GISPolygon.encoded_columns(geom_format or 'wkt', geom)) \
+                    .filter(GISPolygon.id == gis_polygon_id).first()
             return session.query(GISPolygon).get(gis_polygon_id)
 
+    @staticmethod
+    def written_values(gis_polygon, data):
+        """
+        Column values of deserialized gis_polygon given in the request data, falsy ones included,
+        the ones set by the server (dump only) left out.
+        :param gis_polygon: GISPolygon loaded by the serializer from the data
+        :param data: request data
+        :return:
+        """
+        names = [name for name, field in BaseGISPolygonController.serializer.fields.items() if not field.dump_only]
+        return {name: value for name, value in gis_polygon.as_dict().items() if name in data and name in names}
+
+    @staticmethod
+    def update_gis_polygons(session, values, criteria):
+        """
+        Update gis_polygons matching criteria with a single UPDATE ... RETURNING statement never fetching
+        the geometries, levels of detail are refreshed if geom is updated, class summaries if geom or class_id is,
+        the change is recorded for the change feed.
+        :param session:
+        :param values: column values by name
+        :param criteria: SQLAlchemy filter clauses
+        :return: ids of the updated gis_polygons and lon/lat bounds of their geometries before and after the update
+        """
+        table = GISPolygon.__table__
+        # the rows as they are before the update, joined by UPDATE ... FROM to return the former values
+        old = select([table.c.id, table.c.class_id, table.c.geom]).where(and_(*criteria)).alias('old')
+
+        summarized = 'geom' in values or 'class_id' in values
+        old_bounds = geom_bounds_columns(old.c.geom)
+        # (class_id, *stats_columns) of the former rows, bounds included, or just their bounds
+        old_values = [old.c.class_id] + stats_columns(old.c.geom) if summarized else old_bounds
+        returning = [table.c.id] + old_values
+        # offsets of the former and, if geom is updated, the new bounds in the returned rows
+        starts = [len(returning) - len(old_bounds)]
+        if 'geom' in values:
+            starts.append(len(returning))
+            returning += geom_bounds_columns(table.c.geom)
+
+        rows = session.execute(table.update().values(values).where(table.c.id == old.c.id)
+                               .returning(*returning)).fetchall()
+        ids = [row[0] for row in rows]
+        if ids and 'geom' in values:
+            refresh_lod(session, GISPolygon.id.in_(ids))
+        if ids and summarized:
+            remove_class_stats(session, [row[1:1 + len(old_values)] for row in rows])
+            add_class_stats(session, GISPolygon.id.in_(ids))
+        if ids:
+            record_changes(session, GISPolygon.id.in_(ids))
+
+        bounds = [tuple(row[start:start + len(old_bounds)]) for row in rows for start in starts
+                  if row[start] is not None]
+        return ids, bounds
+
+    @staticmethod
+    def delete_gis_polygons(session, criteria):
+        """
+        Delete gis_polygons matching criteria (their levels of detail cascade) with a single DELETE ... RETURNING
+        statement never fetching the geometries, the returned former values are subtracted from class summaries
+        and tombstones of the gis_polygons are recorded for the change feed.
+        :param session:
+        :param criteria: SQLAlchemy filter clauses
+        :return: ids of the deleted gis_polygons and lon/lat bounds of their geometries
+        """
+        table = GISPolygon.__table__
+        returning = [table.c.id, table.c.class_id] + stats_columns(table.c.geom)
+        # stats_columns end with the bounds
+        start = len(returning) - len(geom_bounds_columns(table.c.geom))
+
+        rows = session.execute(table.delete().where(and_(*criteria)).returning(*returning)).fetchall()
+        remove_class_stats(session, [row[1:] for row in rows])
+        ids = [row[0] for row in rows]
+        record_deletes(session, ids)
+        return ids, [tuple(row[start:]) for row in rows if row[start] is not None]
+
+    @staticmethod
+    def get_version(session, gis_polygon_id):
+        """
+        Cheap probe of gis_polygon version (_updated) without fetching the geometry, None if it does not exist.
+        :param session:
+        :param gis_polygon_id:
+        :return:
+        """
+        if gis_polygon_id:
+            return session.query(GISPolygon._updated).filter(GISPolygon.id == gis_polygon_id).scalar()
+
+    @staticmethod
+    def make_etag(*parts):
+        """
+        Strong ETag of the response derived from the parts identifying its content version.
+        :param parts:
+        :return:
+        """
+        return '"%s"' % hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def not_modified(req, resp, etag):
+        """
+        Set ETag of the response and respond 304 Not Modified if it matches If-None-Match.
+        :param req:
+        :param resp:
+        :param etag:
+        :return: True if the client has the response already
+        """
+        resp.etag = etag
+
+        if_none_match = req.get_header('If-None-Match')
+        if not if_none_match:
+            return False
+
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if '*' in tags or etag in tags or 'W/' + etag in tags:
+            resp.status = falcon.HTTP_304
+            return True
+        return False
+
+    @staticmethod
+    def get_page_version(session, after, limit, criteria=(), sort=DEFAULT_SORT):
+        """
+        Cheap probe of a list page version without fetching the geometries: (id, _updated) of its gis_polygons
+        read by the index of the sort, changes on writes to them and on inserts or deletes within the page.
+        :param session:
+        :param after: keyset cursor as returned by get_after
+        :param limit:
+        :param criteria: SQLAlchemy filter clauses
+        :param sort: (column name, descending) as returned by get_sort
+        :return:
+        """
+        query = session.query(GISPolygon.id, GISPolygon._updated).filter(*criteria).order_by(*sort_order(*sort))
+        if after is not None:
+            query = query.filter(keyset_filter(sort[0], sort[1], after))
+        return query.limit(limit).all()
+
+    @staticmethod
+    def query_gis_polygons(session, after=None, geom_format=None, tolerance=None, media_type=formats.JSON,
+                           sort=DEFAULT_SORT):
+        """
+        Query gis_polygons in the sort order (by id by default), optionally starting right after the keyset cursor.
+        :param session:
+        :param after: keyset cursor as returned by get_after
+        :param geom_format: query rows of columns with geom encoded by PostGIS instead of GISPolygon objects
+        :param tolerance: query rows of columns with geom simplified (and encoded as WKT if no geom_format)
+        :param media_type: query rows of formats.COLUMNS for the binary encoders unless JSON
+        :param sort: (column name, descending) as returned by get_sort
+        :return:
+        """
+        if media_type != formats.JSON:
+            query = session.query(*formats.binary_columns(lod_geom(tolerance) if tolerance else None))
+        elif geom_format or tolerance:
+            geom = lod_geom(tolerance) if tolerance else None
+            query = session.query(*GISPolygon.encoded_columns(geom_format or 'wkt', geom))
+        else:
+            query = session.query(GISPolygon)
+        query = query.order_by(*sort_order(*sort))
+        if after is not None:
+            query = query.filter(keyset_filter(sort[0], sort[1], after))
+        return query
+
+    @staticmethod
+    def get_sort(req):
+        """
+        Sort requested by `sort` param: one of SORT_COLUMNS, prefixed with `-` for descending order.
+        :param req:
+        :return: (column name, descending)
+        """
+        sort = req.get_param('sort')
+        if sort is None:
+            return DEFAULT_SORT
+
+        name = sort[1:] if sort.startswith('-') else sort
+        if name not in SORT_COLUMNS:
+            raise falcon.HTTPInvalidParam('Expected one of %s, optionally prefixed with -.'
+                                          % ', '.join(SORT_COLUMNS), 'sort')
+        return name, sort.startswith('-')
+
+    @staticmethod
+    def get_after(req, sort=DEFAULT_SORT):
+        """
+        Keyset cursor requested by `after` param: id of the last gis_polygon of the previous page for id sort,
+        (column value, id) of it decoded from the opaque X-Next-Cursor of the previous page otherwise.
+        :param req:
+        :param sort:
+        :return:
+        """
+        if sort[0] == 'id':
+            return req.get_param_as_int('after')
+
+        after = req.get_param('after')
+        if after is None:
+            return None
+
+        value, last_id = BaseGISPolygonController.decode_cursor(after, 2)
+        try:
+            if value is not None and sort[0] in ('_created', '_updated'):
+                value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+            return value, int(last_id)
+        except (TypeError, ValueError):
+            raise falcon.HTTPInvalidParam('Expected X-Next-Cursor of the previous page.', 'after')
+
+    @staticmethod
+    def next_cursor(gis_polygon, sort=DEFAULT_SORT):
+        """
+        Keyset cursor of the page following the gis_polygon (X-Next-Cursor header), see get_after.
+        :param gis_polygon: the last GISPolygon or row of the page
+        :param sort:
+        :return:
+        """
+        if sort[0] == 'id':
+            return str(gis_polygon.id)
+
+        value = getattr(gis_polygon, sort[0])
+        if isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+        return BaseGISPolygonController.encode_cursor(value, gis_polygon.id)
+
+    @staticmethod
+    def encode_cursor(*values):
+        """
+        Opaque keyset cursor of JSON values.
+        :param values:
+        :return:
+        """
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor, length, name='after'):
+        """
+        JSON values of the opaque keyset cursor.
+        :param cursor:
+        :param length: number of the values expected
+        :param name: param the cursor is given by
+        :return:
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except ValueError:
+            values = None
+        if not isinstance(values, list) or len(values) != length:
+            raise falcon.HTTPInvalidParam('Expected X-Next-Cursor of the previous page.', name)
+        return values
+
+    @staticmethod
+    def get_limit(req, default=None):
+        """
+        Page size requested by `limit` param.
+        :param req:
+        :param default:
+        :return:
+        """
+        limit = req.get_param_as_int('limit')
+        if limit is not None and not 1 <= limit <= settings.LIST_MAX_LIMIT:
+            raise falcon.HTTPInvalidParam('Expected a value between 1 and %s.' % settings.LIST_MAX_LIMIT, 'limit')
+        return limit or default
+
+    def get_page(self, req, resp, after, limit, geom_format=None, criteria=(), tolerance=None,
+                 media_type=formats.JSON, sort=DEFAULT_SORT):
+        """
+        Retrieve a single keyset page of gis_polygons.
+        :param req:
+        :param resp:
+        :param after:
+        :param limit:
+        :param geom_format:
+        :param criteria: SQLAlchemy filter clauses
+        :param tolerance:
+        :param media_type:
+        :param sort:
+        :return:
+        """
+        session = DBSession()
+
+        query = self.query_gis_polygons(session, after, geom_format, tolerance, media_type, sort).filter(*criteria)
+        self.response_page(resp, query.limit(limit).all(), after, limit, media_type, sort, bool(criteria))
+
+    def response_page(self, resp, gis_polygons, after, limit, media_type=formats.JSON, sort=DEFAULT_SORT,
+                      filtered=False):
+        """
+        Respond with a keyset page of gis_polygons encoded into the media type.
+        :param resp:
+        :param gis_polygons:
+        :param after:
+        :param limit:
+        :param media_type:
+        :param sort:
+        :param filtered: whether gis_polygons have been filtered
+        :return:
+        """
+        if len(gis_polygons) == limit:
+            resp.set_header('X-Next-Cursor', self.next_cursor(gis_polygons[-1], sort))
+
+        if media_type != formats.JSON:
+            return self.response_encoded(resp, media_type, [gis_polygons])
+
+        if not gis_polygons:
+            return self.response_empty(resp, after, filtered)
+
+        resp.data = dumps([self.as_dict(gis_polygon) for gis_polygon in gis_polygons])
+        resp.status = falcon.HTTP_200
+
+    @staticmethod
+    def response_empty(resp, after, filtered=False):
+        resp.body = json.dumps([])
+        resp.status = falcon.HTTP_200
+
+    @staticmethod
+    def response_encoded(resp, media_type, chunks, srid=4326):
+        """
+        Respond with gis_polygons encoded into the binary media type.
+        :param resp:
+        :param media_type:
+        :param chunks: lists of rows of formats.COLUMNS
+        :param srid:
+        :return:
+        """
+        resp.data = b''.join(formats.encode(media_type, chunks, srid))
+        resp.content_type = media_type
+        resp.status = falcon.HTTP_200
+
 
 class GISPolygonCRUD(BaseGISPolygonController):
     """
@@ -92,8 +473,20 @@ class GISPolygonCRUD(BaseGISPolygonController):
         Update gis_polygon info on PUT
         Delete gis_polygon info on DELETE
     Returns data in JSON format.
+
+    GET accepts `geom_format` to encode geom by PostGIS and `simplify` (tolerance in degrees) or `zoom`
+    to get geom simplified, precomputed levels of detail are refreshed on POST and PUT.
+
+    PUT writes the fields given (falsy values included) and DELETE deletes by a single UPDATE/DELETE ... RETURNING
+    statement, never fetching the geometry.
+
+    GET responses are cached per worker if settings.GET_CACHE_SIZE is set, entries are invalidated
+    by writes of this worker and, with settings.GET_CACHE_VERIFY, checked against _updated in the DB
+    to catch writes of the other workers.
     """
 
+    cache = LRUCache(settings.GET_CACHE_SIZE, settings.GET_CACHE_TTL) if settings.GET_CACHE_SIZE else None
+
     def on_get(self, req, resp, gis_polygon_id=None):
         """
         Retrieve detailed info about gis_polygon.
@@ -102,17 +495,70 @@ class GISPolygonCRUD(BaseGISPolygonController):
         :param gis_polygon_id:
         :return:
         """
+        geom_format = self.get_geom_format(req)
+        tolerance = self.get_tolerance(req)
+
         session = DBSession()
-        gis_polygon = self.get_gis_polygon(session, gis_polygon_id)
 
-        if gis_polygon:
-            gis_polygon = gis_polygon.as_json_dict()
-        else:
+        version = self.get_version(session, gis_polygon_id)
+        if version is None:
+            self.invalidate(gis_polygon_id)
             return self.response_404(resp)
 
-        resp.body = json.dumps(gis_polygon, ensure_ascii=False, default=datetime_wkb_handler)
+        if self.not_modified(req, resp, self.make_etag(gis_polygon_id, version, geom_format, tolerance)):
+            return
+
+        # keyed by the numeric id, '/gis_polygon/007' and '/gis_polygon/7' are the same entry
+        cache_key = (int(gis_polygon_id), geom_format, tolerance)
+        if self.cache is not None:
+            if not settings.GET_CACHE_VERIFY:
+                version = None
+
+            body = self.cache.get(cache_key, version)
+            if body is not None:
+                resp.data = body
+                resp.status = falcon.HTTP_200
+                return
+
+        gis_polygon = self.get_gis_polygon(session, gis_polygon_id, geom_format, tolerance)
+
+        if not gis_polygon:
+            return self.response_404(resp)
+
+        body = dumps(self.as_dict(gis_polygon))
+        if self.cache is not None:
+            self.cache.set(cache_key, body, version)
+
+        resp.data = body
         resp.status = falcon.HTTP_200
 
+    @classmethod
+    def invalidate(cls, gis_polygon_id, *bounds):
+        """
+        Drop cached GET responses of gis_polygon in every format and cached tiles it is rendered into.
+        :param gis_polygon_id:
+        :param bounds: lon/lat bounds of the gis_polygon geometries before and after the write
+        :return:
+        """
+        cls.invalidate_many([gis_polygon_id], *bounds)
+
+    @classmethod
+    def invalidate_many(cls, gis_polygon_ids, *bounds):
+        """
+        Drop cached GET responses of gis_polygons in every format and cached tiles they are rendered into.
+        :param gis_polygon_ids:
+        :param bounds: lon/lat bounds of the gis_polygons geometries before and after the write
+        :return:
+        """
+        if cls.cache is not None:
+            gis_polygon_ids = {int(gis_polygon_id) for gis_polygon_id in gis_polygon_ids}
+            for key in cls.cache.keys():
+                if key[0] in gis_polygon_ids:
+                    cls.cache.invalidate(key)
+
+        if GISPolygonTiles.cache is not None:
+            invalidate_tiles(GISPolygonTiles.cache, *bounds)
+
     def on_post(self, req, resp):
         """
         Create gis_polygon info.
@@ -132,12 +578,17 @@ class GISPolygonCRUD(BaseGISPolygonController):
 
         # get serialized data itself to injest into the database
         gis_polygon = serialized.data
+        bounds = geom_bounds(gis_polygon.geom)
 
         session.add(gis_polygon)
+        session.flush()
+        refresh_lod(session, GISPolygon.id == gis_polygon.id)
+        add_class_stats(session, GISPolygon.id == gis_polygon.id)
+        record_changes(session, GISPolygon.id == gis_polygon.id)
         session.commit()
+        self.invalidate(gis_polygon.id, bounds)
 
-        # resp.body = json.dumps(gis_polygon.as_dict(), default=datetime_handler)
-        resp.body = json.dumps(self.serializer.dump(gis_polygon).data, default=datetime_wkb_handler)
+        resp.data = dumps(encode_created_gis_polygon(gis_polygon))
         resp.status = falcon.HTTP_201
 
     def on_put(self, req, resp, gis_polygon_id=None):
@@ -157,17 +608,19 @@ class GISPolygonCRUD(BaseGISPolygonController):
         except ValidationError as err:
             return self.response_400(resp, err)
 
-        serialized_data = serialized.data.as_dict()
-        gis_polygon = self.get_gis_polygon(session, gis_polygon_id)
-
-        if gis_polygon:
-            for name, value in serialized_data.items():
-                if value:
-                    setattr(gis_polygon, name, value)
+        values = self.written_values(serialized.data, data)
+        if values:
+            ids, bounds = self.update_gis_polygons(session, values, [GISPolygon.id == gis_polygon_id])
+            found = bool(ids)
         else:
+            # nothing to write, just check the gis_polygon exists
+            found, bounds = self.get_version(session, gis_polygon_id) is not None, []
+
+        if not found:
             return self.response_404(resp)
 
         session.commit()
+        self.invalidate(gis_polygon_id, *bounds)
 
         resp.body = json.dumps({"status": "200 OK"})
         resp.status = falcon.HTTP_200
@@ -181,14 +634,14 @@ class GISPolygonCRUD(BaseGISPolygonController):
         :return:
         """
         session = DBSession()
-        gis_polygon = self.get_gis_polygon(session, gis_polygon_id)
+        ids, bounds = self.delete_gis_polygons(session, [GISPolygon.id == gis_polygon_id])
 
-        if gis_polygon:
-            session.delete(gis_polygon)
-            session.commit()
-        else:
+        if not ids:
             return self.response_404(resp)
 
+        session.commit()
+        self.invalidate(gis_polygon_id, *bounds)
+
         resp.body = json.dumps({"status": "200 OK"})
         resp.status = falcon.HTTP_200
 
@@ -196,29 +649,674 @@ class GISPolygonCRUD(BaseGISPolygonController):
 class GISPolygonList(BaseGISPolygonController):
     """
     Controller to display the list of all gis_polygons upon GET request.
+
+    Query params:
+        after - return only gis_polygons following this keyset cursor: the id of the last gis_polygon
+                of the previous page for id sort, the X-Next-Cursor of the previous page for any sort
+        limit - page size, if given the cursor to pass as `after` for the next page is
+                returned in the X-Next-Cursor header (absent on the last page)
+        sort - one of id (the default), name, _created, _updated, prefixed with `-` for descending order
+
+        class_id - class id
+        name - name prefix
+        created_after, created_before, updated_after, updated_before - _created/_updated range
+                (%Y-%m-%dT%H:%M:%S, the start inclusive, the end exclusive)
+        props - JSON object props are to contain (the given keys with equal values)
+
+        geom_format - encode geom by PostGIS in one of GEOM_FORMATS instead of Shapely WKT
+        simplify, zoom - simplify geom with the tolerance in degrees or the one fitting the map zoom
+
+    Filters and sorts are backed by the indexes of GISPolygon model, the given filters are combined.
+    Without `limit` the whole list is streamed, reading rows through a server-side cursor.
+    Pages carry an ETag of (id, _updated) of their gis_polygons, the streamed list carries none.
+    Responds with Arrow IPC stream or FlatGeobuf instead of JSON if preferred by Accept header.
     """
 
     def on_get(self, req, resp):
-        session = DBSession(autocommit=True)
+        sort = self.get_sort(req)
+        after = self.get_after(req, sort)
+        limit = self.get_limit(req)
+        criteria = self.get_criteria(req)
+        geom_format = self.get_geom_format(req)
+        tolerance = self.get_tolerance(req)
+        media_type = self.get_media_type(req)
 
-        gis_polygons = session.query(GISPolygon).all()
-        gis_polygons = [gis_polygon.as_dict() for gis_polygon in gis_polygons]
+        resp.set_header('Vary', 'Accept')
+        if limit:
+            # the version of the whole streamed list would take a scan of the table, so pages only are versioned
+            etag = self.make_etag(req.query_string, media_type,
+                                  *self.get_page_version(DBSession(), after, limit, criteria, sort))
+            if self.not_modified(req, resp, etag):
+                return
+            return self.get_page(req, resp, after, limit, geom_format, criteria, tolerance, media_type, sort)
 
-        if not gis_polygons:
+        # the stream outlives the request scoped session, so it reads with a session of its own,
+        # closed along with the stream
+        session = DBSession.session_factory()
+        try:
+            gis_polygons = self.query_gis_polygons(session, after, geom_format, tolerance, media_type, sort) \
+                .filter(*criteria)
+            gis_polygons = iter(gis_polygons.yield_per(settings.LIST_STREAM_CHUNK))
+
+            if media_type != formats.JSON:
+                resp.stream = SessionStream(session, self.stream_encoded(media_type, gis_polygons))
+                resp.content_type = media_type
+                resp.status = falcon.HTTP_200
+                return
+
+            first = next(gis_polygons, None)
+        except Exception:
+            session.close()
+            raise
+
+        if first is None:
+            session.close()
+            self.response_empty(resp, after, bool(criteria))
+        else:
+            resp.stream = SessionStream(session, self.stream_gis_polygons(chain([first], gis_polygons)))
+
+        resp.status = falcon.HTTP_200
+
+    @staticmethod
+    def get_criteria(req):
+        """
+        Attribute filter clauses requested by query params.
+        :param req:
+        :return:
+        """
+        criteria = []
+
+        class_id = req.get_param_as_int('class_id')
+        if class_id is not None:
+            criteria.append(class_filter(class_id))
+
+        name = req.get_param('name')
+        if name:
+            criteria.append(name_prefix_filter(name))
+
+        for column, start, end in ((GISPolygon._created, 'created_after', 'created_before'),
+                                   (GISPolygon._updated, 'updated_after', 'updated_before')):
+            start = req.get_param_as_datetime(start, format_string='%Y-%m-%dT%H:%M:%S')
+            end = req.get_param_as_datetime(end, format_string='%Y-%m-%dT%H:%M:%S')
+            if start is not None or end is not None:
+                criteria.append(range_filter(column, start, end))
+
+        props = req.get_param('props')
+        if props is not None:
+            try:
+                valid = isinstance(json.loads(props), dict)
+            except ValueError:
+                valid = False
+            if not valid:
+                raise falcon.HTTPInvalidParam('Expected a JSON object.', 'props')
+            criteria.append(props_filter(props))
+
+        return criteria
+
+    @staticmethod
+    def response_empty(resp, after, filtered=False):
+        if after is None and not filtered:
             resp.body = json.dumps({"status": "The DB is empty, please fill."})
         else:
-            resp.body = json.dumps(gis_polygons, ensure_ascii=False, default=datetime_wkb_handler)
+            resp.body = json.dumps([])
+        resp.status = falcon.HTTP_200
+
+    @classmethod
+    def stream_gis_polygons(cls, gis_polygons):
+        """
+        Yield the JSON array of gis_polygons chunk by chunk.
+        :param gis_polygons:
+        :return:
+        """
+        yield b'['
+        separator = b''
+        chunk = []
+        for gis_polygon in gis_polygons:
+            chunk.append(dumps(cls.as_dict(gis_polygon)))
+            if len(chunk) == settings.LIST_STREAM_CHUNK:
+                yield separator + b','.join(chunk)
+                separator = b','
+                chunk = []
+        if chunk:
+            yield separator + b','.join(chunk)
+        yield b']'
+
+    @staticmethod
+    def stream_encoded(media_type, gis_polygons):
+        """
+        Yield gis_polygons encoded into the binary media type chunk by chunk.
+        :param media_type:
+        :param gis_polygons: rows of formats.COLUMNS
+        :return:
+        """
+        chunks = iter(lambda: list(islice(gis_polygons, settings.LIST_STREAM_CHUNK)), [])
+        for data in formats.encode(media_type, chunks):
+            yield data
+
+
+class GISPolygonChanges(BaseGISPolygonController):
+    """
+    Controller to display the change feed of gis_polygons upon GET request: gis_polygons created or updated
+    (as on the list, with `"deleted": false`) and deleted (`{"id": ..., "deleted": true}` tombstones)
+    in the order of the writing transactions, each gis_polygon once as of its last change.
+
+    Query params:
+        after - X-Next-Cursor of the previous response, read the feed from the beginning without it
+        limit - page size, without it the whole feed is streamed
+
+    X-Next-Cursor is returned by every response: pass it as `after` to read the next page while pages
+    are full (as long as `limit`), and later on to poll for the changes made in the meantime.
+    """
+
+    def on_get(self, req, resp):
+        after = self.get_changes_after(req)
+        limit = self.get_limit(req)
+
+        session = DBSession()
+        bound = feed_bound(session)
+        # the feed up to the bound has been read unless the page is full
+        end = max(after or (bound, 0), (bound, 0))
+
+        if limit:
+            changes = query_changes(session, after, bound).limit(limit).all()
+            cursor = (changes[-1][1], changes[-1][0]) if len(changes) == limit else end
+            resp.set_header('X-Next-Cursor', self.encode_cursor(*cursor))
+            resp.data = dumps([self.as_dict(change) for change in changes])
+            resp.status = falcon.HTTP_200
+            return
+
+        # the stream outlives the request scoped session, so it reads with a session of its own,
+        # closed along with the stream
+        stream_session = DBSession.session_factory()
+        try:
+            changes = iter(query_changes(stream_session, after, bound).yield_per(settings.LIST_STREAM_CHUNK))
+        except Exception:
+            stream_session.close()
+            raise
+
+        resp.set_header('X-Next-Cursor', self.encode_cursor(*end))
+        resp.stream = SessionStream(stream_session, self.stream_changes(changes))
+        resp.status = falcon.HTTP_200
+
+    @staticmethod
+    def get_changes_after(req):
+        """
+        Cursor of the feed requested by `after` param as (xid, gis_polygon_id), None to read from the beginning.
+        :param req:
+        :return:
+        """
+        after = req.get_param('after')
+        if after is None:
+            return None
+
+        values = GISPolygonChanges.decode_cursor(after, 2)
+        if not all(isinstance(value, int) for value in values):
+            raise falcon.HTTPInvalidParam('Expected X-Next-Cursor of the previous page.', 'after')
+        return tuple(values)
+
+    @staticmethod
+    def as_dict(change):
+        """
+        Represent (gis_polygon_id, xid, deleted, GISPolygon) change row as JSON ready Dict.
+        :param change:
+        :return:
+        """
+        gis_polygon_id, _, deleted, gis_polygon = change
+        if deleted or gis_polygon is None:
+            return {'id': gis_polygon_id, 'deleted': True}
+        return dict(encode_gis_polygon(gis_polygon), deleted=False)
+
+    @classmethod
+    def stream_changes(cls, changes):
+        """
+        Yield the JSON array of changes chunk by chunk.
+        :param changes:
+        :return:
+        """
+        yield b'['
+        separator = b''
+        for chunk in iter(lambda: list(islice(changes, settings.LIST_STREAM_CHUNK)), []):
+            yield separator + b','.join(dumps(cls.as_dict(change)) for change in chunk)
+            separator = b','
+        yield b']'
+
+
+class GISPolygonSearch(BaseGISPolygonController):
+    """
+    Controller to search gis_polygons by spatial filters upon GET request.
+
+    Query params:
+        bbox - min_x,min_y,max_x,max_y polygons bounding box intersects
+        intersects - WKT geometry polygons intersect
+        dwithin - lon,lat,meters point polygons are within the distance from
+        after, limit - keyset pagination as on the list (limit is settings.SEARCH_LIMIT by default)
+        geom_format - encode geom by PostGIS in one of GEOM_FORMATS instead of Shapely WKT
+        simplify, zoom - simplify geom with the tolerance in degrees or the one fitting the map zoom
+    All the given filters are combined and compiled into GiST index assisted queries.
+    Responds with Arrow IPC stream or FlatGeobuf instead of JSON if preferred by Accept header.
+    """
+
+    def on_get(self, req, resp):
+        after = req.get_param_as_int('after')
+        limit = self.get_limit(req, default=settings.SEARCH_LIMIT)
+        geom_format = self.get_geom_format(req)
+        tolerance = self.get_tolerance(req)
+        media_type = self.get_media_type(req)
+
+        resp.set_header('Vary', 'Accept')
+        self.get_page(req, resp, after, limit, geom_format, self.get_criteria(req), tolerance, media_type)
+
+    @staticmethod
+    def get_criteria(req):
+        """
+        Spatial filter clauses requested by query params.
+        :param req:
+        :return:
+        """
+        criteria = []
+
+        bbox = GISPolygonSearch.get_param_as_floats(req, 'bbox', 'min_x,min_y,max_x,max_y')
+        if bbox is not None:
+            criteria.append(bbox_filter(*bbox))
+
+        intersects = req.get_param('intersects')
+        if intersects is not None:
+            try:
+                wkt.loads(intersects)
+            except Exception:
+                raise falcon.HTTPInvalidParam('Not a valid WKT geometry.', 'intersects')
+            criteria.append(intersects_filter(intersects))
+
+        dwithin = GISPolygonSearch.get_param_as_floats(req, 'dwithin', 'lon,lat,meters')
+        if dwithin is not None:
+            criteria.append(dwithin_filter(*dwithin))
+
+        return criteria
+
+    @staticmethod
+    def get_param_as_floats(req, name, names):
+        """
+        Comma separated list of floats param, one per comma separated `names`.
+        :param req:
+        :param name:
+        :param names:
+        :return:
+        """
+        value = req.get_param(name)
+        if value is None:
+            return None
+
+        try:
+            values = [float(item) for item in value.split(',')]
+        except ValueError:
+            values = []
+        if len(values) != len(names.split(',')):
+            raise falcon.HTTPInvalidParam('Expected %s.' % names, name)
+        return values
+
+
+class GISPolygonTiles(BaseGISPolygonController):
+    """
+    Controller to render Mapbox Vector Tiles of gis_polygons (with id, name and class_id attributes)
+    upon GET request. Rendered tiles are cached per worker if settings.TILE_CACHE_SIZE is set,
+    writes through GISPolygonCRUD invalidate the tiles covering the old and the new geometry.
+    """
+
+    cache = LRUCache(settings.TILE_CACHE_SIZE, settings.TILE_CACHE_TTL) if settings.TILE_CACHE_SIZE else None
+
+    def on_get(self, req, resp, z, x, y):
+        try:
+            z, x, y = int(z), int(x), int(y)
+        except ValueError:
+            return self.response_404(resp)
+
+        if not is_valid_tile(z, x, y):
+            return self.response_404(resp)
+
+        tile = self.cache.get((z, x, y)) if self.cache is not None else None
+        if tile is None:
+            tile = render_tile(DBSession(), z, x, y)
+            if self.cache is not None:
+                self.cache.set((z, x, y), tile)
+
+        resp.data = tile
+        resp.content_type = 'application/vnd.mapbox-vector-tile'
+        resp.status = falcon.HTTP_200
+
+
+class GISPolygonStats(BaseGISPolygonController):
+    """
+    Controller to summarize gis_polygons by class_id upon GET request: count, geodesic area (m2),
+    extent [min_x, min_y, max_x, max_y] and area weighted centroid [lon, lat] of each class.
+
+    With no query params the summaries are read from gis_polygon_class_stats maintained on writes,
+    at the cost of a row per class. Given the spatial filters of /gis_polygon/search (bbox, intersects,
+    dwithin) the gis_polygons matching them (whole, not clipped) are summarized by the query.
+    """
+
+    def on_get(self, req, resp):
+        resp.data = dumps(class_stats(DBSession(), *GISPolygonSearch.get_criteria(req)))
+        resp.status = falcon.HTTP_200
+
+
+class GISPolygonBulk(BaseGISPolygonController):
+    """
+    Controller to create gis_polygons in bulk upon POST request, to update or delete them in bulk
+    upon PATCH or DELETE request.
+
+    Accepts either a JSON array (application/json) or a stream of JSON records one per line
+    (application/x-ndjson, application/geo+json-seq). Records are either in the GISPolygonSerializer format
+    or GeoJSON Features with name/class_id/props in properties.
+    Records are validated and inserted in chunks of settings.BULK_CHUNK_SIZE, one INSERT statement per chunk,
+    geometries of a chunk are checked for validity in one batch.
+    Invalid records are reported by their index in the request and do not abort the valid ones.
+
+    PATCH (with the fields to set in the body, as on PUT) and DELETE run a single statement on gis_polygons
+    selected by query params, at least one is required:
+        ids - comma separated ids
+        class_id - class id
+        bbox, intersects, dwithin - spatial filters as on /gis_polygon/search
+    """
+
+    serializer = GISPolygonBulkSerializer()
+    update_serializer = GISPolygonSerializer(strict=True)
+
+    SEQUENCE_CONTENT_TYPES = ('application/x-ndjson', 'application/geo+json-seq', 'application/json-seq')
+
+    def on_post(self, req, resp):
+        """
+        Create gis_polygons in bulk.
+        :param req:
+        :param resp:
+        :return:
+        """
+        content_type = (req.content_type or '').split(';')[0].strip()
+        if content_type in self.SEQUENCE_CONTENT_TYPES:
+            records = self.read_sequence(req.bounded_stream)
+        else:
+            records = req.media
+            if not isinstance(records, list):
+                raise falcon.HTTPBadRequest('Invalid JSON', 'A JSON array of gis_polygons is expected.')
+
+        self.response_inserted(resp, *self.insert_records(DBSession(), records))
+
+    def insert_records(self, session, records):
+        """
+        Validate and insert records chunk by chunk, each chunk committed.
+        :param session:
+        :param records: iterable of records
+        :return: number of inserted gis_polygons and errors by the record index
+        """
+        inserted = 0
+        errors = {}
+        records = enumerate(records)
+
+        while True:
+            chunk = list(islice(records, settings.BULK_CHUNK_SIZE))
+            if not chunk:
+                break
+            inserted += self.insert_chunk(session, chunk, errors)
+            session.commit()
+
+        if inserted and GISPolygonTiles.cache is not None:
+            GISPolygonTiles.cache.clear()
+
+        return inserted, errors
+
+    @staticmethod
+    def response_inserted(resp, inserted, errors):
+        """
+        Respond 201 with the inserted count and errors, 400 if there are errors only.
+        :param resp:
+        :param inserted:
+        :param errors:
+        :return:
+        """
+        resp.body = json.dumps({"inserted": inserted, "errors": errors})
+        resp.status = falcon.HTTP_201 if inserted or not errors else falcon.HTTP_400
+
+    def on_patch(self, req, resp):
+        """
+        Update gis_polygons matching the filters.
+        :param req:
+        :param resp:
+        :return:
+        """
+        self.patch(req, resp, req.media)
+
+    def patch(self, req, resp, data):
+        """
+        Update gis_polygons matching the filters with the fields of the request data.
+        :param req:
+        :param resp:
+        :param data: request data
+        :return:
+        """
+        session = DBSession()
+        criteria = self.get_criteria(req)
+
+        try:
+            serialized = self.update_serializer.load(data=data, partial=True)
+        except ValidationError as err:
+            return self.response_400(resp, err)
+
+        values = self.written_values(serialized.data, data)
+        if not values:
+            raise falcon.HTTPBadRequest('Nothing to update', 'No gis_polygon fields are given.')
+
+        ids, bounds = self.update_gis_polygons(session, values, criteria)
+        session.commit()
+        GISPolygonCRUD.invalidate_many(ids, *bounds)
+
+        resp.data = dumps({"updated": len(ids), "ids": ids})
+        resp.status = falcon.HTTP_200
+
+    def on_delete(self, req, resp):
+        """
+        Delete gis_polygons matching the filters.
+        :param req:
+        :param resp:
+        :return:
+        """
+        session = DBSession()
+        criteria = self.get_criteria(req)
+
+        ids, bounds = self.delete_gis_polygons(session, criteria)
+        session.commit()
+        GISPolygonCRUD.invalidate_many(ids, *bounds)
+
+        resp.data = dumps({"deleted": len(ids), "ids": ids})
+        resp.status = falcon.HTTP_200
+
+    @staticmethod
+    def get_criteria(req):
+        """
+        Filter clauses of bulk PATCH/DELETE requested by query params, at least one is required.
+        :param req:
+        :return:
+        """
+        criteria = GISPolygonSearch.get_criteria(req)
+
+        ids = req.get_param('ids')
+        if ids is not None:
+            try:
+                criteria.append(GISPolygon.id.in_([int(item) for item in ids.split(',')]))
+            except ValueError:
+                raise falcon.HTTPInvalidParam('Expected comma separated integers.', 'ids')
+
+        class_id = req.get_param_as_int('class_id')
+        if class_id is not None:
+            criteria.append(GISPolygon.class_id == class_id)
+
+        if not criteria:
+            raise falcon.HTTPBadRequest('Missing filter', 'One of ids, class_id, bbox, intersects or dwithin '
+                                                          'query params is required.')
+        return criteria
+
+    @staticmethod
+    def read_sequence(stream):
+        """
+        Yield records of NDJSON/GeoJSON Text Sequence stream, ValueError for lines not being valid JSON.
+        :param stream:
+        :return:
+        """
+        # by readline, wsgi.input is not required to be iterable and the bounded stream iterates it unbounded
+        for line in iter(stream.readline, b''):
+            line = line.strip(b'\x1e \t\r\n')
+            if line:
+                try:
+                    yield loads(line)
+                except ValueError as err:
+                    yield err
+
+    @staticmethod
+    def feature_as_record(feature):
+        """
+        Represent GeoJSON Feature as GISPolygonSerializer data.
+        :param feature:
+        :return:
+        """
+        record = dict(feature.get('properties') or {})
+        record['geom'] = feature.get('geometry')
+        return record
+
+    def insert_chunk(self, session, chunk, errors):
+        """
+        Validate chunk of (index, record) pairs and insert the valid ones, collecting errors by index.
+        :param session:
+        :param chunk:
+        :param errors:
+        :return: number of inserted records
+        """
+        indexes, records = [], []
+        for index, record in chunk:
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                if not isinstance(record, dict):
+                    raise TypeError('Invalid input type.')
+                if record.get('type') == 'Feature':
+                    record = self.feature_as_record(record)
+            except (AttributeError, KeyError, TypeError, ValueError) as err:
+                errors[index] = {'_schema': [str(err)]}
+                continue
+            indexes.append(index)
+            records.append(record)
+
+        if not records:
+            return 0
+
+        data, chunk_errors = self.serializer.load(records, many=True)
+        for position, messages in chunk_errors.items():
+            errors[indexes[position]] = messages
+
+        positions = [position for position in range(len(data)) if position not in chunk_errors]
+        geometries, geometry_errors = check_geometries([data[position]['geom'] for position in positions],
+                                                       settings.GEOM_REPAIR)
+        for position, message in geometry_errors.items():
+            errors[indexes[positions[position]]] = {'geom': [message]}
+
+        rows = []
+        for position, geometry in zip(positions, geometries):
+            if geometry is not None:
+                rows.append(dict(data[position], geom=as_wkb_element(geometry)))
+        if not rows:
+            return 0
+
+        # multi-row INSERT needs the same columns in every row
+        ids = []
+        table = GISPolygon.__table__
+        rows.sort(key=lambda row: sorted(row))
+        for _, same_columns in groupby(rows, key=lambda row: sorted(row)):
+            ids.extend(row[0] for row in session.execute(table.insert().values(list(same_columns))
+                                                         .returning(table.c.id)))
+
+        refresh_lod(session, GISPolygon.id.in_(ids))
+        add_class_stats(session, GISPolygon.id.in_(ids))
+        record_changes(session, GISPolygon.id.in_(ids))
+
+        return len(rows)
+
+
+class GISPolygonMetrics(object):
+    """
+    Controller to expose request duration histograms of the worker by route and phase
+    in Prometheus text format upon GET request.
+    """
+
+    def on_get(self, req, resp):
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.data = metrics.render().encode('utf-8')
+        resp.status = falcon.HTTP_200
+
+
+class GISPolygonProfiles(BaseGISPolygonController):
+    """
+    Admin controller to list request profiling captures of the worker upon GET request,
+    or to download one of them by id: as JSON with its SQL statements and profile text,
+    or with `?format=pstats` as cProfile data (for pstats, snakeviz etc.).
+    Requires settings.PROFILE_ENABLED and the profiling secret header.
+    """
+
+    profiled = False
+
+    def on_get(self, req, resp, capture_id=None):
+        if not settings.PROFILE_ENABLED or not profiling.authorized(req):
+            return self.response_404(resp)
+
+        if capture_id is None:
+            resp.data = dumps(profiling.captures.list())
+            resp.status = falcon.HTTP_200
+            return
+
+        capture = profiling.captures.get(int(capture_id)) if capture_id.isdigit() else None
+        if capture is None:
+            return self.response_404(resp)
+
+        if req.get_param('format') == 'pstats':
+            if capture['pstats'] is None:
+                return self.response_404(resp)
+            resp.content_type = 'application/octet-stream'
+            resp.set_header('Content-Disposition', 'attachment; filename="gis_polygon_%s.prof"' % capture_id)
+            resp.data = capture['pstats']
+        else:
+            resp.data = dumps({name: value for name, value in capture.items() if name != 'pstats'})
+        resp.status = falcon.HTTP_200
+
 
+class GISPolygonStatus(object):
+    """
+    Controller to display worker internals (database connection pool, cache and geometry process pool statistics)
+    upon GET request.
+    """
+
+    def on_get(self, req, resp):
+        cache = GISPolygonCRUD.cache.stats() if GISPolygonCRUD.cache is not None else None
+        tile_cache = GISPolygonTiles.cache.stats() if GISPolygonTiles.cache is not None else None
+        resp.body = json.dumps({"pool": engine.pool.stats(), "cache": cache, "tile_cache": tile_cache,
+                                "geom_pool": geometry_pool.stats()})
         resp.status = falcon.HTTP_200
 
 
 @logged(logger)
 class GISPolygonTransform(BaseGISPolygonController):
     """
-    Controller to display the list of all gis_polygons upon GET request.
-    """
+    Controller to display gis_polygons projected into `outProj` coordinate system upon GET request.
 
-    from webargs.falconparser import use_args
+    Query params:
+        id - a single gis_polygon to project
+        ids - comma separated list of gis_polygons to project in batch
+        class_id - project in batch all the gis_polygons of the class
+        engine - one of TRANSFORM_ENGINES to project with (settings.TRANSFORM_ENGINE by default):
+            python - project by pyproj in the worker
+            postgis - project by ST_Transform in the database
+            auto - project by PostGIS the polygons having at least settings.TRANSFORM_POSTGIS_MIN_VERTICES
+                   vertices, the rest by pyproj
+        simplify, zoom - simplify geom with the tolerance in degrees or the one fitting the map zoom
+    Batches are fetched with a single query and projected with a single vectorized transform.
+    Responds with Arrow IPC stream or FlatGeobuf instead of JSON if preferred by Accept header,
+    the binary formats always carry a collection, even of a single gis_polygon.
+    """
 
     @use_args(UserSchema(strict=True))
     def on_get(self, req, resp, args):
@@ -226,29 +1324,179 @@ class GISPolygonTransform(BaseGISPolygonController):
         Retrieve detailed info abP gis_polygon projected between coordinate systems.
         :param req:
         :param resp:
-        :param gis_polygon_id:
+        :param args:
         :return:
         """
 
         self.__log.info('{0} {1} {2} {3}'.format(req.method, req.relative_uri, resp.status[:3], args))
 
+        srid = self.get_srid(args)
+        engine = args['engine'] or settings.TRANSFORM_ENGINE
+        tolerance = self.get_tolerance(req)
+        media_type = self.get_media_type(req)
         session = DBSession()
-        gis_polygon = self.get_gis_polygon(session, args['id'])
 
-        if gis_polygon:
-            gis_polygon = gis_polygon.as_json_dict()
-        else:
+        criteria, batch = self.get_criteria(args)
+        if criteria is None:
             return self.response_404(resp)
 
-        if args['outProj']:
-            gis_polygon['geom'] = cs_transform(gis_polygon['geom'], in_proj='epsg:4326',
-                                               out_proj=''.join(['epsg:', args['outProj']]))
-        elif args['outProj'] is None:
-            resp.status = falcon.HTTP_400
-            resp.body = 'No output projection s specified'
-        else:
-            resp.status = falcon.HTTP_200
-            resp.body = 'NOT Hoorrayy!!!!'
+        versions = self.get_versions(session, criteria)
+        if not batch and not versions:
+            return self.response_404(resp)
+
+        resp.set_header('Vary', 'Accept')
+        if self.not_modified(req, resp, self.make_etag(srid, engine, tolerance, media_type, *versions)):
+            return
+
+        gis_polygons = self.transform_gis_polygons(session, criteria, srid, engine, tolerance)
+        self.response_transformed(resp, gis_polygons, batch, media_type, srid)
+
+    @staticmethod
+    def get_srid(args):
+        """
+        EPSG code requested by `outProj`, None to keep geom as it is.
+        :param args:
+        :return:
+        """
+        try:
+            return int(args['outProj']) if args['outProj'] else None
+        except ValueError:
+            raise falcon.HTTPInvalidParam('EPSG code is expected.', 'outProj')
+
+    @staticmethod
+    def get_criteria(args):
+        """
+        Filter clauses of the gis_polygons requested, None if none is, and whether it is a batch.
+        :param args:
+        :return:
+        """
+        batch = args['ids'] is not None or args['class_id'] is not None
+
+        if batch:
+            if args['ids'] is not None and len(args['ids']) > settings.LIST_MAX_LIMIT:
+                raise falcon.HTTPInvalidParam('At most %s ids are allowed.' % settings.LIST_MAX_LIMIT, 'ids')
+
+            criteria = []
+            if args['ids'] is not None:
+                criteria.append(GISPolygon.id.in_(args['ids']))
+            if args['class_id'] is not None:
+                criteria.append(GISPolygon.class_id == args['class_id'])
+            return criteria, batch
+        if args['id']:
+            return [GISPolygon.id == args['id']], batch
+        return None, batch
+
+    @staticmethod
+    def get_versions(session, criteria):
+        """
+        Cheap probe of (id, _updated) of gis_polygons matching criteria without fetching the geometry.
+        :param session:
+        :param criteria:
+        :return:
+        """
+        return session.query(GISPolygon.id, GISPolygon._updated).filter(*criteria).order_by(GISPolygon.id).all()
+
+    def response_transformed(self, resp, gis_polygons, batch, media_type, srid):
+        """
+        Respond with transformed gis_polygons encoded into the media type, a single one unless batch.
+        :param resp:
+        :param gis_polygons:
+        :param batch:
+        :param media_type:
+        :param srid:
+        :return:
+        """
+        if media_type != formats.JSON:
+            return self.response_encoded(resp, media_type, [formats.dict_rows(gis_polygons)], srid or 4326)
+        if not batch:
+            if not gis_polygons:
+                return self.response_404(resp)
+            gis_polygons = gis_polygons[0]
 
-        resp.body = json.dumps(gis_polygon, ensure_ascii=False, default=datetime_wkb_handler)
+        resp.data = dumps(gis_polygons)
         resp.status = falcon.HTTP_200
+
+    @staticmethod
+    def transform_columns(srid, engine, geom=GISPolygon.geom):
+        """
+        GISPolygon columns with geom as WKB to be projected by python (`geom`)
+        or as WKT already projected by PostGIS (`projected`), the other one being NULL.
+        :param srid:
+        :param engine:
+        :param geom: SQL expression to project instead of geom column itself, e.g. its simplified version
+        :return:
+        """
+        python_geom = func.ST_AsBinary(geom, type_=LargeBinary)
+        postgis_geom = func.ST_AsText(func.ST_Transform(geom, srid))
+
+        if engine == 'python':
+            postgis_geom = null()
+        elif engine == 'postgis':
+            python_geom = null()
+        else:
+            large = func.ST_NPoints(geom) >= settings.TRANSFORM_POSTGIS_MIN_VERTICES
+            python_geom = case([(large, null())], else_=python_geom)
+            postgis_geom = case([(large, postgis_geom)], else_=null())
+
+        columns = [c for c in GISPolygon.__table__.columns if c.name != 'geom']
+        return columns + [python_geom.label('geom'), postgis_geom.label('projected')]
+
+    @classmethod
+    def transform_gis_polygons(cls, session, criteria, srid, engine, tolerance=None):
+        """
+        Fetch gis_polygons matching criteria with a single query and project them into srid by the engine.
+        :param session:
+        :param criteria: SQLAlchemy filter clauses
+        :param srid: EPSG code to project into, None to keep geom as it is
+        :param engine: one of TRANSFORM_ENGINES
+        :param tolerance: tolerance to simplify geom with before projecting, None for full resolution
+        :return:
+        """
+        return cls.project_gis_polygons(cls.query_gis_polygons_transform(session, criteria, srid, engine, tolerance),
+                                        srid)
+
+    @classmethod
+    def query_gis_polygons_transform(cls, session, criteria, srid, engine, tolerance=None):
+        """
+        Fetch gis_polygons matching criteria with a single query, the ones to be projected by PostGIS
+        already projected (in `projected`), the rest left for project_gis_polygons (in `geom`).
+        :param session:
+        :param criteria:
+        :param srid:
+        :param engine:
+        :param tolerance:
+        :return:
+        """
+        geom = lod_geom(tolerance) if tolerance else GISPolygon.geom
+
+        if srid is None:
+            query = session.query(*GISPolygon.encoded_columns('wkt', geom))
+        else:
+            query = session.query(*cls.transform_columns(srid, engine, geom))
+        return [gis_polygon._asdict() for gis_polygon in query.filter(*criteria).order_by(GISPolygon.id)]
+
+    @staticmethod
+    @metrics.timed('projection')
+    def project_gis_polygons(gis_polygons, srid):
+        """
+        Project fetched gis_polygons left for python into srid, CPU bound with no database access.
+        :param gis_polygons:
+        :param srid:
+        :return:
+        """
+        if srid is None:
+            return gis_polygons
+
+        # project the rest of polygons by python in one batch, in the process pool if large enough
+        pending = [gis_polygon for gis_polygon in gis_polygons if gis_polygon['geom'] is not None]
+        projected = geometry_pool.run(geometry_pool.transform, [bytes(gis_polygon['geom']) for gis_polygon in pending],
+                                      'epsg:4326', 'epsg:%s' % srid, output='wkt')
+        for gis_polygon, geom in zip(pending, projected):
+            gis_polygon['geom'] = geom
+
+        for gis_polygon in gis_polygons:
+            projected = gis_polygon.pop('projected')
+            if projected is not None:
+                gis_polygon['geom'] = projected
+
+        return gis_polygons
@@ -5,26 +5,136 @@
 Constructs new database session.
 """
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import time
+from threading import Lock
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 import settings
+from . import metrics, profiling
 from .models import Base
 
-engine = create_engine(settings.DB_PATH)
+
+class StatsQueuePool(QueuePool):
+    """
+    QueuePool keeping statistics of connection checkouts to size workers against PostgreSQL max_connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(StatsQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super(StatsQueuePool, self).connect()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.checkout_timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.checkout_wait_total += wait
+                self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def stats(self):
+        """
+        Pool occupancy and checkout wait statistics (in seconds) as Dict.
+        :return:
+        """
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "checked_in": self.checkedin(),
+                "checked_out": self.checkedout(),
+                "overflow": self.overflow(),
+                "checkouts": self.checkouts,
+                "checkout_timeouts": self.checkout_timeouts,
+                "checkout_wait_total": self.checkout_wait_total,
+                "checkout_wait_max": self.checkout_wait_max,
+                "checkout_wait_avg": self.checkout_wait_total / self.checkouts if self.checkouts else 0.0,
+            }
+
+
+engine = create_engine(settings.DB_PATH,
+                       poolclass=StatsQueuePool,
+                       pool_size=settings.DB_POOL_SIZE,
+                       max_overflow=settings.DB_MAX_OVERFLOW,
+                       pool_timeout=settings.DB_POOL_TIMEOUT,
+                       pool_recycle=settings.DB_POOL_RECYCLE,
+                       pool_pre_ping=settings.DB_POOL_PRE_PING)
 Base.metadata.bind = engine
+if settings.METRICS_ENABLED:
+    metrics.instrument_engine(engine)
+if settings.PROFILE_ENABLED:
+    profiling.instrument_engine(engine)
+
+# Thread local session, scoped to a request by SessionManager
+DBSession = scoped_session(sessionmaker(bind=engine))
+
+
+def reset_after_fork():
+    """
+    Drop the connections a forked worker has inherited from its parent (e.g. gunicorn master preloading
+    the application) without closing them, as they are still the parent's, so the worker opens its own.
+    :return:
+    """
+    DBSession.remove()
+    engine.dispose(close=False)
+
+
+class SessionManager(object):
+    """
+    Falcon middleware closing the request scoped DBSession on response:
+    commits it if the request succeeded, rolls it back otherwise.
+    """
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not DBSession.registry.has():
+            return
+
+        try:
+            if req_succeeded:
+                DBSession.commit()
+            else:
+                DBSession.rollback()
+        finally:
+            DBSession.remove()
+
+
+class SessionStream(object):
+    """
+    Streamed response body read by a session of its own, closing the session once exhausted or closed
+    by the server, which closes it on client disconnect even if it has never been iterated
+    (when the finally clause of a generator body would never run).
+    """
+
+    def __init__(self, session, iterable):
+        self.session = session
+        self.iterator = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.close()
+            raise
 
-# TODO: Implement scoped db session for a series of operations to be closed on scope exit.
-DBSession = sessionmaker(bind=engine)
-
-# @contextmanager
-# def session_scope():
-#     DBSession = sessionmaker(bind=db_engine)
-#     try:
-#         yield DBSession
-#         DBSession.commit()
-#     except:
-#         DBSession.rollback()
-#         raise
-#     finally:
-# DBSession.close()
+    def close(self):
+        try:
+            close = getattr(self.iterator, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.session.close()
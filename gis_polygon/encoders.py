@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Precompiled JSON encoders of GISPolygon responses.
+
+Encoders representing GISPolygon objects as JSON ready dicts are compiled once from the column list,
+converting only the columns JSON does not support (geom, and datetimes unless orjson is installed),
+and `dumps` serializes straight into bytes for resp.data by orjson if installed, else by the stdlib json.
+"""
+
+import json
+from datetime import datetime
+
+from geoalchemy2.elements import WKBElement
+from geoalchemy2.types import Geometry
+from sqlalchemy import DateTime
+
+from .metrics import timed
+from .models import GISPolygon, wkb_to_wkt
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def datetime_wkb_handler(x):
+    """
+    Handles json dumps of datetime/WKBElement objects in str format.
+    :param x:
+    :return:
+    """
+    if isinstance(x, datetime):
+        return x.isoformat()
+    if isinstance(x, WKBElement):
+        return wkb_to_wkt(x)
+    raise TypeError('%r is not JSON serializable' % x)
+
+
+if orjson is not None:
+    @timed('serialize')
+    def dumps(obj):
+        """
+        JSON of obj as UTF-8 bytes.
+        :param obj:
+        :return:
+        """
+        return orjson.dumps(obj, default=datetime_wkb_handler, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    @timed('serialize')
+    def dumps(obj):
+        """
+        JSON of obj as UTF-8 bytes.
+        :param obj:
+        :return:
+        """
+        return json.dumps(obj, ensure_ascii=False, default=datetime_wkb_handler).encode('utf-8')
+
+    loads = json.loads
+
+
+def nullable(convert):
+    return lambda value: None if value is None else convert(value)
+
+
+def make_encoder(columns, converters=None):
+    """
+    Compile function representing GISPolygon object as JSON ready Dict of the columns.
+    :param columns: SQLAlchemy columns
+    :param converters: converters of values by column name overriding the ones derived from the column types
+    :return:
+    """
+    converters = dict(converters or {})
+    for column in columns:
+        if column.name in converters:
+            continue
+        if isinstance(column.type, Geometry):
+            converters[column.name] = wkb_to_wkt
+        elif isinstance(column.type, DateTime) and orjson is None:
+            converters[column.name] = datetime.isoformat
+
+    plain = [column.name for column in columns if column.name not in converters]
+    converted = [(column.name, nullable(converters[column.name])) for column in columns
+                 if column.name in converters]
+
+    def encode(gis_polygon):
+        data = {name: getattr(gis_polygon, name) for name in plain}
+        for name, convert in converted:
+            data[name] = convert(getattr(gis_polygon, name))
+        return data
+
+    return encode
+
+
+# GET representation, same as GISPolygon.as_json_dict
+encode_gis_polygon = make_encoder(GISPolygon.__table__.columns)
+
+# POST representation, same as GISPolygonSerializer.dump
+encode_created_gis_polygon = make_encoder(
+    [column for column in GISPolygon.__table__.columns if column.name != 'id'],
+    {
+        'geom': lambda value: ''.join(['SRID=4326;', wkb_to_wkt(value)]),
+        'props': lambda value: value if isinstance(value, dict) else str(value),
+        '_created': lambda value: value.strftime('%Y-%m-%dT%H:%M:%S'),
+        '_updated': lambda value: value.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+GISPolygon filters compiled into index assisted predicates: PostGIS ones on GISPolygon.geom (GiST indexes)
+and attribute ones (B-tree and GIN indexes), keyset pagination in the sort orders backed by indexes.
+"""
+
+from sqlalchemy import and_, cast, func, literal, or_, tuple_, Text
+from sqlalchemy.dialects.postgresql import JSONB
+
+from .models import GISPolygon
+
+
+def bbox_filter(min_x, min_y, max_x, max_y):
+    """
+    Polygons whose bounding box intersects the given one, answered by the GiST index on geom alone.
+    :param min_x:
+    :param min_y:
+    :param max_x:
+    :param max_y:
+    :return:
+    """
+    return GISPolygon.geom.op('&&')(func.ST_MakeEnvelope(min_x, min_y, max_x, max_y, 4326))
+
+
+def intersects_filter(geom_wkt):
+    """
+    Polygons intersecting the WKT geometry (in EPSG:4326).
+    :param geom_wkt:
+    :return:
+    """
+    return func.ST_Intersects(GISPolygon.geom, func.ST_GeomFromText(geom_wkt, 4326))
+
+
+def dwithin_filter(lon, lat, meters):
+    """
+    Polygons within the distance in meters from the point, backed by the GiST index on geography(geom).
+    :param lon:
+    :param lat:
+    :param meters:
+    :return:
+    """
+    point = func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326)
+    return func.ST_DWithin(func.geography(GISPolygon.geom), func.geography(point), meters)
+
+
+# Columns lists can be sorted by, each but id is backed by a (column, id) index
+SORT_COLUMNS = {
+    'id': GISPolygon.id,
+    'name': GISPolygon.name,
+    '_created': GISPolygon._created,
+    '_updated': GISPolygon._updated,
+}
+
+
+def class_filter(class_id):
+    """
+    Polygons of the class, backed by idx_gis_polygon_class_id.
+    :param class_id:
+    :return:
+    """
+    return GISPolygon.class_id == class_id
+
+
+def name_prefix_filter(prefix):
+    """
+    Polygons whose name starts with the prefix (LIKE wildcards in it are matched literally),
+    backed by idx_gis_polygon_name_pattern.
+    :param prefix:
+    :return:
+    """
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return GISPolygon.name.like(escaped + '%')
+
+
+def range_filter(column, start=None, end=None):
+    """
+    Polygons whose column value is within [start, end) range, either bound may be omitted.
+    :param column: e.g. GISPolygon._created backed by (column, id) index
+    :param start:
+    :param end:
+    :return:
+    """
+    bounds = ([column >= start] if start is not None else []) + ([column < end] if end is not None else [])
+    return and_(*bounds)
+
+
+def props_filter(props):
+    """
+    Polygons whose props JSON object contains the given one (all of its keys with equal values),
+    backed by GIN index idx_gis_polygon_props.
+    :param props: JSON object text
+    :return:
+    """
+    # bound as text for PostgreSQL to parse, a JSONB bound value would be encoded once again into a JSON string
+    return cast(GISPolygon.props, JSONB).op('@>')(cast(literal(props, Text), JSONB))
+
+
+def sort_order(name, descending=False):
+    """
+    ORDER BY clauses of the sort: by the column, then by id to make it total.
+    :param name: one of SORT_COLUMNS
+    :param descending:
+    :return:
+    """
+    columns = [SORT_COLUMNS[name]] + ([GISPolygon.id] if name != 'id' else [])
+    return [column.desc() for column in columns] if descending else columns
+
+
+def keyset_filter(name, descending, after):
+    """
+    Polygons following the keyset cursor in the sort order (answered by a range scan of the sort index).
+    NULLs of nullable columns come last ascending and first descending, as sorted by PostgreSQL.
+    :param name: one of SORT_COLUMNS
+    :param descending:
+    :param after: id of the last polygon for id sort, (column value, id) of it otherwise
+    :return:
+    """
+    if name == 'id':
+        return GISPolygon.id < after if descending else GISPolygon.id > after
+
+    column = SORT_COLUMNS[name]
+    value, last_id = after
+    if value is None:
+        following = and_(column.is_(None), GISPolygon.id < last_id if descending else GISPolygon.id > last_id)
+        return or_(column.isnot(None), following) if descending else following
+
+    if descending:
+        return tuple_(column, GISPolygon.id) < tuple_(value, last_id)
+    following = tuple_(column, GISPolygon.id) > tuple_(value, last_id)
+    return or_(following, column.is_(None)) if GISPolygon.__table__.c[name].nullable else following
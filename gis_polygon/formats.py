@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Compact binary encodings of gis_polygon collections negotiated by the Accept header:
+    - Arrow IPC stream with the geometry in a GeoArrow WKB column (requires pyarrow)
+    - FlatGeobuf without spatial index (requires flatbuffers)
+Writers are fed with chunks of rows of COLUMNS (geom as WKB bytes, props as JSON text)
+and build the output chunk by chunk, column by column, so it can be streamed.
+"""
+
+import io
+import json
+import struct
+from functools import lru_cache
+
+import numpy as np
+import pyproj
+from shapely import wkb, wkt
+from sqlalchemy import cast, func, LargeBinary, Text
+
+from .metrics import timed
+from .models import GISPolygon
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import flatbuffers
+except ImportError:
+    flatbuffers = None
+
+
+JSON = 'application/json'
+ARROW = 'application/vnd.apache.arrow.stream'
+FLATGEOBUF = 'application/flatgeobuf'
+
+# Order of the columns in the rows fed to the encoders
+COLUMNS = ('id', 'class_id', 'name', 'props', '_created', '_updated', 'geom')
+
+
+def media_types():
+    """
+    Media types the responses can be encoded into, the default (JSON) one first.
+    :return:
+    """
+    return [JSON] + ([ARROW] if pyarrow is not None else []) + ([FLATGEOBUF] if flatbuffers is not None else [])
+
+
+def binary_columns(geom=None):
+    """
+    GISPolygon columns to select for the binary encoders, in COLUMNS order.
+    :param geom: SQL expression to select instead of geom column itself, e.g. its simplified version
+    :return:
+    """
+    geom = GISPolygon.geom if geom is None else geom
+    return [GISPolygon.id, GISPolygon.class_id, GISPolygon.name, cast(GISPolygon.props, Text).label('props'),
+            GISPolygon._created, GISPolygon._updated, func.ST_AsBinary(geom, type_=LargeBinary).label('geom')]
+
+
+def dict_rows(gis_polygons):
+    """
+    Rows for the binary encoders out of gis_polygon dicts having geom as WKT.
+    :param gis_polygons:
+    :return:
+    """
+    return [(gis_polygon['id'], gis_polygon['class_id'], gis_polygon['name'],
+             json.dumps(gis_polygon['props']) if gis_polygon['props'] is not None else None,
+             gis_polygon['_created'], gis_polygon['_updated'],
+             wkt.loads(gis_polygon['geom']).wkb if gis_polygon['geom'] is not None else None)
+            for gis_polygon in gis_polygons]
+
+
+def writer(media_type, srid=4326):
+    """
+    Incremental writer of gis_polygons into the binary media type.
+    :param media_type: ARROW or FLATGEOBUF
+    :param srid: EPSG code of the geometries
+    :return:
+    """
+    if media_type == ARROW:
+        return ArrowWriter(srid)
+    if media_type == FLATGEOBUF:
+        return FlatGeobufWriter(srid)
+    raise ValueError('Unsupported media type %s' % media_type)
+
+
+def encode(media_type, chunks, srid=4326):
+    """
+    Yield gis_polygons encoded into the binary media type chunk by chunk.
+    :param media_type: ARROW or FLATGEOBUF
+    :param chunks: iterable of lists of rows of COLUMNS
+    :param srid: EPSG code of the geometries
+    :return:
+    """
+    output = writer(media_type, srid)
+    yield output.begin()
+    for rows in chunks:
+        yield output.write(rows)
+    yield output.end()
+
+
+@lru_cache(maxsize=None)
+def crs_json(srid):
+    """
+    PROJJSON of the coordinate system, lon/lat ordered for EPSG:4326 as PostGIS stores it.
+    :param srid:
+    :return:
+    """
+    return pyproj.CRS.from_user_input('OGC:CRS84' if srid == 4326 else 'EPSG:%s' % srid).to_json()
+
+
+def arrow_schema(srid):
+    geom = pyarrow.field('geom', pyarrow.binary(), metadata={
+        'ARROW:extension:name': 'geoarrow.wkb',
+        'ARROW:extension:metadata': json.dumps({'crs': json.loads(crs_json(srid))}),
+    })
+    return pyarrow.schema([
+        pyarrow.field('id', pyarrow.int32(), nullable=False),
+        pyarrow.field('class_id', pyarrow.int32()),
+        pyarrow.field('name', pyarrow.string()),
+        pyarrow.field('props', pyarrow.string()),
+        pyarrow.field('_created', pyarrow.timestamp('us')),
+        pyarrow.field('_updated', pyarrow.timestamp('us')),
+        geom,
+    ])
+
+
+class ArrowWriter(object):
+    """
+    Arrow IPC stream of gis_polygons, one record batch per chunk.
+    """
+
+    def __init__(self, srid=4326):
+        self.schema = arrow_schema(srid)
+        self.sink = io.BytesIO()
+        self.writer = None
+
+    def flush(self):
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    def begin(self):
+        self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+        return self.flush()
+
+    @timed('serialize')
+    def write(self, rows):
+        if rows:
+            columns = [pyarrow.array(column, type=field.type) for column, field in zip(zip(*rows), self.schema)]
+            self.writer.write_batch(pyarrow.record_batch(columns, schema=self.schema))
+        return self.flush()
+
+    def end(self):
+        self.writer.close()
+        return self.flush()
+
+
+# FlatGeobuf format constants, see https://flatgeobuf.org and its header.fbs/feature.fbs schemas
+FLATGEOBUF_MAGIC = b'fgb\x03fgb\x00'
+FLATGEOBUF_POLYGON = 3
+FLATGEOBUF_INT, FLATGEOBUF_STRING, FLATGEOBUF_JSON, FLATGEOBUF_DATETIME = 5, 11, 12, 13
+
+# FlatGeobuf (name, type) of COLUMNS but geom
+FLATGEOBUF_COLUMNS = (('id', FLATGEOBUF_INT), ('class_id', FLATGEOBUF_INT), ('name', FLATGEOBUF_STRING),
+                      ('props', FLATGEOBUF_JSON), ('_created', FLATGEOBUF_DATETIME),
+                      ('_updated', FLATGEOBUF_DATETIME))
+
+
+def flatgeobuf_header(srid):
+    """
+    Size prefixed FlatGeobuf Header table: polygons of unknown count without spatial index.
+    :param srid:
+    :return:
+    """
+    builder = flatbuffers.Builder(1024)
+
+    columns = []
+    for name, column_type in FLATGEOBUF_COLUMNS:
+        name = builder.CreateString(name)
+        builder.StartObject(11)
+        builder.PrependUOffsetTRelativeSlot(0, name, 0)
+        builder.PrependUint8Slot(1, column_type, 0)
+        columns.append(builder.EndObject())
+
+    builder.StartVector(4, len(columns), 4)
+    for column in reversed(columns):
+        builder.PrependUOffsetTRelative(column)
+    columns = builder.EndVector()
+
+    org = builder.CreateString('EPSG')
+    builder.StartObject(6)
+    builder.PrependUOffsetTRelativeSlot(0, org, 0)
+    builder.PrependInt32Slot(1, srid, 0)
+    crs = builder.EndObject()
+
+    name = builder.CreateString('gis_polygon')
+    builder.StartObject(14)
+    builder.PrependUOffsetTRelativeSlot(0, name, 0)
+    builder.PrependUint8Slot(2, FLATGEOBUF_POLYGON, 0)
+    builder.PrependUOffsetTRelativeSlot(7, columns, 0)
+    builder.PrependUint16Slot(9, 0, 16)
+    builder.PrependUOffsetTRelativeSlot(10, crs, 0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def flatgeobuf_properties(row):
+    """
+    FlatGeobuf properties of the row: column index followed by the little endian value for every non NULL one.
+    :param row:
+    :return:
+    """
+    properties = []
+    for index, ((_, column_type), value) in enumerate(zip(FLATGEOBUF_COLUMNS, row)):
+        if value is None:
+            continue
+        if column_type == FLATGEOBUF_INT:
+            properties.append(struct.pack('<Hi', index, value))
+        else:
+            value = (value.isoformat() if column_type == FLATGEOBUF_DATETIME else value).encode('utf-8')
+            properties.append(struct.pack('<HI', index, len(value)) + value)
+    return b''.join(properties)
+
+
+def flatgeobuf_feature(row):
+    """
+    Size prefixed FlatGeobuf Feature table of the row.
+    :param row:
+    :return:
+    """
+    builder = flatbuffers.Builder(1024)
+
+    geometry = None
+    if row[-1] is not None:
+        polygon = wkb.loads(bytes(row[-1]))
+        rings = [polygon.exterior] + list(polygon.interiors)
+        xy = builder.CreateNumpyVector(np.concatenate([np.asarray(ring.coords)[:, :2] for ring in rings]).ravel())
+        ends = None
+        if len(rings) > 1:
+            ends = builder.CreateNumpyVector(np.cumsum([len(ring.coords) for ring in rings]).astype(np.uint32))
+
+        builder.StartObject(8)
+        if ends is not None:
+            builder.PrependUOffsetTRelativeSlot(0, ends, 0)
+        builder.PrependUOffsetTRelativeSlot(1, xy, 0)
+        geometry = builder.EndObject()
+
+    properties = builder.CreateNumpyVector(np.frombuffer(flatgeobuf_properties(row[:-1]), dtype=np.uint8))
+
+    builder.StartObject(3)
+    if geometry is not None:
+        builder.PrependUOffsetTRelativeSlot(0, geometry, 0)
+    builder.PrependUOffsetTRelativeSlot(1, properties, 0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+class FlatGeobufWriter(object):
+    """
+    FlatGeobuf of gis_polygons, features of a chunk written at once.
+    """
+
+    def __init__(self, srid=4326):
+        self.srid = srid
+
+    def begin(self):
+        return FLATGEOBUF_MAGIC + flatgeobuf_header(self.srid)
+
+    @staticmethod
+    @timed('serialize')
+    def write(rows):
+        return b''.join(flatgeobuf_feature(row) for row in rows)
+
+    @staticmethod
+    def end():
+        return b''
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Process pool offloading CPU heavy geometry operations (reprojection, simplification, validity repair,
+area computation) on large polygons, so they do not stall the other requests of the worker.
+
+Jobs of at least settings.GEOM_POOL_MIN_VERTICES vertices in total run in a pool of settings.GEOM_POOL_SIZE
+processes per worker (0 runs every job inline), smaller ones run inline not to pay for the handover.
+Geometries are handed over to the pool processes as WKB buffers, which need no parsing unlike WKT.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+import pyproj
+from shapely import wkb
+
+import settings
+from .middleware import get_transformer, transform_polygons
+
+try:
+    from shapely.validation import make_valid
+except ImportError:
+    # Shapely<1.8, geometries are not repaired
+    make_valid = None
+
+# Rough size of a polygon vertex in WKB (two doubles) to estimate vertex count of a job by its buffers
+WKB_VERTEX_SIZE = 16
+
+_executor = None
+_lock = Lock()
+_stats = {'queued': 0, 'pooled': 0, 'inline': 0}
+
+
+def dump(geometry, output):
+    return geometry.wkb if output == 'wkb' else geometry.wkt
+
+
+def transform(geometries, in_proj, out_proj, output='wkb'):
+    """
+    Project WKB polygons between two coordinate systems with a single vectorized projection.
+    :param geometries: WKB buffers
+    :param in_proj:
+    :param out_proj:
+    :param output: format to return the projected polygons in, wkb or wkt
+    :return:
+    """
+    polygons = [wkb.loads(geometry) for geometry in geometries]
+    return [dump(polygon, output) for polygon in transform_polygons(polygons, get_transformer(in_proj, out_proj))]
+
+
+def simplify(geometries, tolerance, output='wkb'):
+    """
+    Simplify WKB polygons preserving topology.
+    :param geometries: WKB buffers
+    :param tolerance:
+    :param output: wkb or wkt
+    :return:
+    """
+    return [dump(wkb.loads(geometry).simplify(tolerance, preserve_topology=True), output) for geometry in geometries]
+
+
+def repair(geometries, output='wkb'):
+    """
+    Repair invalid WKB geometries by make_valid (requires Shapely>=1.8).
+    :param geometries: WKB buffers
+    :param output: wkb or wkt
+    :return:
+    """
+    return [dump(make_valid(wkb.loads(geometry)), output) for geometry in geometries]
+
+
+def area(geometries):
+    """
+    Geodesic area (in square meters, on WGS 84 ellipsoid) of WKB polygons in EPSG:4326.
+    :param geometries: WKB buffers
+    :return:
+    """
+    geod = pyproj.Geod(ellps='WGS84')
+    return [abs(geod.geometry_area_perimeter(wkb.loads(geometry))[0]) for geometry in geometries]
+
+
+def get_executor():
+    """
+    Process pool of the worker, started on the first use, i.e. after gunicorn has forked the worker.
+    :return:
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.GEOM_POOL_SIZE)
+        return _executor
+
+
+def _reset_after_fork():
+    # a forked worker must not share the pool processes of its parent
+    global _executor, _lock
+    _executor = None
+    _lock = Lock()
+    _stats.update(queued=0, pooled=0, inline=0)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def run(operation, geometries, *args, **kwargs):
+    """
+    Run the geometry operation on WKB geometries in the process pool if they are large enough, inline otherwise.
+    :param operation: one of the operations of this module
+    :param geometries: WKB buffers
+    :param args: operation args
+    :param kwargs: operation kwargs
+    :return:
+    """
+    vertices = sum(len(geometry) for geometry in geometries) // WKB_VERTEX_SIZE
+    if not settings.GEOM_POOL_SIZE or vertices < settings.GEOM_POOL_MIN_VERTICES:
+        with _lock:
+            _stats['inline'] += 1
+        return operation(geometries, *args, **kwargs)
+
+    executor = get_executor()
+    with _lock:
+        _stats['queued'] += 1
+        _stats['pooled'] += 1
+    try:
+        return executor.submit(operation, list(geometries), *args, **kwargs).result()
+    finally:
+        with _lock:
+            _stats['queued'] -= 1
+
+
+def stats():
+    """
+    Pool size, number of jobs queued or running in the pool right now and jobs run in the pool/inline so far.
+    :return:
+    """
+    with _lock:
+        return dict(_stats, size=settings.GEOM_POOL_SIZE, min_vertices=settings.GEOM_POOL_MIN_VERTICES)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Levels of detail of GISPolygon geometry: topology preserving simplified versions precomputed
+for settings.LOD_TOLERANCES on writes, any other tolerance is simplified on the fly.
+"""
+
+import math
+
+from sqlalchemy import and_, func, literal, select
+from sqlalchemy.dialects import postgresql
+
+import settings
+from .models import GISPolygon, GISPolygonLOD
+
+
+def zoom_tolerance(zoom):
+    """
+    Simplification tolerance (in degrees) for the map zoom: the coarsest precomputed one
+    not exceeding a pixel of 256px tiles, None (full resolution) if all of them exceed it.
+    :param zoom:
+    :return:
+    """
+    pixel = 360.0 / (256 * 2 ** zoom)
+    tolerances = [tolerance for tolerance in settings.LOD_TOLERANCES if tolerance <= pixel]
+    return max(tolerances) if tolerances else None
+
+
+def precomputed_tolerance(tolerance):
+    """
+    The precomputed tolerance equal to the given one, None if it is not precomputed.
+    :param tolerance:
+    :return:
+    """
+    for precomputed in settings.LOD_TOLERANCES:
+        if math.isclose(tolerance, precomputed):
+            return precomputed
+
+
+def lod_geom(tolerance):
+    """
+    SQL expression of GISPolygon geometry simplified with the tolerance, read from gis_polygon_lod
+    for precomputed tolerances (falling back to simplifying on the fly if it is missing).
+    :param tolerance:
+    :return:
+    """
+    simplified = func.ST_SimplifyPreserveTopology(GISPolygon.geom, tolerance)
+    tolerance = precomputed_tolerance(tolerance)
+    if tolerance is None:
+        return simplified
+
+    precomputed = select([GISPolygonLOD.geom]) \
+        .where(and_(GISPolygonLOD.gis_polygon_id == GISPolygon.id, GISPolygonLOD.tolerance == tolerance)) \
+        .as_scalar()
+    return func.coalesce(precomputed, simplified)
+
+
+def refresh_lod(session, *criteria):
+    """
+    (Re)compute levels of detail of gis_polygons matching criteria, one INSERT ... SELECT per tolerance.
+    :param session:
+    :param criteria: SQLAlchemy filter clauses
+    :return:
+    """
+    for tolerance in settings.LOD_TOLERANCES:
+        simplified = select([GISPolygon.id, literal(tolerance),
+                             func.ST_SimplifyPreserveTopology(GISPolygon.geom, tolerance)]).where(and_(*criteria))
+
+        insert = postgresql.insert(GISPolygonLOD.__table__) \
+            .from_select(['gis_polygon_id', 'tolerance', 'geom'], simplified)
+        insert = insert.on_conflict_do_update(index_elements=['gis_polygon_id', 'tolerance'],
+                                              set_={'geom': insert.excluded.geom})
+        session.execute(insert)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Per-request timing breakdown by phase:
+    - db - SQL statements execution (SQLAlchemy engine events)
+    - decode - geometry parsing and WKB to WKT conversion
+    - projection - reprojection of geometries in the worker
+    - serialize - JSON/binary encoding of the response
+recorded by Metrics middleware into Prometheus histograms per route (served on /metrics)
+and into the Server-Timing response header.
+
+Phase timings of a request are collected into Timings of the request context (contextvars),
+so they are kept apart for concurrent requests of threads and asyncio tasks alike.
+Bodies streamed after the responder has returned are not timed.
+"""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+
+from sqlalchemy import event
+
+import settings
+
+PHASES = ('db', 'decode', 'projection', 'serialize')
+
+
+class Timings(object):
+    """
+    Phase timings (in seconds) of a request. Phases are exclusive: a nested phase (e.g. WKB converted
+    while encoding JSON) pauses the enclosing one, so the phases sum up to at most the request duration.
+    """
+
+    __slots__ = ('phases', 'stack')
+
+    def __init__(self):
+        self.phases = {}
+        self.stack = []
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            current = self.stack[-1]
+            self.phases[current[0]] = self.phases.get(current[0], 0.0) + now - current[1]
+        self.stack.append([name, now])
+
+    def exit(self):
+        now = time.perf_counter()
+        name, start = self.stack.pop()
+        self.phases[name] = self.phases.get(name, 0.0) + now - start
+        if self.stack:
+            self.stack[-1][1] = now
+
+
+# Timings of the current request, None out of a request
+_timings = ContextVar('gis_polygon_timings', default=None)
+
+
+@contextmanager
+def phase(name):
+    """
+    Add the time spent within the block to the phase of the current request.
+    :param name: one of PHASES
+    :return:
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    timings.enter(name)
+    try:
+        yield
+    finally:
+        timings.exit()
+
+
+def current_phases():
+    """
+    Phase timings (in seconds) of the current request so far, None out of a request.
+    :return:
+    """
+    timings = _timings.get()
+    return dict(timings.phases) if timings is not None else None
+
+
+def timed(name):
+    """
+    Decorator adding the time spent by the function to the phase of the current request,
+    cheap enough for per row functions.
+    :param name: one of PHASES
+    :return:
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = _timings.get()
+            if timings is None:
+                return func(*args, **kwargs)
+
+            timings.enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.exit()
+
+        return wrapper
+
+    return decorator
+
+
+class Histogram(object):
+    """
+    Prometheus histogram with labels, cumulative bucket counts are computed on rendering.
+    """
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._lock = Lock()
+        self._series = {}
+
+    def observe(self, labels, value):
+        """
+        :param labels: tuple of (label, value) pairs
+        :param value:
+        :return:
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        """
+        Histogram in Prometheus text exposition format.
+        :return:
+        """
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in sorted(self._series.items())]
+
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        for labels, counts, total in series:
+            label_text = ','.join('%s="%s"' % (label, value) for label, value in labels)
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                count += bucket_count
+                lines.append('%s_bucket{%s,le="%s"} %s' % (self.name, label_text,
+                                                           '+Inf' if bound == float('inf') else repr(bound), count))
+            lines.append('%s_sum{%s} %r' % (self.name, label_text, total))
+            lines.append('%s_count{%s} %s' % (self.name, label_text, count))
+        return '\n'.join(lines) + '\n'
+
+
+request_duration = Histogram('gis_polygon_request_duration_seconds',
+                             'Request duration by route, method and phase (total for the whole request).',
+                             settings.METRICS_BUCKETS)
+
+
+def render():
+    """
+    All the metrics of the worker in Prometheus text exposition format.
+    :return:
+    """
+    return request_duration.render()
+
+
+def instrument_engine(engine):
+    """
+    Time SQL statements executed by the (sync) engine into the db phase.
+    :param engine:
+    :return:
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        timings = _timings.get()
+        if timings is not None:
+            timings.enter('db')
+            conn.info['gis_polygon_timings'] = timings
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        timings = conn.info.pop('gis_polygon_timings', None)
+        if timings is not None:
+            timings.exit()
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        timings = context.connection.info.pop('gis_polygon_timings', None) if context.connection is not None else None
+        if timings is not None:
+            timings.exit()
+
+
+def server_timing(timings, total):
+    """
+    Server-Timing header value of the phase timings.
+    :param timings: seconds by phase
+    :param total: seconds spent by the whole request
+    :return:
+    """
+    return ', '.join('%s;dur=%.3f' % (name, seconds * 1e3)
+                     for name, seconds in list(timings.items()) + [('total', total)])
+
+
+class Metrics(object):
+    """
+    Falcon middleware timing requests by phase into request_duration histogram and Server-Timing header.
+    """
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = time.perf_counter()
+        req.context.metrics_token = _timings.set(Timings())
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = getattr(req.context, 'metrics_start', None)
+        if start is None:
+            return
+
+        total = time.perf_counter() - start
+        timings = _timings.get().phases
+        _timings.reset(req.context.metrics_token)
+
+        route = req.uri_template or 'unmatched'
+        for name, seconds in timings.items():
+            request_duration.observe((('route', route), ('method', req.method), ('phase', name)), seconds)
+        request_duration.observe((('route', route), ('method', req.method), ('phase', 'total')), total)
+
+        resp.set_header('Server-Timing', server_timing(timings, total))
+
+
+class AsyncMetrics(Metrics):
+    """
+    Metrics for falcon.asgi.App.
+    """
+
+    async def process_request(self, req, resp):
+        super(AsyncMetrics, self).process_request(req, resp)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        super(AsyncMetrics, self).process_response(req, resp, resource, req_succeeded)
@@ -5,20 +5,79 @@
 Middlware to allow on the fly conversion between two coordinate systems (CSs).
 """
 
-from functools import partial
+from functools import lru_cache
 
+import numpy as np
 import pyproj
 from shapely import wkt
-from shapely.ops import transform
+from shapely.geometry import Polygon
+
+import settings
 
 
 # TODO: Grab in/out Proj from DB or request
 # pyproj.Proj(init='epsg:' + str(srid))
 # pyproj.Proj(init='epsg:' + str(req_srid)))
 
+@lru_cache(maxsize=settings.TRANSFORMER_CACHE_SIZE)
+def get_transformer(in_proj, out_proj):
+    """
+    Prepared transformer between two coordinate systems, built once per worker and (in_proj, out_proj) pair.
+    Coordinates are always in (x, y) i.e. (lon, lat) order as with the former pyproj.Proj(init=...).
+    :param in_proj:
+    :param out_proj:
+    :return:
+    """
+    return pyproj.Transformer.from_crs(in_proj, out_proj, always_xy=True)
+
+
+def ring_coords(ring):
+    """
+    (x, y) coordinates of the ring as NumPy array of shape (n, 2).
+    :param ring:
+    :return:
+    """
+    return np.array(ring.coords, dtype=float).reshape(-1, 3 if ring.has_z else 2)[:, :2]
+
+
+def transform_polygons(polygons, transformer):
+    """
+    Project the coordinate rings of all the polygons concatenated into a single NumPy array in one transformer call.
+    :param polygons:
+    :param transformer:
+    :return:
+    """
+    rings = [[ring_coords(ring) for ring in [polygon.exterior] + list(polygon.interiors)] for polygon in polygons]
+    flat_rings = [ring for polygon_rings in rings for ring in polygon_rings]
+    if not flat_rings:
+        return []
+
+    coords = np.concatenate(flat_rings)
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    projected = np.split(np.column_stack([x, y]), np.cumsum([len(ring) for ring in flat_rings])[:-1])
+
+    result = []
+    start = 0
+    for polygon_rings in rings:
+        shell, *holes = projected[start:start + len(polygon_rings)]
+        result.append(Polygon(shell, holes))
+        start += len(polygon_rings)
+    return result
+
+
+def transform_polygon(polygon, transformer):
+    """
+    Project all the coordinate rings of the polygon as a single NumPy array in one transformer call.
+    :param polygon:
+    :param transformer:
+    :return:
+    """
+    return transform_polygons([polygon], transformer)[0]
+
+
 def cs_transform(polygon_wkt, in_proj=None, out_proj=None):
     """
-    Transform between two coordinate systems defined by the Proj instances.
+    Transform between two coordinate systems defined by the Proj strings.
     :param in_proj:
     :param out_proj:
     :param polygon:
@@ -29,19 +88,22 @@ def cs_transform(polygon_wkt, in_proj=None, out_proj=None):
 
     polygon = wkt.loads(polygon_wkt)
 
-    in_proj = pyproj.Proj(init=in_proj)
-    out_proj = pyproj.Proj(init=out_proj)
     # TODO: Check if polygon is correctly specified
-    project_db_to_req = partial(pyproj.transform, in_proj, out_proj)
-
     # Apply projection transform to Polygon 'pol' and convert to wkt
-    return transform(project_db_to_req, polygon).to_wkt()
+    return transform_polygon(polygon, get_transformer(in_proj, out_proj)).wkt
 
-    # print(pol.area)  # Area in square meters
-    # print(pol2.area)
 
+def cs_transform_many(polygons_wkt, in_proj=None, out_proj=None):
+    """
+    Transform a batch of polygons between two coordinate systems with a single vectorized projection.
+    :param polygons_wkt:
+    :param in_proj:
+    :param out_proj:
+    :return:
+    """
+    in_proj = 'epsg:4326' if in_proj is None else in_proj
+    out_proj = 'epsg:32644' if out_proj is None else out_proj
+
+    polygons = [wkt.loads(polygon_wkt) for polygon_wkt in polygons_wkt]
 
-    # from geoalchemy2.shape import to_shape, from_shape
-    # wkb_element = from_shape(pol, srid=4326)
-    #
-    # to_shape(wkb_element)
+    return [polygon.wkt for polygon in transform_polygons(polygons, get_transformer(in_proj, out_proj))]
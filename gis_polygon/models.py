@@ -10,14 +10,29 @@ from datetime import datetime
 from geoalchemy2.elements import WKBElement
 from geoalchemy2.shape import to_shape
 from geoalchemy2.types import Geometry
-from sqlalchemy import create_engine, Column, String, TIMESTAMP, JSON, INTEGER
+from sqlalchemy import cast, create_engine, func, BigInteger, Boolean, Column, Float, ForeignKey, Index, String, \
+    TIMESTAMP, JSON, INTEGER
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 
 import settings
+from .metrics import timed
 
 Base = declarative_base()
 
 
+@timed('decode')
+def wkb_to_wkt(element):
+    """
+    WKT of WKBElement geometry.
+    :param element:
+    :return:
+    """
+    geom = to_shape(element)
+    # Shapely 2 has dropped to_wkt
+    return geom.to_wkt() if hasattr(geom, 'to_wkt') else geom.wkt
+
+
 def serialize(x):
     """
     Handles json dumps of datetime/WKBElement objects in str format.
@@ -28,21 +43,28 @@ def serialize(x):
     if isinstance(x, datetime):
         return x.isoformat()
     if isinstance(x, WKBElement):
-        return to_shape(x).to_wkt()
+        return wkb_to_wkt(x)
     return x
 
 
+# PostGIS encoders for the geom column, allowing to skip WKB -> Shapely -> str conversion in python on reads
+GEOM_FORMATS = {
+    'wkt': func.ST_AsText,
+    'geojson': func.ST_AsGeoJSON,
+    'wkb': lambda geom: func.encode(func.ST_AsBinary(geom), 'hex'),
+    'ewkb': lambda geom: func.encode(func.ST_AsEWKB(geom), 'hex'),
+}
+
+
 class GISPolygon(Base):
     """
     GeoAlchemy GIS Polygon data model for the CRUD API.
     """
     __tablename__ = 'gis_polygon'
 
-    now = datetime.utcnow()
-
-    _created = Column(TIMESTAMP, nullable=False, default=now.strftime(format='%Y-%m-%dT%H:%M:%S'))
-    _updated = Column(TIMESTAMP, nullable=False, default=now.strftime(format='%Y-%m-%dT%H:%M:%S'),
-                      onupdate=datetime.utcnow().strftime(format='%Y-%m-%dT%H:%M:%S'))
+    # evaluated on every write, _updated serves as the row version
+    _created = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+    _updated = Column(TIMESTAMP, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     id = Column(INTEGER, primary_key=True)
     class_id = Column(INTEGER, default=1)
     name = Column(String)
@@ -64,6 +86,80 @@ class GISPolygon(Base):
         """
         return {c.name: serialize(getattr(self, c.name)) for c in self.__table__.columns}
 
+    @classmethod
+    def encoded_columns(cls, geom_format='wkt', geom=None):
+        """
+        Table columns to select with geom encoded into a string by PostGIS.
+        :param geom_format: one of GEOM_FORMATS
+        :param geom: SQL expression to select instead of geom column itself, e.g. its simplified version
+        :return:
+        """
+        encode = GEOM_FORMATS[geom_format]
+        geom = cls.geom if geom is None else geom
+        return [encode(geom).label(c.name) if c.name == 'geom' else c for c in cls.__table__.columns]
+
+
+class GISPolygonLOD(Base):
+    """
+    Topology preserving simplified versions (levels of detail) of GISPolygon geometry,
+    one per tolerance (in degrees) of settings.LOD_TOLERANCES.
+    """
+    __tablename__ = 'gis_polygon_lod'
+
+    gis_polygon_id = Column(INTEGER, ForeignKey('gis_polygon.id', ondelete='CASCADE'), primary_key=True)
+    tolerance = Column(Float, primary_key=True)
+    geom = Column(Geometry(geometry_type='POLYGON', srid=4326, spatial_index=False))
+
+
+class GISPolygonClassStats(Base):
+    """
+    Summary of GISPolygons of a class_id maintained on writes (see stats.py): count, geodesic area (m2),
+    area weighted sums of centroids coordinates (centroid = area_x / area, area_y / area) and extent.
+    """
+    __tablename__ = 'gis_polygon_class_stats'
+
+    class_id = Column(INTEGER, primary_key=True, autoincrement=False)
+    count = Column(BigInteger, nullable=False)
+    area = Column(Float, nullable=False)
+    area_x = Column(Float, nullable=False)
+    area_y = Column(Float, nullable=False)
+    min_x = Column(Float)
+    min_y = Column(Float)
+    max_x = Column(Float)
+    max_y = Column(Float)
+
+
+class GISPolygonChange(Base):
+    """
+    Change log of GISPolygons for the change feed (see changes.py): the id of the transaction which has
+    written each gis_polygon last, deleted gis_polygons are kept as tombstones.
+    """
+    __tablename__ = 'gis_polygon_change'
+
+    gis_polygon_id = Column(INTEGER, primary_key=True, autoincrement=False)
+    xid = Column(BigInteger, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    _updated = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+
+
+# Change feed keyset pagination in the order of the writing transactions
+Index('idx_gis_polygon_change_xid', GISPolygonChange.xid, GISPolygonChange.gis_polygon_id)
+
+# Class summaries recomputation and class_id filters
+Index('idx_gis_polygon_class_id', GISPolygon.class_id)
+
+# Attribute filters and sorts of the list (see filters.py): name prefix (LIKE whatever the collation is),
+# keyset pagination by (column, id), class_id with _updated range, props JSON containment
+Index('idx_gis_polygon_name_pattern', GISPolygon.name, postgresql_ops={'name': 'text_pattern_ops'})
+Index('idx_gis_polygon_name_id', GISPolygon.name, GISPolygon.id)
+Index('idx_gis_polygon_created_id', GISPolygon._created, GISPolygon.id)
+Index('idx_gis_polygon_updated_id', GISPolygon._updated, GISPolygon.id)
+Index('idx_gis_polygon_class_id_updated', GISPolygon.class_id, GISPolygon._updated)
+Index('idx_gis_polygon_props', cast(GISPolygon.props, JSONB), postgresql_using='gin')
+
+# Spatial index for distance in meters queries, geom itself is indexed by GeoAlchemy (idx_gis_polygon_geom)
+Index('idx_gis_polygon_geography', func.geography(GISPolygon.geom), postgresql_using='gist')
+
 
 if __name__ == "__main__":
     engine = create_engine(settings.DB_PATH)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Opt-in request profiling (settings.PROFILE_ENABLED) for the WSGI and ASGI applications.
+
+A request is profiled by cProfile if it carries settings.PROFILE_HEADER with settings.PROFILE_SECRET
+or is sampled at settings.PROFILE_SAMPLE_RATE. SQL statements of every request are recorded as well
+(with their durations), so requests slower than settings.PROFILE_SLOW_SECONDS are captured even
+if they have not been profiled. Captures are kept in a ring buffer of settings.PROFILE_BUFFER_SIZE
+per worker, listed and downloaded on /gis_polygon/profiles.
+The ASGI application captures SQL statements and timings only, without cProfile.
+"""
+
+import cProfile
+import io
+import marshal
+import pstats
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from itertools import count
+from threading import Lock
+
+from sqlalchemy import event
+
+import settings
+from .metrics import current_phases
+
+# SQL statements of the current request as [statement, seconds], None out of a request
+_statements = ContextVar('gis_polygon_statements', default=None)
+
+
+class CaptureBuffer(object):
+    """
+    Ring buffer of the latest captures, the oldest ones are dropped once it is full.
+    """
+
+    def __init__(self, size):
+        self._lock = Lock()
+        self._ids = count(1)
+        self._captures = deque(maxlen=size)
+
+    def add(self, capture):
+        with self._lock:
+            capture['id'] = next(self._ids)
+            self._captures.append(capture)
+        return capture['id']
+
+    def list(self):
+        """
+        Summaries of the captures, the latest first.
+        :return:
+        """
+        with self._lock:
+            captures = list(self._captures)
+        return [{name: value for name, value in capture.items() if name not in ('statements', 'stats', 'pstats')}
+                for capture in reversed(captures)]
+
+    def get(self, capture_id):
+        with self._lock:
+            for capture in self._captures:
+                if capture['id'] == capture_id:
+                    return capture
+        return None
+
+
+captures = CaptureBuffer(settings.PROFILE_BUFFER_SIZE)
+
+
+def instrument_engine(engine):
+    """
+    Record SQL statements executed by the engine with their durations into the current request.
+    :param engine:
+    :return:
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements = _statements.get()
+        if statements is not None:
+            statements.append([statement, time.perf_counter()])
+            conn.info['gis_polygon_statement'] = statements[-1]
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record = conn.info.pop('gis_polygon_statement', None)
+        if record is not None:
+            record[1] = time.perf_counter() - record[1]
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        connection = context.connection
+        record = connection.info.pop('gis_polygon_statement', None) if connection is not None else None
+        if record is not None:
+            record[1] = time.perf_counter() - record[1]
+
+
+def authorized(req):
+    """
+    Whether the request carries the profiling secret (always False with no secret set).
+    :param req:
+    :return:
+    """
+    return bool(settings.PROFILE_SECRET) and req.get_header(settings.PROFILE_HEADER) == settings.PROFILE_SECRET
+
+
+def profile_stats(profiler):
+    """
+    Profile as text sorted by cumulative time (settings.PROFILE_TOP functions)
+    and as marshalled pstats loadable by pstats/snakeviz.
+    :param profiler:
+    :return:
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(settings.PROFILE_TOP)
+    return stream.getvalue(), marshal.dumps(stats.stats)
+
+
+class Profiler(object):
+    """
+    Falcon middleware profiling the responder of triggered requests and capturing the profiled or slow ones.
+    """
+
+    cprofile = True
+
+    def process_request(self, req, resp):
+        req.context.profile_start = time.perf_counter()
+        req.context.profile_token = _statements.set([])
+
+        if authorized(req):
+            req.context.profile_reason = 'header'
+        elif settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+            req.context.profile_reason = 'sample'
+        else:
+            req.context.profile_reason = None
+
+    def process_resource(self, req, resp, resource, params):
+        # resources may opt out of being profiled, e.g. the one serving the captures
+        if not getattr(resource, 'profiled', True):
+            req.context.profile_start = None
+            _statements.reset(req.context.profile_token)
+            return
+
+        if self.cprofile and getattr(req.context, 'profile_reason', None):
+            req.context.profiler = cProfile.Profile()
+            req.context.profiler.enable()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = getattr(req.context, 'profile_start', None)
+        if start is None:
+            return
+
+        profiler = getattr(req.context, 'profiler', None)
+        if profiler is not None:
+            profiler.disable()
+
+        duration = time.perf_counter() - start
+        statements = _statements.get()
+        _statements.reset(req.context.profile_token)
+
+        reason = req.context.profile_reason
+        if reason is None and settings.PROFILE_SLOW_SECONDS and duration >= settings.PROFILE_SLOW_SECONDS:
+            reason = 'slow'
+        if reason is None:
+            return
+
+        stats, pstats_data = profile_stats(profiler) if profiler is not None else (None, None)
+        capture_id = captures.add({
+            'created': datetime.utcnow().isoformat(),
+            'reason': reason,
+            'method': req.method,
+            'uri': req.relative_uri,
+            'status': resp.status,
+            'duration': duration,
+            'phases': current_phases(),
+            'profiled': profiler is not None,
+            'statements': [{'statement': statement, 'duration': seconds} for statement, seconds in statements or []],
+            'stats': stats,
+            'pstats': pstats_data,
+        })
+        resp.set_header('X-Profile-Id', str(capture_id))
+
+
+class AsyncProfiler(Profiler):
+    """
+    Profiler for falcon.asgi.App. Triggered and slow requests are captured with their SQL statements
+    and phase timings, but not profiled by cProfile: it profiles the calling thread, where the event loop
+    interleaves concurrent requests, while blocking work runs in executor threads.
+    """
+
+    cprofile = False
+
+    async def process_request(self, req, resp):
+        super(AsyncProfiler, self).process_request(req, resp)
+
+    async def process_resource(self, req, resp, resource, params):
+        super(AsyncProfiler, self).process_resource(req, resp, resource, params)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        super(AsyncProfiler, self).process_response(req, resp, resource, req_succeeded)
@@ -5,22 +5,133 @@
 Base Functionality to serialize/deserialize GISPolygon data using marshmallow simple serializer.
 """
 
-from geoalchemy2.shape import to_shape
-from marshmallow import Schema, fields, post_load
+import json
+import re
+import struct
 
-from .models import GISPolygon
+import numpy as np
+from geoalchemy2.elements import WKBElement
+from marshmallow import Schema, ValidationError, fields, post_load
+from shapely import wkb, wkt
+from shapely.geometry import shape
+from shapely.validation import explain_validity
+
+import settings
+from . import geometry_pool
+from .metrics import timed
+from .models import GISPolygon, wkb_to_wkt
+
+try:
+    # vectorized over arrays of geometries since Shapely 2
+    from shapely import is_valid
+except ImportError:
+    is_valid = None
+
+try:
+    from shapely.validation import make_valid
+except ImportError:
+    make_valid = None
+
+HEX = re.compile(r'^[0-9a-fA-F]+$')
+
+# EWKB geometry type flag of the SRID following the type
+EWKB_SRID_FLAG = 0x20000000
+
+
+@timed('decode')
+def parse_geometry(value):
+    """
+    Parse geometry given as WKT, EWKT, GeoJSON (object or string) or hex (E)WKB once into Shapely geometry.
+    :param value:
+    :return: geometry and its SRID, None if not given
+    """
+    if isinstance(value, dict):
+        return shape(value), None
+    if not isinstance(value, str):
+        raise TypeError('Invalid input type.')
+
+    value = value.strip()
+    srid = None
+    if value[:5].upper() == 'SRID=':
+        srid, value = value[5:].split(';', 1)
+        srid = int(srid)
+
+    if value.startswith('{'):
+        return shape(json.loads(value)), srid
+
+    if HEX.match(value):
+        data = bytes.fromhex(value)
+        byte_order = '<' if data[0] == 1 else '>'
+        if struct.unpack_from(byte_order + 'I', data, 1)[0] & EWKB_SRID_FLAG:
+            srid = struct.unpack_from(byte_order + 'I', data, 5)[0]
+        return wkb.loads(data), srid
+
+    return wkt.loads(value), srid
+
+
+@timed('decode')
+def check_geometries(geometries, repair=False):
+    """
+    Check validity of polygons in one batch, optionally repairing the invalid ones.
+    :param geometries: Shapely geometries
+    :param repair: replace invalid polygons with their repaired versions if these are polygons
+    :return: checked geometries (None for the failed ones) and error messages by position of the failed ones
+    """
+    if is_valid is not None:
+        array = np.empty(len(geometries), dtype=object)
+        array[:] = geometries
+        invalid = np.flatnonzero(~is_valid(array)).tolist()
+    else:
+        invalid = [position for position, geometry in enumerate(geometries) if not geometry.is_valid]
+
+    repaired = [None] * len(invalid)
+    if repair and make_valid is not None and invalid:
+        # offloaded to the process pool if large enough
+        repaired = [wkb.loads(geometry) for geometry in geometry_pool.run(
+            geometry_pool.repair, [geometries[position].wkb for position in invalid])]
+
+    checked = list(geometries)
+    errors = {}
+    for position, geometry in zip(invalid, repaired):
+        if geometry is not None and geometry.geom_type == 'Polygon' and not geometry.is_empty:
+            checked[position] = geometry
+            continue
+
+        errors[position] = 'Not a valid geometry: %s.' % explain_validity(checked[position])
+        checked[position] = None
+
+    return checked, errors
+
+
+def as_wkb_element(geometry):
+    """
+    EWKB element of the geometry ready to be bound by SQLAlchemy with no further parsing.
+    :param geometry:
+    :return:
+    """
+    return WKBElement(wkb.dumps(geometry, srid=4326, output_dimension=2), srid=4326, extended=True)
 
 
 class GeometrySerializationField(fields.Field):
     """
-    Custom SQLAlchemy Geometry serializer/deserializer
+    Custom SQLAlchemy Geometry serializer/deserializer.
+
+    Deserializes WKT, EWKT, GeoJSON or hex (E)WKB polygon in EPSG:4326 into WKBElement,
+    invalid polygons are repaired if settings.GEOM_REPAIR is set or rejected otherwise.
+    With check=False validity is left to be checked by the caller, in batch by check_geometries,
+    and parsed Shapely geometry is returned.
     """
 
-    # TODO: Change error message if geometry is incorrect
     default_error_messages = {
         'invalid': 'Not a valid geometry.',
+        'type': 'Polygon geometry is expected.',
+        'srid': 'Geometry in SRID 4326 is expected.',
     }
 
+    def __init__(self, check=True, **kwargs):
+        super(GeometrySerializationField, self).__init__(**kwargs)
+        self.check = check
+
     # TODO: use WKBElement serialization/deserialization
     def _serialize(self, value, attr, obj):
         if value is None:
@@ -30,19 +141,47 @@ class GeometrySerializationField(fields.Field):
             #     return to_shape(value)
             # else:
             #     return None
-            return ''.join(['SRID=4326;', to_shape(value).to_wkt()])  # TODO: Grab in Proj from DB or request
+            return ''.join(['SRID=4326;', wkb_to_wkt(value)])  # TODO: Grab in Proj from DB or request
 
     def _deserialize(self, value, attr, data):
-        """Deserialize an ISO8601-formatted time to a :class:`datetime.time` object."""
+        """Deserialize geometry into WKBElement parsing it once."""
         if not value:  # falsy values are invalid
             self.fail('invalid')
 
-        if isinstance(value, str) and 'POLYGON' in value:
-            try:
-                # return from_shape(loads(value))
-                return value
-            except (AttributeError, TypeError, ValueError):
-                self.fail('invalid')
+        try:
+            geometry, srid = parse_geometry(value)
+        except Exception:
+            self.fail('invalid')
+
+        if geometry.geom_type != 'Polygon' or geometry.is_empty:
+            self.fail('type')
+        if srid not in (None, 4326):
+            self.fail('srid')
+
+        if not self.check:
+            return geometry
+
+        (geometry,), errors = check_geometries([geometry], settings.GEOM_REPAIR)
+        if errors:
+            raise ValidationError(errors[0])
+        return as_wkb_element(geometry)
+
+
+class PropsSerializationField(fields.String):
+    """
+    Free form gis_polygon properties: a string, or a JSON object stored as such
+    (so it can be matched by the `props` filter of the list).
+    """
+
+    def _serialize(self, value, attr, obj):
+        if isinstance(value, dict):
+            return value
+        return super(PropsSerializationField, self)._serialize(value, attr, obj)
+
+    def _deserialize(self, value, attr, data):
+        if isinstance(value, dict):
+            return value
+        return super(PropsSerializationField, self)._deserialize(value, attr, data)
 
 
 class GISPolygonSerializer(Schema):
@@ -51,11 +190,12 @@ class GISPolygonSerializer(Schema):
     """
 
     name = fields.String(required=True)
-    props = fields.String(required=False)
+    props = PropsSerializationField(required=False)
     geom = GeometrySerializationField(required=True)
     class_id = fields.Integer()
-    _created = fields.DateTime(format='%Y-%m-%dT%H:%M:%S')
-    _updated = fields.DateTime(format='%Y-%m-%dT%H:%M:%S')
+    # set by the server only, ignored in the request data
+    _created = fields.DateTime(format='%Y-%m-%dT%H:%M:%S', dump_only=True)
+    _updated = fields.DateTime(format='%Y-%m-%dT%H:%M:%S', dump_only=True)
 
     @post_load
     def make_polygons(self, data):
@@ -65,3 +205,15 @@ class GISPolygonSerializer(Schema):
         :return:
         """
         return GISPolygon(**data)
+
+
+class GISPolygonBulkSerializer(GISPolygonSerializer):
+    """
+    Class to validate GISPolygon data in batches (many=True), leaving it as dicts to be inserted in one statement.
+    Geometries are left parsed but unchecked, to be checked in batch by check_geometries.
+    """
+
+    geom = GeometrySerializationField(required=True, check=False)
+
+    def make_polygons(self, data):
+        return data
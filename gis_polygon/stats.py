@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Per class_id summaries of gis_polygons (count, geodesic area, extent and centroid) kept
+in gis_polygon_class_stats table, maintained incrementally by the writes:
+    - inserted/updated gis_polygons are added by a single INSERT ... SELECT ... ON CONFLICT DO UPDATE
+    - deleted/updated ones are subtracted by their former values returned by the writes, one UPDATE per class,
+      the extent of a class is recomputed only if a subtracted polygon has touched its edge
+
+The centroid of a class is the area weighted centroid of its polygons (of their union for not overlapping ones),
+gis_polygons with no class_id or geometry are not summarized.
+
+Rebuild the table from scratch (after creating it or writing bypassing the API):
+    python -m gis_polygon.stats
+"""
+
+from sqlalchemy import and_, create_engine, func, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+
+import settings
+from .models import GISPolygon, GISPolygonClassStats
+from .tiles import geom_bounds_columns
+
+# Columns of gis_polygon_class_stats filled from the summary select, in its order
+SUMMARY_COLUMNS = ('class_id', 'count', 'area', 'area_x', 'area_y', 'min_x', 'min_y', 'max_x', 'max_y')
+
+INF = float('inf')
+
+
+def stats_columns(geom):
+    """
+    SQL expressions of a gis_polygon geometry summarized: geodesic area (m2), centroid lon, lat and bounds.
+    :param geom:
+    :return:
+    """
+    centroid = func.ST_Centroid(geom)
+    return [func.ST_Area(func.geography(geom)), func.ST_X(centroid), func.ST_Y(centroid)] + geom_bounds_columns(geom)
+
+
+def summary_select(*criteria):
+    """
+    Select of gis_polygons matching criteria summarized by class_id in SUMMARY_COLUMNS order.
+    :param criteria: SQLAlchemy filter clauses
+    :return:
+    """
+    names = ('area', 'x', 'y', 'min_x', 'min_y', 'max_x', 'max_y')
+    polygons = select([GISPolygon.class_id.label('class_id')] +
+                      [column.label(name) for name, column in zip(names, stats_columns(GISPolygon.geom))]) \
+        .where(and_(GISPolygon.class_id.isnot(None), GISPolygon.geom.isnot(None), *criteria)).alias('polygon')
+
+    # sums of empty geometries only (with no centroid) are NULL
+    sums = [func.coalesce(func.sum(column), 0.0)
+            for column in (polygons.c.area, polygons.c.area * polygons.c.x, polygons.c.area * polygons.c.y)]
+    return select([polygons.c.class_id, func.count()] + sums + [
+        func.min(polygons.c.min_x), func.min(polygons.c.min_y),
+        func.max(polygons.c.max_x), func.max(polygons.c.max_y)]).group_by(polygons.c.class_id)
+
+
+def add_class_stats(session, *criteria):
+    """
+    Add gis_polygons matching criteria (as they are now) to the summaries of their classes.
+    :param session:
+    :param criteria: SQLAlchemy filter clauses
+    :return:
+    """
+    table = GISPolygonClassStats.__table__
+    insert = postgresql.insert(table).from_select(SUMMARY_COLUMNS, summary_select(*criteria))
+
+    excluded = insert.excluded
+    insert = insert.on_conflict_do_update(index_elements=['class_id'], set_={
+        'count': table.c.count + excluded.count,
+        'area': table.c.area + excluded.area,
+        'area_x': table.c.area_x + excluded.area_x,
+        'area_y': table.c.area_y + excluded.area_y,
+        'min_x': func.least(table.c.min_x, excluded.min_x),
+        'min_y': func.least(table.c.min_y, excluded.min_y),
+        'max_x': func.greatest(table.c.max_x, excluded.max_x),
+        'max_y': func.greatest(table.c.max_y, excluded.max_y),
+    })
+    session.execute(insert)
+
+
+def remove_class_stats(session, rows):
+    """
+    Subtract gis_polygons from the summaries of their classes by their former values.
+    :param session:
+    :param rows: (class_id, *stats_columns) of the gis_polygons as they were before the write
+    :return:
+    """
+    removed = {}
+    for class_id, area, x, y, min_x, min_y, max_x, max_y in rows:
+        if class_id is None or area is None:
+            continue
+        summary = removed.setdefault(class_id, [0, 0.0, 0.0, 0.0, INF, INF, -INF, -INF])
+        summary[0] += 1
+        if area:
+            summary[1:4] = summary[1] + area, summary[2] + area * x, summary[3] + area * y
+        if min_x is not None:
+            summary[4:] = min(summary[4], min_x), min(summary[5], min_y), max(summary[6], max_x), max(summary[7], max_y)
+
+    table = GISPolygonClassStats.__table__
+    shrunk = []
+    # in class_id order, so concurrent writes lock the summaries in the same order
+    for class_id, (count, area, area_x, area_y, min_x, min_y, max_x, max_y) in sorted(removed.items()):
+        extent = session.execute(table.update().where(table.c.class_id == class_id).values(
+            count=table.c.count - count, area=table.c.area - area,
+            area_x=table.c.area_x - area_x, area_y=table.c.area_y - area_y,
+        ).returning(table.c.count, table.c.min_x, table.c.min_y, table.c.max_x, table.c.max_y)).first()
+
+        if extent is None:
+            continue
+        if extent[0] <= 0:
+            session.execute(table.delete().where(table.c.class_id == class_id))
+        elif None in extent or min_x <= extent[1] or min_y <= extent[2] or max_x >= extent[3] or max_y >= extent[4]:
+            shrunk.append(class_id)
+
+    if shrunk:
+        recompute_extents(session, shrunk)
+
+
+def recompute_extents(session, class_ids):
+    """
+    Recompute extents of the classes from their gis_polygons (by idx_gis_polygon_class_id).
+    :param session:
+    :param class_ids:
+    :return:
+    """
+    min_x, min_y, max_x, max_y = geom_bounds_columns(GISPolygon.geom)
+    extents = select([GISPolygon.class_id.label('class_id'),
+                      func.min(min_x).label('min_x'), func.min(min_y).label('min_y'),
+                      func.max(max_x).label('max_x'), func.max(max_y).label('max_y')]) \
+        .where(GISPolygon.class_id.in_(class_ids)).group_by(GISPolygon.class_id).alias('extent')
+
+    table = GISPolygonClassStats.__table__
+    session.execute(table.update().where(table.c.class_id == extents.c.class_id).values(
+        min_x=extents.c.min_x, min_y=extents.c.min_y, max_x=extents.c.max_x, max_y=extents.c.max_y))
+
+
+def rebuild_class_stats(session):
+    """
+    Recompute the summaries of all the classes from scratch.
+    :param session:
+    :return:
+    """
+    session.execute(GISPolygonClassStats.__table__.delete())
+    add_class_stats(session)
+
+
+def as_dict(row):
+    """
+    JSON ready Dict of a summary row in SUMMARY_COLUMNS order.
+    :param row:
+    :return:
+    """
+    class_id, count, area, area_x, area_y, min_x, min_y, max_x, max_y = row
+    return {
+        'class_id': class_id,
+        'count': count,
+        'area': area,
+        'extent': [min_x, min_y, max_x, max_y],
+        'centroid': [area_x / area, area_y / area] if area else None,
+    }
+
+
+def class_stats(session, *criteria):
+    """
+    Summaries of gis_polygons by class_id ordered by class_id: read from gis_polygon_class_stats
+    with no criteria, computed from the gis_polygons matching criteria otherwise.
+    :param session:
+    :param criteria: SQLAlchemy filter clauses
+    :return:
+    """
+    if criteria:
+        rows = session.execute(summary_select(*criteria).order_by('class_id'))
+    else:
+        table = GISPolygonClassStats.__table__
+        rows = session.execute(select([table.c[name] for name in SUMMARY_COLUMNS]).order_by(table.c.class_id))
+    return [as_dict(row) for row in rows]
+
+
+if __name__ == "__main__":
+    session = sessionmaker(bind=create_engine(settings.DB_PATH))()
+    rebuild_class_stats(session)
+    session.commit()
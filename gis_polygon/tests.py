@@ -1,15 +1,34 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import struct
+from datetime import datetime
+
+import falcon
 import pytest
 from falcon import testing
-from shapely.geometry import Polygon
+from geoalchemy2.shape import from_shape
+from shapely import wkb, wkt
+from shapely.geometry import Polygon, mapping, shape
+from sqlalchemy import true
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker
 
-from .app import api
-from .controllers import datetime_wkb_handler
+from . import formats, geometry_pool, metrics, profiling
+from .app import api, warm_up
+from .benchmarks import make_polygon, percentiles
+from .cache import LRUCache
+from .controllers import GISPolygonCRUD, GISPolygonChanges, GISPolygonList, GISPolygonProfiles
+from .db_session import DBSession, SessionStream
+from .encoders import datetime_wkb_handler, dumps, encode_gis_polygon, encode_created_gis_polygon
+from .filters import bbox_filter, intersects_filter, dwithin_filter, class_filter, name_prefix_filter, range_filter, \
+    props_filter, keyset_filter, sort_order
 from .models import *
-from .serializers import GISPolygonSerializer
+from .serializers import GISPolygonSerializer, check_geometries
+from .stats import as_dict as stats_as_dict, class_stats, rebuild_class_stats
+from .lod import zoom_tolerance
+from .middleware import get_transformer
+from .tiles import invalidate_tiles
 
 try:
     import ujson as json
@@ -44,7 +63,7 @@ def gis_polygon_data():
         u"class_id": 1,
         u"name": u"some_test_polygon",
         u"props": 'None',
-        u"geom": ''.join(['SRID=4326;', p.to_wkt()]),  # TODO: Grab in Proj from DB or request
+        u"geom": ''.join(['SRID=4326;', p.wkt]),  # TODO: Grab in Proj from DB or request
         u"_created": now.strftime(format='%Y-%m-%dT%H:%M:%S'),
         u"_updated": now.strftime(format='%Y-%m-%dT%H:%M:%S')
     }
@@ -100,10 +119,24 @@ def gis_polygon_instance(gis_polygon_data, session, request):
     return gis_polygon_data_serialized
 
 
+@pytest.fixture(params=['wsgi', 'asgi'])
+def client(request):
+    """
+    Shortcut for a TestClient to simulate requests to the WSGI and to the ASGI application.
+    :param request:
+    :return:
+    """
+    if request.param == 'asgi':
+        # not skipped if missing, falcon>=3 and SQLAlchemy>=1.4 are required
+        from .asgi import app
+        return testing.TestClient(app)
+    return testing.TestClient(api)
+
+
 @pytest.fixture
-def client():
+def wsgi_client():
     """
-    Shortcut for a TestClient to simulate requests to a WSGI application.
+    Shortcut for a TestClient to simulate requests to the WSGI application only.
     :return:
     """
     return testing.TestClient(api)
@@ -119,6 +152,21 @@ def _cleanup_gis_polygon(session):
     session.commit()
 
 
+def _post_gis_polygon(client, session, gis_polygon_data):
+    """
+    Create a gis_polygon through the API, POST does not return the id, so it is looked up by the name
+    (to be unique to the test, the latest one is taken if an earlier run left one).
+    :param client:
+    :param session:
+    :param gis_polygon_data:
+    :return: id of the created gis_polygon
+    """
+    result = client.simulate_post('/gis_polygon', body=json.dumps(gis_polygon_data),
+                                  headers={"Content-Type": "application/json"})
+    assert result.status == falcon.HTTP_201, 'gis_polygon has not been created'
+    return session.query(func.max(GISPolygon.id)).filter(GISPolygon.name == gis_polygon_data['name']).scalar()
+
+
 def test_as_dict(session):
     """
     Testing representation of a GeoAlchemy GIS Polygon data model as a dict.
@@ -142,20 +190,26 @@ def test_as_dict(session):
     # _cleanup_gis_polygon(session)
 
 
-def test_create_gis_polygon(client, session):
+def test_create_gis_polygon(client, session, gis_polygon_data):
     """
     Testing Creation, simulating POST request.
     :param client:
     :param session:
+    :param gis_polygon_data:
     :return:
     """
-    doc = gis_polygon_dict = gis_polygon_data()
+    doc = dict(gis_polygon_data)
+    # timestamps are set by the server, the ones sent are ignored
+    gis_polygon_dict = dict(doc, _created='2000-01-01T00:00:00', _updated='2000-01-01T00:00:00')
 
     body = json.dumps(gis_polygon_dict, default=datetime_wkb_handler)
 
     headers = {"Content-Type": "application/json"}
     result = client.simulate_post('/gis_polygon/', body=body, headers=headers).json
     # result.pop('id')
+    for name in ('_created', '_updated'):
+        sent, created = [datetime.strptime(value.pop(name), '%Y-%m-%dT%H:%M:%S') for value in (doc, result)]
+        assert abs((created - sent).total_seconds()) < 60, 'Server has not set %s' % name
     assert result == doc
 
     # _cleanup_gis_polygon(session)
@@ -174,6 +228,28 @@ def test_get_gis_polygon(client, session, gis_polygon_instance):
     assert result == doc, 'No GIS Polygons data was found'
 
 
+def test_get_gis_polygon_geom_format(client, gis_polygon_instance):
+    """
+    Testing Reading with geom encoded by PostGIS.
+    :param client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    polygon = to_shape(gis_polygon_instance.geom)
+
+    result = client.simulate_get('/gis_polygon/%s' % gis_polygon_instance.id, query_string='geom_format=wkt').json
+    assert wkt.loads(result['geom']).equals(polygon), 'Wrong WKT encoded by PostGIS'
+
+    result = client.simulate_get('/gis_polygon/%s' % gis_polygon_instance.id, query_string='geom_format=geojson').json
+    assert shape(json.loads(result['geom'])).equals(polygon), 'Wrong GeoJSON encoded by PostGIS'
+
+    result = client.simulate_get('/gis_polygon/%s' % gis_polygon_instance.id, query_string='geom_format=wkb').json
+    assert wkb.loads(result['geom'], hex=True).equals(polygon), 'Wrong WKB encoded by PostGIS'
+
+    result = client.simulate_get('/gis_polygon/%s' % gis_polygon_instance.id, query_string='geom_format=kml')
+    assert result.status_code == 400, 'Passed unknown geom format'
+
+
 def test_update_gis_polygon(client, gis_polygon_instance):
     body = json.dumps({
         u"class_id": 111,
@@ -187,6 +263,16 @@ def test_update_gis_polygon(client, gis_polygon_instance):
     assert result.json == doc, 'GIS Polygon has not been updated'
 
 
+def test_update_gis_polygon_falsy(client, gis_polygon_instance):
+    headers = {"Content-Type": "application/json"}
+    result = client.simulate_put('/gis_polygon/%s' % gis_polygon_instance.id, body=json.dumps({"class_id": 0}),
+                                 headers=headers)
+    assert result.json == {'status': '200 OK'}, 'GIS Polygon has not been updated'
+
+    result = client.simulate_get('/gis_polygon/%s' % gis_polygon_instance.id)
+    assert result.json['class_id'] == 0, 'Falsy value has not been written'
+
+
 def test_gis_polygon_list(client, session):
     doc = {"status": "The DB is empty, please fill."}
     _cleanup_gis_polygon(session)
@@ -194,6 +280,24 @@ def test_gis_polygon_list(client, session):
     assert result.json == doc, 'No GIS Polygons list was found'
 
 
+def test_gis_polygon_list_page(client, gis_polygon_instance):
+    result = client.simulate_get('/gis_polygon/list',
+                                 query_string='after=%s&limit=1' % (gis_polygon_instance.id - 1))
+
+    assert [p['id'] for p in result.json] == [gis_polygon_instance.id], 'Wrong GIS Polygons page'
+    assert result.headers['X-Next-Cursor'] == str(gis_polygon_instance.id), 'No next page cursor'
+
+    result = client.simulate_get('/gis_polygon/list',
+                                 query_string='after=%s&limit=1' % gis_polygon_instance.id)
+    assert result.json == [], 'Page after the last GIS Polygon is not empty'
+    assert 'X-Next-Cursor' not in result.headers, 'Last page has a next page cursor'
+
+
+def test_gis_polygon_list_stream(client, gis_polygon_instance):
+    result = client.simulate_get('/gis_polygon/list')
+    assert gis_polygon_instance.id in [p['id'] for p in result.json], 'No GIS Polygons list was streamed'
+
+
 def test_delete_gis_polygon(client, gis_polygon_instance):
     doc = {'status': '200 OK'}
 
@@ -223,10 +327,10 @@ def test_404(client):
     assert result3.json == doc, 'Passed a non existent request'
 
 
-def test_400_missed(client):
+def test_400_missed(client, gis_polygon_data):
     doc_missed = {'name': ['Missing data for required field.']}
 
-    data_missed = gis_polygon_data()
+    data_missed = gis_polygon_data
     data_missed.pop('name')
 
     body_missed = json.dumps(data_missed, default=datetime_wkb_handler)
@@ -239,10 +343,10 @@ def test_400_missed(client):
     assert result_missed.json == doc_missed, 'Passed object with missed required fields'
 
 
-def test_400_wrong(client):
+def test_400_wrong(client, gis_polygon_data):
     doc_wrong = {'class_id': ['Not a valid integer.']}
 
-    data_wrong = gis_polygon_data()
+    data_wrong = gis_polygon_data
     data_wrong['class_id'] = 'asldhnaskjdnkjasn'
 
     body_wrong = json.dumps(data_wrong, default=datetime_wkb_handler)
@@ -259,7 +363,7 @@ def test_content_type(client, gis_polygon_data):
     body = json.dumps(gis_polygon_data, default=datetime_wkb_handler)
 
     doc = {'description': 'application/x-www-form-urlencoded is an unsupported media type.',
-           'title': 'Unsupported media type'}
+           'title': '415 Unsupported Media Type'}
 
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
     result = client.simulate_post('/gis_polygon/', body=body, headers=headers)
@@ -278,8 +382,781 @@ def test_get_gis_polygon_transformed(client, gis_polygon_instance):
                    [-1449348.5935858904849738, 14415157.0348221659660339],
                    [-1449292.4849653979763389, 14415159.7974598743021488],
                    [-1449265.8023261826019734, 14415153.2734880037605762],
-                   [-1433556.4349097274243832, 14371297.8913895916193724]]).to_wkt()
+                   [-1433556.4349097274243832, 14371297.8913895916193724]]).wkt
     result = client.simulate_get(path='/gis_polygon/transform',
                                  query_string='id=%s&out_proj=' % gis_polygon_instance.id).json
 
     assert result['geom'] == doc, 'No GIS Polygons data was found'
+
+
+def test_get_gis_polygons_transformed_batch(client, gis_polygon_instance):
+    """
+    Testing Reading a batch of polygons, simulating GET request.
+    :param client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    single = client.simulate_get(path='/gis_polygon/transform',
+                                 query_string='id=%s' % gis_polygon_instance.id).json
+    result = client.simulate_get(path='/gis_polygon/transform',
+                                 query_string='ids=%s,-1' % gis_polygon_instance.id).json
+
+    assert [p['id'] for p in result] == [gis_polygon_instance.id], 'Wrong GIS Polygons batch'
+    assert result[0]['geom'] == single['geom'], 'Batch projection differs from the single one'
+
+
+def test_get_gis_polygon_transformed_engines(client, gis_polygon_instance):
+    """
+    Testing projection by pyproj and by PostGIS give the same result.
+    :param client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    results = [client.simulate_get(path='/gis_polygon/transform',
+                                   query_string='id=%s&engine=%s' % (gis_polygon_instance.id, engine)).json
+               for engine in ('python', 'postgis')]
+
+    assert wkt.loads(results[0]['geom']).equals_exact(wkt.loads(results[1]['geom']), 1e-3), \
+        'Projection engines results differ'
+
+
+def test_bulk_create_gis_polygons(client, session, gis_polygon_data):
+    """
+    Testing bulk Creation, simulating POST request of NDJSON with a broken record.
+    :param client:
+    :param session:
+    :param gis_polygon_data:
+    :return:
+    """
+    data_missed = dict(gis_polygon_data)
+    data_missed.pop('name')
+    feature = {"type": "Feature", "properties": {"name": "some_test_feature", "class_id": 2},
+               "geometry": mapping(wkt.loads(gis_polygon_data['geom'].split(';')[1]))}
+
+    body = '\n'.join(json.dumps(record) for record in [gis_polygon_data, data_missed, feature])
+
+    headers = {"Content-Type": "application/x-ndjson"}
+    result = client.simulate_post('/gis_polygon/bulk', body=body, headers=headers)
+
+    assert result.json == {'inserted': 2, 'errors': {'1': {'name': ['Missing data for required field.']}}}, \
+        'Wrong bulk creation result'
+    assert session.query(GISPolygon).filter(GISPolygon.name == 'some_test_feature').count() == 1, \
+        'GeoJSON Feature has not been created'
+
+    body = json.dumps([gis_polygon_data])
+    result = client.simulate_post('/gis_polygon/bulk', body=body, headers={"Content-Type": "application/json"})
+    assert result.json == {'inserted': 1, 'errors': {}}, 'JSON array has not been created'
+
+
+def test_session_stream_closes_session():
+    class Session(object):
+        closed = 0
+
+        def close(self):
+            self.closed += 1
+
+    session = Session()
+    stream = SessionStream(session, GISPolygonList.stream_gis_polygons([]))
+    stream.close()
+    assert session.closed == 1, 'Session of a body closed unread has not been closed'
+
+    session = Session()
+    assert b''.join(SessionStream(session, [b'[', b']'])) == b'[]'
+    assert session.closed == 1, 'Session of an exhausted body has not been closed'
+
+
+def test_blocking_stream_closes_session():
+    import asyncio
+    from .asgi import BlockingStream
+
+    class Session(object):
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    session = Session()
+    stream = BlockingStream(SessionStream(session, GISPolygonChanges.stream_changes(iter([]))))
+    # a loop of its own, asyncio.run would unset the one of the test client
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(stream.close())
+    finally:
+        loop.close()
+    assert session.closed, 'Session of an ASGI body closed unread has not been closed'
+
+
+def test_async_session_stream_closes_session():
+    import asyncio
+    from .asgi import AsyncGISPolygonList, AsyncSessionStream
+
+    class Session(object):
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    async def chunks():
+        yield []
+
+    session = Session()
+    stream = AsyncSessionStream(session, AsyncGISPolygonList.stream_async(formats.JSON, [], chunks()))
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(stream.close())
+    finally:
+        loop.close()
+    assert session.closed, 'Session of an ASGI list body closed unread has not been closed'
+
+
+def test_written_values_skip_server_set():
+    data = {u"name": u"renamed", u"class_id": 0, u"_updated": u"2000-01-01T00:00:00"}
+    gis_polygon = GISPolygonSerializer(strict=True).load(data=data, partial=True).data
+
+    assert GISPolygonCRUD.written_values(gis_polygon, data) == {'name': 'renamed', 'class_id': 0}, \
+        'Values set by the server have been written'
+
+
+def test_session_scoped_to_request(wsgi_client, gis_polygon_instance):
+    """
+    Testing DB Session is removed after the request and the connection is returned to the pool.
+    :param wsgi_client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    wsgi_client.simulate_get('/gis_polygon/%s' % gis_polygon_instance.id)
+    assert not DBSession.registry.has(), 'DB Session has not been removed'
+
+    result = wsgi_client.simulate_get('/gis_polygon/status').json
+    assert result['pool']['checked_out'] == 0, 'DB connection has not been returned to the pool'
+    assert result['pool']['checkouts'] > 0, 'No DB connection checkouts were counted'
+    assert result['geom_pool']['queued'] == 0, 'Geometry process pool jobs are left queued'
+
+
+def _explain(session, query):
+    """
+    Query plan of the query with sequential scans discouraged, so tiny test tables still show the index usage.
+    :param session:
+    :param query:
+    :return:
+    """
+    # with bound parameters, as not every type (JSONB) can be rendered as a literal
+    statement = query.statement.compile(dialect=session.bind.dialect)
+    session.execute('SET LOCAL enable_seqscan = off')
+    plan = '\n'.join(row[0] for row in session.connection().execute('EXPLAIN %s' % statement, statement.params))
+    session.rollback()
+    return plan
+
+
+def test_search_gis_polygons(client, gis_polygon_instance):
+    result = client.simulate_get('/gis_polygon/search',
+                                 query_string='bbox=-73.1,47.3,-73,47.8&intersects=POINT(-73.08 47.5)'
+                                              '&dwithin=-73.08,47.5,10').json
+    assert gis_polygon_instance.id in [p['id'] for p in result], 'No GIS Polygons were found'
+
+    result = client.simulate_get('/gis_polygon/search', query_string='bbox=0,0,1,1').json
+    assert gis_polygon_instance.id not in [p['id'] for p in result], 'GIS Polygons out of bbox were found'
+
+
+def test_search_uses_spatial_index(session):
+    for criterion in [bbox_filter(-73.1, 47.3, -73, 47.8),
+                      intersects_filter('POINT(-73.08 47.5)'),
+                      dwithin_filter(-73.08, 47.5, 10)]:
+        plan = _explain(session, session.query(GISPolygon.id).filter(criterion))
+
+        assert 'Seq Scan' not in plan and 'idx_gis_polygon_' in plan, 'Spatial index is not used:\n%s' % plan
+
+
+@pytest.mark.parametrize('criterion, index', [
+    (class_filter(3), 'idx_gis_polygon_class_id'),
+    (name_prefix_filter('some_'), 'idx_gis_polygon_name'),
+    (range_filter(GISPolygon._created, '2020-01-01T00:00:00', '2020-01-02T00:00:00'), 'idx_gis_polygon_created_id'),
+    (range_filter(GISPolygon._updated, '2020-01-01T00:00:00'), 'idx_gis_polygon_updated_id'),
+    (props_filter('{"key": "value"}'), 'idx_gis_polygon_props'),
+], ids=['class_id', 'name', 'created', 'updated', 'props'])
+def test_list_filter_uses_index(session, criterion, index):
+    plan = _explain(session, session.query(GISPolygon.id).filter(criterion))
+
+    assert 'Seq Scan' not in plan and index in plan, 'Index is not used:\n%s' % plan
+
+
+def test_props_filter_bound_as_text():
+    compiled = props_filter('{"key": "value"}').compile(dialect=postgresql.dialect())
+    [name] = compiled.params
+    bind = compiled.binds[name]
+    processor = bind.type.bind_processor(compiled.dialect)
+
+    assert (processor(bind.value) if processor else bind.value) == '{"key": "value"}', 'props are encoded twice'
+
+
+@pytest.mark.parametrize('sort, after', [
+    (('name', False), ('some', 1)),
+    (('_created', False), ('2020-01-01T00:00:00', 1)),
+    (('_updated', True), ('2020-01-01T00:00:00', 1)),
+], ids=['name', 'created', 'updated_desc'])
+def test_list_sort_uses_index(session, sort, after):
+    query = session.query(GISPolygon.id).filter(keyset_filter(sort[0], sort[1], after)) \
+        .order_by(*sort_order(*sort)).limit(10)
+    plan = _explain(session, query)
+
+    assert 'Seq Scan' not in plan and 'Sort' not in plan and 'idx_gis_polygon_%s' % sort[0].strip('_') in plan, \
+        'Sort is not read from index:\n%s' % plan
+
+
+def test_gis_polygon_list_filter_sort(client, session, gis_polygon_data):
+    """
+    Testing attribute filters and keyset pagination in a sort order of the list.
+    :param client:
+    :param session:
+    :param gis_polygon_data:
+    :return:
+    """
+    _cleanup_gis_polygon(session)
+    headers = {"Content-Type": "application/json"}
+    for name in ['b_polygon', 'a_polygon', 'c_polygon', 'other']:
+        client.simulate_post('/gis_polygon', headers=headers, body=json.dumps(
+            dict(gis_polygon_data, name=name, props={"kind": name[0]}, class_id=3)))
+
+    query_string = 'class_id=3&name=%25_polygon&sort=-name'
+    assert client.simulate_get('/gis_polygon/list', query_string=query_string).json == [], \
+        'LIKE wildcards of the name prefix are not escaped'
+
+    result = client.simulate_get('/gis_polygon/list', query_string='class_id=3&updated_after=2000-01-01T00:00:00'
+                                                                   '&props={"kind":"a"}')
+    assert [p['name'] for p in result.json] == ['a_polygon'], 'Wrong gis_polygons of the props'
+
+    names, after = [], None
+    while True:
+        query_string = 'class_id=3&sort=-name&limit=2' + ('&after=%s' % after if after else '')
+        result = client.simulate_get('/gis_polygon/list', query_string=query_string)
+        names += [p['name'] for p in result.json]
+        after = result.headers.get('X-Next-Cursor')
+        if after is None:
+            break
+    assert names == ['other', 'c_polygon', 'b_polygon', 'a_polygon'], 'Wrong keyset pagination in name order'
+
+    result = client.simulate_get('/gis_polygon/list', query_string='name=_poly&updated_before=2000-01-01T00:00:00')
+    assert result.json == [], 'Filtered out gis_polygons have been listed'
+
+
+def test_list_cursor():
+    gis_polygon = GISPolygon(id=5, name=u'some_polygon', _updated=datetime(2020, 1, 2, 3, 4, 5, 6))
+    for sort, expected in [(('id', False), 5), (('name', True), (u'some_polygon', 5)),
+                           (('_updated', False), (datetime(2020, 1, 2, 3, 4, 5, 6), 5))]:
+        req = falcon.Request(testing.create_environ(
+            query_string='after=%s' % GISPolygonList.next_cursor(gis_polygon, sort)))
+        assert GISPolygonList.get_after(req, sort) == expected, 'Cursor of %s sort has not been decoded' % sort[0]
+
+    req = falcon.Request(testing.create_environ(query_string='sort=-size'))
+    with pytest.raises(falcon.HTTPInvalidParam):
+        GISPolygonList.get_sort(req)
+
+    serializer = GISPolygonSerializer(strict=True)
+    data = serializer.load({'name': 'some_polygon', 'props': {'key': 'value'}, 'geom': 'POLYGON((0 0, 1 0, 1 1, 0 0))'})
+    assert data.data.props == {'key': 'value'}, 'JSON object props have not been kept'
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set(1, 'a')
+    cache.set(2, 'b')
+    cache.get(1)
+    cache.set(3, 'c', version=1)
+
+    assert cache.get(2) is None, 'Least recently used entry has not been evicted'
+    assert cache.get(1) == 'a', 'Recently used entry has been evicted'
+    assert cache.get(3, version=2) is None, 'Stale entry has been returned'
+    assert cache.stats() == {'size': 1, 'maxsize': 2, 'hits': 2, 'misses': 2, 'evictions': 1, 'expirations': 1}
+
+
+def test_get_gis_polygon_cached(client, gis_polygon_instance, monkeypatch):
+    monkeypatch.setattr(GISPolygonCRUD, 'cache', LRUCache(10))
+    path = '/gis_polygon/%s' % gis_polygon_instance.id
+    headers = {"Content-Type": "application/json"}
+
+    first = client.simulate_get(path).json
+    second = client.simulate_get(path).json
+    assert second == first and GISPolygonCRUD.cache.hits == 1, 'GIS Polygon has not been cached'
+
+    client.simulate_put(path, body=json.dumps({u"name": u"some_renamed_polygon"}), headers=headers)
+    result = client.simulate_get(path).json
+    assert result['name'] == 'some_renamed_polygon', 'Cached GIS Polygon has not been invalidated'
+
+
+def test_get_gis_polygon_cached_by_numeric_id(client, gis_polygon_instance, monkeypatch):
+    monkeypatch.setattr(GISPolygonCRUD, 'cache', LRUCache(10))
+    padded_path = '/gis_polygon/%03d' % gis_polygon_instance.id
+    headers = {"Content-Type": "application/json"}
+
+    client.simulate_get(padded_path)
+    client.simulate_put('/gis_polygon/%s' % gis_polygon_instance.id,
+                        body=json.dumps({u"name": u"some_renamed_polygon"}), headers=headers)
+    result = client.simulate_get(padded_path).json
+    assert result['name'] == 'some_renamed_polygon', 'Zero-padded id cache entry has not been invalidated'
+
+
+def test_get_gis_polygon_not_modified(client, gis_polygon_instance):
+    """
+    Testing conditional GET by ETag, simulating GET requests with If-None-Match.
+    :param client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    path = '/gis_polygon/%s' % gis_polygon_instance.id
+    etag = client.simulate_get(path).headers['ETag']
+
+    result = client.simulate_get(path, headers={'If-None-Match': etag})
+    assert result.status_code == 304 and not result.content, 'Unchanged GIS Polygon has been sent again'
+
+    client.simulate_put(path, body=json.dumps({u"class_id": 222}), headers={"Content-Type": "application/json"})
+    result = client.simulate_get(path, headers={'If-None-Match': etag})
+    assert result.status_code == 200 and result.headers['ETag'] != etag, 'Updated GIS Polygon has not been sent'
+
+    for path, query_string in [('/gis_polygon/list', 'limit=10'),
+                               ('/gis_polygon/transform', 'id=%s' % gis_polygon_instance.id)]:
+        etag = client.simulate_get(path, query_string=query_string).headers['ETag']
+        result = client.simulate_get(path, query_string=query_string, headers={'If-None-Match': etag})
+        assert result.status_code == 304, 'Unchanged %s has been sent again' % path
+
+    # a page changes with any of its gis_polygons
+    query_string = 'limit=1&after=%s' % (gis_polygon_instance.id - 1)
+    etag = client.simulate_get('/gis_polygon/list', query_string=query_string).headers['ETag']
+    client.simulate_put('/gis_polygon/%s' % gis_polygon_instance.id, body=json.dumps({u"class_id": 333}),
+                        headers={"Content-Type": "application/json"})
+    result = client.simulate_get('/gis_polygon/list', query_string=query_string, headers={'If-None-Match': etag})
+    assert result.status_code == 200, 'Page of an updated GIS Polygon has not been sent'
+
+
+def test_gis_polygon_tiles(client, gis_polygon_instance):
+    """
+    Testing vector tiles rendering, simulating GET request of the tile covering the polygon and an empty one.
+    :param client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    result = client.simulate_get('/gis_polygon/tiles/8/76/89.mvt')
+    assert result.status_code == 200 and result.content, 'GIS Polygon has not been rendered into the tile'
+    assert result.headers['Content-Type'] == 'application/vnd.mapbox-vector-tile'
+
+    result = client.simulate_get('/gis_polygon/tiles/8/0/0.mvt')
+    assert result.status_code == 200 and not result.content, 'Tile out of GIS Polygon is not empty'
+
+    result = client.simulate_get('/gis_polygon/tiles/1/2/0.mvt')
+    assert result.status_code == 404, 'Passed a non existent tile'
+
+
+def test_invalidate_tiles():
+    cache = LRUCache(10)
+    for key in [(0, 0, 0), (8, 76, 89), (8, 0, 0)]:
+        cache.set(key, b'tile')
+
+    invalidate_tiles(cache, None, (-73.08, 47.36, -73.07, 47.76))
+    assert sorted(cache.keys()) == [(8, 0, 0)], 'Tiles covering the GIS Polygon have not been invalidated'
+
+
+def test_get_gis_polygon_simplified(client, gis_polygon_instance):
+    """
+    Testing Reading of simplified geom, precomputed by zoom and on the fly by an arbitrary tolerance.
+    :param client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    path = '/gis_polygon/%s' % gis_polygon_instance.id
+    polygon = to_shape(gis_polygon_instance.geom)
+
+    for query_string in ['zoom=2', 'simplify=0.01', 'simplify=0.0123']:
+        result = client.simulate_get(path, query_string=query_string).json
+        simplified = wkt.loads(result['geom'])
+        assert len(simplified.exterior.coords) <= len(polygon.exterior.coords), 'GIS Polygon has not been simplified'
+        assert simplified.is_valid, 'Simplified GIS Polygon is not valid'
+
+    for query_string in ['simplify=0', 'simplify=abc', 'zoom=23']:
+        result = client.simulate_get(path, query_string=query_string)
+        assert result.status_code == 400, 'Passed a wrong simplify tolerance %s' % query_string
+
+
+def test_zoom_tolerance():
+    assert zoom_tolerance(0) == 0.01, 'Not the coarsest precomputed tolerance finer than a pixel'
+    assert zoom_tolerance(10) == 0.001
+    assert zoom_tolerance(22) is None, 'No precomputed tolerance is finer than a pixel at zoom 22'
+
+
+def test_gis_polygons_binary_formats(client, gis_polygon_instance):
+    """
+    Testing content negotiation of the list, search and transform into Arrow IPC and FlatGeobuf.
+    :param client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    pyarrow = pytest.importorskip('pyarrow')
+    polygon = to_shape(gis_polygon_instance.geom)
+
+    for path, query_string in [('/gis_polygon/list', None), ('/gis_polygon/list', 'limit=10'),
+                               ('/gis_polygon/search', 'bbox=-180,-90,180,90'),
+                               ('/gis_polygon/transform', 'id=%s&outProj=4326' % gis_polygon_instance.id)]:
+        result = client.simulate_get(path, query_string=query_string, headers={'Accept': formats.ARROW})
+        assert result.headers['Content-Type'] == formats.ARROW, 'Arrow IPC stream has not been negotiated'
+
+        table = pyarrow.ipc.open_stream(result.content).read_all()
+        assert table.schema.field('geom').metadata[b'ARROW:extension:name'] == b'geoarrow.wkb'
+        rows = dict(zip(table.column('id').to_pylist(), table.column('geom').to_pylist()))
+        assert wkb.loads(rows[gis_polygon_instance.id]).equals(polygon), 'Wrong GeoArrow WKB of %s' % path
+
+    pytest.importorskip('flatbuffers')
+    result = client.simulate_get('/gis_polygon/search', query_string='bbox=-180,-90,180,90',
+                                 headers={'Accept': formats.FLATGEOBUF})
+    assert result.headers['Content-Type'] == formats.FLATGEOBUF
+    assert result.content.startswith(formats.FLATGEOBUF_MAGIC), 'Not a FlatGeobuf'
+
+    result = client.simulate_get('/gis_polygon/list', headers={'Accept': 'text/csv'})
+    assert result.status_code == 406, 'Passed an unsupported media type'
+
+
+def test_encode_flatgeobuf():
+    pytest.importorskip('flatbuffers')
+    polygon = Polygon([(0, 0), (10, 0), (10, 10), (0, 10)], [[(1, 1), (2, 1), (2, 2), (1, 1)]])
+    rows = [(1, 2, u'name', None, datetime(2020, 1, 1), datetime(2020, 1, 2), polygon.wkb)]
+
+    data = b''.join(formats.encode(formats.FLATGEOBUF, [rows]))
+    assert data.startswith(formats.FLATGEOBUF_MAGIC)
+
+    header_size = struct.unpack_from('<I', data, 8)[0]
+    feature = data[12 + header_size:]
+    assert struct.unpack_from('<I', feature)[0] == len(feature) - 4, 'Wrong size prefix of the feature'
+    for value in polygon.exterior.coords:
+        assert struct.pack('<dd', *value) in feature, 'Missed vertex %s of the polygon' % (value,)
+
+
+def test_encoders():
+    gis_polygon = GISPolygon(id=1, name=u'some_polygon', class_id=1, props={u'key': u'value'},
+                             _created=datetime(2020, 1, 1, 10, 20, 30, 40), _updated=datetime(2020, 1, 2),
+                             geom=from_shape(Polygon([(0, 0), (1, 0), (1, 1), (0, 0)]), srid=4326))
+
+    assert json.loads(dumps(encode_gis_polygon(gis_polygon))) == \
+        json.loads(json.dumps(gis_polygon.as_json_dict())), 'GET representation has changed'
+    assert json.loads(dumps(encode_created_gis_polygon(gis_polygon))) == \
+        GISPolygonSerializer(strict=True).dump(gis_polygon).data, 'POST representation has changed'
+
+
+def test_deserialize_geometry(monkeypatch):
+    """
+    Testing geometry parsing in every accepted format, validation and repair.
+    :param monkeypatch:
+    :return:
+    """
+    serializer = GISPolygonSerializer()
+    polygon = Polygon([(0, 0), (1, 0), (1, 1), (0, 0)])
+
+    for geom in [polygon.wkt, 'SRID=4326;' + polygon.wkt, mapping(polygon), json.dumps(mapping(polygon)),
+                 polygon.wkb_hex, wkb.dumps(polygon, hex=True, srid=4326)]:
+        data, errors = serializer.load({'name': 'some_polygon', 'geom': geom})
+        assert not errors and to_shape(data.geom).equals(polygon), 'Geometry %s has not been parsed' % geom
+
+    # ring touching itself, repairable into a polygon with a hole
+    invalid = Polygon([(0, 0), (4, 0), (4, 4), (2, 4), (3, 2), (1, 2), (2, 4), (0, 4), (0, 0)])
+    for geom, message in [('SRID=3857;' + polygon.wkt, 'Geometry in SRID 4326 is expected.'),
+                          ('POINT (1 2)', 'Polygon geometry is expected.'),
+                          ('POLYGON ((0 0, 1 0', 'Not a valid geometry.'),
+                          (invalid.wkt, 'Not a valid geometry: Ring Self-intersection[2 4].')]:
+        data, errors = serializer.load({'name': 'some_polygon', 'geom': geom})
+        assert errors == {'geom': [message]}, 'Passed a wrong geometry %s' % geom
+
+    monkeypatch.setattr(settings, 'GEOM_REPAIR', True)
+    data, errors = serializer.load({'name': 'some_polygon', 'geom': invalid.wkt})
+    assert not errors and to_shape(data.geom).is_valid, 'Invalid geometry has not been repaired'
+
+
+def test_check_geometries():
+    valid = Polygon([(0, 0), (1, 0), (1, 1), (0, 0)])
+    bowtie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1), (0, 0)])
+
+    checked, errors = check_geometries([valid, bowtie, valid])
+    assert checked == [valid, None, valid] and list(errors) == [1], 'Invalid geometry has not been found in batch'
+
+    # repaired into a MultiPolygon which does not fit the column
+    checked, errors = check_geometries([bowtie], repair=True)
+    assert checked == [None] and errors, 'Geometry has been repaired into not a Polygon'
+
+
+def test_geometry_pool(monkeypatch):
+    square = Polygon([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)])
+    geometries = [square.wkb, square.wkb]
+
+    monkeypatch.setattr(settings, 'GEOM_POOL_SIZE', 0)
+    inline = geometry_pool.stats()['inline']
+    projected = geometry_pool.run(geometry_pool.transform, geometries, 'epsg:4326', 'epsg:3857', output='wkt')
+    assert geometry_pool.stats()['inline'] == inline + 1, 'Job has not been run inline with no pool'
+    assert wkt.loads(projected[0]).bounds[2] == pytest.approx(111319.49), 'Polygon has not been projected'
+
+    monkeypatch.setattr(settings, 'GEOM_POOL_SIZE', 1)
+    monkeypatch.setattr(settings, 'GEOM_POOL_MIN_VERTICES', 0)
+    pooled = geometry_pool.stats()['pooled']
+    areas = geometry_pool.run(geometry_pool.area, geometries)
+    stats = geometry_pool.stats()
+    assert stats['pooled'] == pooled + 1 and stats['queued'] == 0, 'Job has not been run in the pool'
+    assert areas[0] == pytest.approx(12308778361, rel=1e-3), 'Wrong geodesic area of the polygon'
+
+    simplified = geometry_pool.run(geometry_pool.simplify, geometries, 0.1)
+    assert wkb.loads(simplified[0]).equals(square), 'Polygon has been changed by simplification'
+
+
+def test_make_polygon():
+    polygon = make_polygon(1000, seed=1, holes=3)
+    assert polygon.is_valid, 'Synthetic polygon is not valid'
+    assert len(polygon.exterior.coords) == 1001 and len(polygon.interiors) == 3, 'Wrong synthetic polygon shape'
+    assert polygon.equals(make_polygon(1000, seed=1, holes=3)), 'Synthetic polygon is not deterministic'
+
+
+def test_percentiles():
+    assert percentiles(range(100, 0, -1)) == {'p50': 50, 'p95': 95, 'p99': 99}, 'Wrong nearest rank percentiles'
+    assert percentiles([7]) == {'p50': 7, 'p95': 7, 'p99': 7}, 'Wrong percentiles of a single timing'
+
+
+def test_metrics(client):
+    result = client.simulate_get('/metrics')
+    assert result.status_code == 200, 'Metrics have not been served'
+    assert 'total;dur=' in result.headers['Server-Timing'], 'No Server-Timing header has been sent'
+
+    result = client.simulate_get('/metrics')
+    assert 'gis_polygon_request_duration_seconds_count{route="/metrics",method="GET",phase="total"}' in result.text, \
+        'Request has not been recorded into the histogram'
+
+
+def test_metrics_phases():
+    histogram = metrics.Histogram('test_seconds', 'Test.', (0.1, 1))
+    histogram.observe((('phase', 'db'),), 0.5)
+    histogram.observe((('phase', 'db'),), 2)
+    assert 'test_seconds_bucket{phase="db",le="1"} 1' in histogram.render(), 'Wrong cumulative bucket count'
+    assert 'test_seconds_count{phase="db"} 2' in histogram.render(), 'Wrong histogram count'
+
+    timings = metrics.Timings()
+    token = metrics._timings.set(timings)
+    try:
+        with metrics.phase('serialize'):
+            metrics.timed('decode')(lambda: None)()
+    finally:
+        metrics._timings.reset(token)
+    assert set(timings.phases) == {'serialize', 'decode'} and not timings.stack, 'Nested phases have not been timed'
+
+
+def test_profiling(monkeypatch):
+    class Slow(object):
+        def on_get(self, req, resp):
+            resp.body = '{}'
+
+    monkeypatch.setattr(settings, 'PROFILE_ENABLED', True)
+    monkeypatch.setattr(settings, 'PROFILE_SECRET', 'secret')
+    monkeypatch.setattr(settings, 'PROFILE_SLOW_SECONDS', 0)
+    monkeypatch.setattr(profiling, 'captures', profiling.CaptureBuffer(2))
+
+    app = falcon.App(middleware=[profiling.Profiler()])
+    app.add_route('/slow', Slow())
+    app.add_route('/gis_polygon/profiles', GISPolygonProfiles())
+    app.add_route('/gis_polygon/profiles/{capture_id}', GISPolygonProfiles())
+    profiling_client = testing.TestClient(app)
+    headers = {settings.PROFILE_HEADER: 'secret'}
+
+    assert 'X-Profile-Id' not in profiling_client.simulate_get('/slow').headers, 'Request has been captured'
+    assert profiling_client.simulate_get('/gis_polygon/profiles').status_code == 404, 'Captures listed with no secret'
+
+    capture_id = profiling_client.simulate_get('/slow', headers=headers).headers['X-Profile-Id']
+    result = profiling_client.simulate_get('/gis_polygon/profiles/%s' % capture_id, headers=headers)
+    assert result.json['profiled'] and 'on_get' in result.json['stats'], 'Request has not been profiled'
+    result = profiling_client.simulate_get('/gis_polygon/profiles/%s' % capture_id, headers=headers,
+                                           query_string='format=pstats')
+    assert result.status_code == 200 and result.content, 'Profile has not been downloaded'
+
+    monkeypatch.setattr(settings, 'PROFILE_SLOW_SECONDS', 1e-9)
+    profiling_client.simulate_get('/slow')
+    profiling_client.simulate_get('/slow')
+    result = profiling_client.simulate_get('/gis_polygon/profiles', headers=headers)
+    assert [capture['reason'] for capture in result.json] == ['slow', 'slow'], 'Slow requests have not been captured'
+
+
+def test_profiling_asgi(monkeypatch):
+    import falcon.asgi
+    from .asgi import ThreadedResource
+
+    class Slow(object):
+        async def on_get(self, req, resp):
+            resp.text = '{}'
+
+    monkeypatch.setattr(settings, 'PROFILE_ENABLED', True)
+    monkeypatch.setattr(settings, 'PROFILE_SECRET', 'secret')
+    monkeypatch.setattr(settings, 'PROFILE_SLOW_SECONDS', 0)
+    monkeypatch.setattr(profiling, 'captures', profiling.CaptureBuffer(2))
+
+    app = falcon.asgi.App(middleware=[profiling.AsyncProfiler()])
+    app.add_route('/slow', Slow())
+    app.add_route('/gis_polygon/profiles/{capture_id}', ThreadedResource(GISPolygonProfiles()))
+    profiling_client = testing.TestClient(app)
+    headers = {settings.PROFILE_HEADER: 'secret'}
+
+    result = profiling_client.simulate_get('/slow', headers=headers)
+    capture_id = result.headers['X-Profile-Id']
+    result = profiling_client.simulate_get('/gis_polygon/profiles/%s' % capture_id, headers=headers)
+    assert 'X-Profile-Id' not in result.headers, 'Captures have been captured'
+    assert result.json['reason'] == 'header' and not result.json['profiled'], 'Event loop has been profiled'
+
+
+def test_warm_up():
+    warm_up()
+    cached = get_transformer.cache_info().currsize
+    assert cached >= len(settings.WARM_UP_SRIDS), 'Transformers have not been prepared on warm up'
+
+    hits = get_transformer.cache_info().hits
+    get_transformer('epsg:4326', 'epsg:%s' % settings.WARM_UP_SRIDS[0])
+    assert get_transformer.cache_info().hits == hits + 1, 'Default transformer has not been prepared on warm up'
+
+
+def test_bulk_update_delete_gis_polygons(client, gis_polygon_instance):
+    """
+    Testing bulk PATCH and DELETE by ids and by a spatial filter.
+    :param client:
+    :param gis_polygon_instance:
+    :return:
+    """
+    headers = {"Content-Type": "application/json"}
+    query_string = 'ids=%s,-1' % gis_polygon_instance.id
+    result = client.simulate_patch('/gis_polygon/bulk', query_string=query_string,
+                                   body=json.dumps({"class_id": 7}), headers=headers)
+    assert result.json == {'updated': 1, 'ids': [gis_polygon_instance.id]}, 'GIS Polygons have not been updated'
+
+    result = client.simulate_get('/gis_polygon/%s' % gis_polygon_instance.id)
+    assert result.json['class_id'] == 7, 'Bulk update has not been written'
+
+    result = client.simulate_delete('/gis_polygon/bulk', query_string='bbox=-74,47,-73,48&class_id=7')
+    assert result.json == {'deleted': 1, 'ids': [gis_polygon_instance.id]}, 'GIS Polygons have not been deleted'
+
+
+def test_bulk_update_delete_filter_required(client):
+    result = client.simulate_patch('/gis_polygon/bulk', body=json.dumps({"class_id": 7}),
+                                   headers={"Content-Type": "application/json"})
+    assert result.status_code == 400, 'Updated gis_polygons with no filter'
+
+    result = client.simulate_delete('/gis_polygon/bulk', query_string='ids=1,a')
+    assert result.status_code == 400, 'Passed invalid ids'
+
+
+def _assert_class_stats(session):
+    """
+    Assert the class summaries maintained on writes match the ones computed from gis_polygons.
+    :param session:
+    :return:
+    """
+    session.commit()
+    maintained, computed = class_stats(session), class_stats(session, true())
+    assert [item['class_id'] for item in maintained] == [item['class_id'] for item in computed], \
+        'Summarized classes differ'
+    for item, expected in zip(maintained, computed):
+        assert item['count'] == expected['count'], 'Counts differ: %s %s' % (item, expected)
+        assert item['area'] == pytest.approx(expected['area']), 'Areas differ: %s %s' % (item, expected)
+        assert item['extent'] == pytest.approx(expected['extent']), 'Extents differ: %s %s' % (item, expected)
+        if expected['centroid'] is not None:
+            assert item['centroid'] == pytest.approx(expected['centroid']), 'Centroids differ'
+
+
+def test_gis_polygon_stats(wsgi_client, session, gis_polygon_data):
+    """
+    Testing class summaries are kept up to date by create, update and delete.
+    :param wsgi_client:
+    :param session:
+    :param gis_polygon_data:
+    :return:
+    """
+    rebuild_class_stats(session)
+    _assert_class_stats(session)
+
+    headers = {"Content-Type": "application/json"}
+    gis_polygon_data['class_id'] = 1001
+    gis_polygon_id = _post_gis_polygon(wsgi_client, session, dict(gis_polygon_data, name='stats_test_polygon'))
+    other_id = _post_gis_polygon(wsgi_client, session, dict(gis_polygon_data, name='stats_test_other_polygon', geom=(
+        'SRID=4326;POLYGON((10 10, 11 10, 11 11, 10 11, 10 10))')))
+    _assert_class_stats(session)
+
+    result = wsgi_client.simulate_get('/gis_polygon/stats').json
+    summary = [item for item in result if item['class_id'] == 1001][0]
+    assert summary['count'] == 2 and summary['extent'][2] == pytest.approx(11), 'Wrong class summary'
+
+    # the other polygon defines the extent, moving it out of the class has to shrink it
+    wsgi_client.simulate_put('/gis_polygon/%s' % other_id, body=json.dumps({"class_id": 1002}), headers=headers)
+    _assert_class_stats(session)
+
+    wsgi_client.simulate_put('/gis_polygon/%s' % gis_polygon_id, headers=headers, body=json.dumps(
+        {"geom": 'SRID=4326;POLYGON((0 0, 2 0, 2 2, 0 2, 0 0))'}))
+    _assert_class_stats(session)
+
+    result = wsgi_client.simulate_get('/gis_polygon/stats', query_string='bbox=9,9,12,12').json
+    assert [item['class_id'] for item in result] == [1002], 'Wrong classes in bbox'
+
+    wsgi_client.simulate_delete('/gis_polygon/%s' % gis_polygon_id)
+    wsgi_client.simulate_delete('/gis_polygon/bulk', query_string='class_id=1002')
+    _assert_class_stats(session)
+    assert not [item for item in class_stats(session) if item['class_id'] in (1001, 1002)], \
+        'Summaries of classes with no gis_polygons are left'
+
+
+def test_class_stats_as_dict():
+    result = stats_as_dict((1, 2, 4.0, 2.0, 6.0, 0.0, 1.0, 1.0, 2.0))
+    assert result == {'class_id': 1, 'count': 2, 'area': 4.0, 'extent': [0.0, 1.0, 1.0, 2.0], 'centroid': [0.5, 1.5]}
+
+    assert stats_as_dict((1, 1, 0.0, 0.0, 0.0, None, None, None, None))['centroid'] is None, 'Centroid of no area'
+
+
+def _read_changes(client, after=None, limit=None):
+    """
+    Read the change feed to the end from the cursor, page by page if limit is given.
+    :param client:
+    :param after:
+    :param limit:
+    :return: changes as (id, deleted) and the cursor to poll with
+    """
+    changes = []
+    while True:
+        query_string = '&'.join(([('after=%s' % after)] if after else []) + (['limit=%s' % limit] if limit else []))
+        result = client.simulate_get('/gis_polygon/changes', query_string=query_string)
+        changes += [(change['id'], change['deleted']) for change in result.json]
+        after = result.headers['X-Next-Cursor']
+        if not limit or len(result.json) < limit:
+            return changes, after
+
+
+def test_gis_polygon_changes(client, session, gis_polygon_data):
+    """
+    Testing the change feed lists created, updated and deleted gis_polygons once as of their last change.
+    :param client:
+    :param session:
+    :param gis_polygon_data:
+    :return:
+    """
+    _, after = _read_changes(client, limit=1000)
+
+    headers = {"Content-Type": "application/json"}
+    deleted_id = _post_gis_polygon(client, session, dict(gis_polygon_data, name='changes_test_deleted_polygon'))
+    updated_id = _post_gis_polygon(client, session, dict(gis_polygon_data, name='changes_test_updated_polygon'))
+    client.simulate_put('/gis_polygon/%s' % deleted_id, body=json.dumps({"name": "renamed"}), headers=headers)
+    client.simulate_delete('/gis_polygon/%s' % deleted_id)
+    client.simulate_put('/gis_polygon/%s' % updated_id, body=json.dumps({"name": "renamed"}), headers=headers)
+
+    expected = [(deleted_id, True), (updated_id, False)]
+    changes, polled = _read_changes(client, after)
+    assert changes == expected, 'Wrong changes streamed'
+    assert _read_changes(client, after, limit=1)[0] == expected, 'Wrong changes paginated'
+
+    result = client.simulate_get('/gis_polygon/changes', query_string='after=%s' % after)
+    assert [change['name'] for change in result.json if not change['deleted']] == ['renamed'], \
+        'Changed gis_polygon is not up to date'
+
+    assert _read_changes(client, polled, limit=10)[0] == [], 'Changes have been read twice'
+
+
+def test_changes_as_dict():
+    assert GISPolygonChanges.as_dict((5, 100, True, None)) == {'id': 5, 'deleted': True}, 'Wrong tombstone'
+
+    gis_polygon = GISPolygon(id=5, name=u'some_polygon', class_id=1, _created=datetime(2020, 1, 2, 3, 4, 5),
+                             _updated=datetime(2020, 1, 2, 3, 4, 5))
+    assert GISPolygonChanges.as_dict((5, 100, False, gis_polygon)) == dict(encode_gis_polygon(gis_polygon),
+                                                                           deleted=False), 'Wrong change'
+
+    req = falcon.Request(testing.create_environ(query_string='after=%s' % GISPolygonChanges.encode_cursor(100, 5)))
+    assert GISPolygonChanges.get_changes_after(req) == (100, 5), 'Cursor has not been decoded'
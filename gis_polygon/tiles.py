@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Mapbox Vector Tiles of gis_polygons rendered by PostGIS (ST_AsMVT) in Web Mercator tile grid.
+"""
+
+import math
+
+from geoalchemy2.elements import WKBElement
+from geoalchemy2.shape import to_shape
+from shapely import wkt
+from sqlalchemy import func, text
+
+import settings
+
+# Half of the Web Mercator (EPSG:3857) world extent in meters
+MERCATOR_HALF_EXTENT = 20037508.342789244
+
+TILE_SQL = text("""
+    SELECT ST_AsMVT(tile, 'gis_polygon', :extent, 'geom') FROM (
+        SELECT ST_AsMVTGeom(ST_Transform(gis_polygon.geom, 3857), bounds.geom, :extent, :buffer, true) AS geom,
+               gis_polygon.id, gis_polygon.name, gis_polygon.class_id
+        FROM gis_polygon, (SELECT ST_MakeEnvelope(:min_x, :min_y, :max_x, :max_y, 3857) AS geom) AS bounds
+        WHERE gis_polygon.geom && ST_Transform(bounds.geom, 4326)
+    ) AS tile
+""")
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= settings.TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """
+    Web Mercator bounds (min_x, min_y, max_x, max_y) of the tile.
+    :param z:
+    :param x:
+    :param y:
+    :return:
+    """
+    size = 2 * MERCATOR_HALF_EXTENT / 2 ** z
+    min_x = -MERCATOR_HALF_EXTENT + x * size
+    max_y = MERCATOR_HALF_EXTENT - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+def tile_lonlat_bounds(z, x, y, buffer=0):
+    """
+    Lon/lat bounds (min_lon, min_lat, max_lon, max_lat) of the tile, grown by the buffer in tile extent units.
+    :param z:
+    :param x:
+    :param y:
+    :param buffer:
+    :return:
+    """
+    margin = float(buffer) / settings.TILE_EXTENT
+    n = 2 ** z
+
+    def lon(tile_x):
+        return tile_x / n * 360.0 - 180.0
+
+    def lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return lon(x - margin), lat(min(y + 1 + margin, n)), lon(x + 1 + margin), lat(max(y - margin, 0))
+
+
+def render_tile(session, z, x, y):
+    """
+    Render the tile with gis_polygons id, name and class_id attributes.
+    :param session:
+    :param z:
+    :param x:
+    :param y:
+    :return: MVT bytes
+    """
+    min_x, min_y, max_x, max_y = tile_bounds(z, x, y)
+    tile = session.execute(TILE_SQL, {'extent': settings.TILE_EXTENT, 'buffer': settings.TILE_BUFFER,
+                                      'min_x': min_x, 'min_y': min_y, 'max_x': max_x, 'max_y': max_y}).scalar()
+    return bytes(tile or b'')
+
+
+def geom_bounds(geom):
+    """
+    Lon/lat bounds of GISPolygon.geom value: WKBElement or (E)WKT string, None for no geometry.
+    :param geom:
+    :return:
+    """
+    if geom is None:
+        return None
+    if isinstance(geom, WKBElement):
+        return to_shape(geom).bounds
+    return wkt.loads(geom.split(';')[-1]).bounds
+
+
+def geom_bounds_columns(geom):
+    """
+    SQL expressions of lon/lat bounds (min_x, min_y, max_x, max_y) of a geometry column, to be returned
+    by writes instead of the geometry itself.
+    :param geom:
+    :return:
+    """
+    return [func.ST_XMin(geom), func.ST_YMin(geom), func.ST_XMax(geom), func.ST_YMax(geom)]
+
+
+def invalidate_tiles(cache, *bounds):
+    """
+    Drop cached tiles (keyed by (z, x, y)) intersecting any of lon/lat bounds, including the tiles buffer.
+    :param cache:
+    :param bounds:
+    :return:
+    """
+    bounds = [b for b in bounds if b is not None]
+    if not bounds:
+        return
+
+    for key in cache.keys():
+        min_lon, min_lat, max_lon, max_lat = tile_lonlat_bounds(*key, buffer=settings.TILE_BUFFER)
+        if any(min_lon <= b[2] and b[0] <= max_lon and min_lat <= b[3] and b[1] <= max_lat for b in bounds):
+            cache.invalidate(key)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Gunicorn deployment profile preloading the GISPolygon application:
+    gunicorn -c gunicorn.conf.py
+
+The master imports and builds the application once and warms it up, workers are forked ready to serve
+(sharing the loaded modules copy-on-write) and drop the database connections inherited from the master.
+"""
+
+import multiprocessing
+import os
+
+wsgi_app = 'gis_polygon.app:create_app()'
+preload_app = True
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+
+
+def when_ready(server):
+    # the application has been preloaded by now, warm it up before the workers are forked
+    from gis_polygon.app import warm_up
+    from gis_polygon.db_session import engine
+
+    warm_up()
+    engine.dispose()
+
+
+def post_fork(server, worker):
+    from gis_polygon.db_session import reset_after_fork
+
+    reset_after_fork()